@@ -0,0 +1,315 @@
+import asyncio
+import heapq
+import itertools
+import logging
+import math
+import threading
+import time
+from contextlib import asynccontextmanager, contextmanager
+
+from metrics import Histogram, Labeled
+
+logger = logging.getLogger(__name__)
+
+# Приоритеты допуска: меньшее значение обслуживается раньше
+PRIORITY_DIALOG = 0   # отправитель посередине диалога
+PRIORITY_NEW = 1      # новая сессия (STATES['INITIAL']) или сессии нет
+PRIORITY_NAMES = {PRIORITY_DIALOG: 'dialog', PRIORITY_NEW: 'new'}
+# Метка запросов, принятых без ожидания: при свободных местах приоритет не определяется
+PRIORITY_ANY = 'any'
+# Результаты допуска (для метрики bot_admission_requests_total): admitted - принят, остальные - отклонен
+# queue_full - очередь заполнена, timeout - не дождался места, evicted - вытеснен из очереди запросом из диалога
+ADMISSION_RESULTS = ('admitted', 'queue_full', 'timeout', 'evicted')
+
+# Состояния ожидающего в очереди и результат допуска для каждого из них по окончании ожидания
+_WAITING, _ADMITTED, _EVICTED = 0, 1, 2
+_RESULTS = {_WAITING: 'timeout', _ADMITTED: 'admitted', _EVICTED: 'evicted'}
+
+# Подстройка лимита: окно усреднения времени обработки, минимум запросов в окне,
+# сглаживание изменения лимита и скорость, с которой долгое среднее следует за текущим
+WINDOW_SECONDS = 1.0
+WINDOW_MIN_SAMPLES = 10
+LIMIT_SMOOTHING = 0.2
+BASELINE_ALPHA = 0.02
+
+# Отклоненные запросы пишутся в журнал не чаще раза в столько секунд
+SHED_LOG_INTERVAL = 1.0
+
+# Границы гистограммы ожидания в очереди
+QUEUE_WAIT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+
+class _ControllerBase:
+    """Общая часть синхронного и асинхронного контроллера допуска.
+
+    Одновременно обрабатывается не больше limit запросов, лишние ждут в очереди не дольше
+    queue_timeout секунд, а при заполненной очереди сразу отклоняются. Новым сессиям доступна только
+    доля new_share лимита: остаток - запас для отправителей посередине диалога, которые в очереди
+    обслуживаются первыми и вытесняют из заполненной очереди последний запрос новой сессии.
+
+    limit подстраивается под время обработки (градиент, как в Netflix concurrency-limits):
+    среднее за окно сравнивается с долгим средним, и если обработка замедлилась больше чем в tolerance раз,
+    лимит плавно уменьшается, иначе растет на долю sqrt(limit), пока запросы его заполняют.
+
+    max_limit <= 0 отключает контроль: admit() принимает все запросы без учета.
+    """
+
+    def __init__(self, max_limit, min_limit=1, queue_size=100, queue_timeout=2.0, new_share=0.8, tolerance=2.0):
+        self.enabled = max_limit > 0
+        self.max_limit = max(1, int(max_limit))
+        self.min_limit = max(1, min(int(min_limit), self.max_limit))
+        self.queue_size = max(0, int(queue_size))
+        self.queue_timeout = queue_timeout
+        self.new_share = min(1.0, max(0.0, new_share))
+        self.tolerance = tolerance
+        self.limit = float(self.max_limit)
+        self.in_flight = 0
+        self._waiters = []
+        self._sequence = itertools.count()
+
+        self._window_started = time.monotonic()
+        self._window_sum = 0.0
+        self._window_count = 0
+        self._window_peak = 0
+        self._baseline = None
+        self._shed_logged = 0.0
+
+        self.requests = Labeled(('priority', 'result'))
+        self.latency = Histogram()
+        self.queue_wait = Histogram(QUEUE_WAIT_BUCKETS)
+
+    def _capacity(self, priority):
+        limit = int(self.limit)
+        if priority == PRIORITY_NEW:
+            return max(1, int(limit * self.new_share))
+        return limit
+
+    def _try_fast(self, priority):
+        """Место без ожидания: в очереди нет запросов того же или более высокого приоритета и лимит не занят"""
+        if (self._waiters and self._waiters[0][0] <= priority) or self.in_flight >= self._capacity(priority):
+            return False
+        self._start()
+        return True
+
+    def _start(self):
+        self.in_flight += 1
+        if self.in_flight > self._window_peak:
+            self._window_peak = self.in_flight
+
+    def _enqueue(self, priority, event):
+        """Постановка в очередь; None, если очередь заполнена и вытеснить некого"""
+        if len(self._waiters) >= self.queue_size:
+            victim = None
+            if priority == PRIORITY_DIALOG:
+                # Из заполненной очереди вытесняется последний пришедший запрос новой сессии
+                for waiter in self._waiters:
+                    if waiter[0] == PRIORITY_NEW and (victim is None or waiter[1] > victim[1]):
+                        victim = waiter
+            if victim is None:
+                return None
+            self._waiters.remove(victim)
+            heapq.heapify(self._waiters)
+            victim[2] = _EVICTED
+            victim[3].set()
+        waiter = [priority, next(self._sequence), _WAITING, event]
+        heapq.heappush(self._waiters, waiter)
+        return waiter
+
+    def _dispatch(self):
+        """Передача освободившихся мест ожидающим в порядке приоритета"""
+        while self._waiters and self.in_flight < self._capacity(self._waiters[0][0]):
+            waiter = heapq.heappop(self._waiters)
+            waiter[2] = _ADMITTED
+            self._start()
+            waiter[3].set()
+
+    def _abandon(self, waiter):
+        """Ожидающий прерван (тайм-аут, отмена): если место уже выдано, оно возвращается"""
+        if waiter[2] == _ADMITTED:
+            self.in_flight -= 1
+            self._dispatch()
+        elif waiter[2] == _WAITING:
+            self._waiters.remove(waiter)
+            heapq.heapify(self._waiters)
+
+    def _finish(self, duration):
+        """Запрос обработан за duration секунд: место освобождается, лимит подстраивается"""
+        self.in_flight -= 1
+        self.latency.observe(duration)
+        self._window_sum += duration
+        self._window_count += 1
+        now = time.monotonic()
+        if self._window_count >= WINDOW_MIN_SAMPLES and now - self._window_started >= WINDOW_SECONDS:
+            self._adjust(self._window_sum / self._window_count)
+            self._window_started = now
+            self._window_sum = 0.0
+            self._window_count = 0
+            self._window_peak = self.in_flight
+        self._dispatch()
+
+    def _adjust(self, current):
+        if current <= 0:
+            return
+        if self._baseline is None:
+            self._baseline = current
+        else:
+            self._baseline += (current - self._baseline) * BASELINE_ALPHA
+            # Обработка заметно ускорилась (прошел всплеск): долгое среднее быстрее возвращается вниз
+            if self._baseline > current * 2:
+                self._baseline *= 0.95
+        gradient = max(0.5, min(1.0, self.tolerance * self._baseline / current))
+        # Запросов в окне было меньше половины лимита: задержка не говорит о том, выдержит ли сервер больше
+        if gradient >= 1.0 and self._window_peak < self.limit / 2:
+            return
+        target = self.limit * gradient if gradient < 1.0 else self.limit + math.sqrt(self.limit)
+        limit = self.limit * (1 - LIMIT_SMOOTHING) + target * LIMIT_SMOOTHING
+        limit = max(self.min_limit, min(self.max_limit, limit))
+        if int(limit) != int(self.limit):
+            logger.info("Лимит одновременных webhook-запросов: %d -> %d (обработка %.1f мс, обычно %.1f мс)",
+                        self.limit, limit, current * 1000, self._baseline * 1000)
+        self.limit = limit
+
+    def _record(self, priority, result):
+        name = PRIORITY_NAMES.get(priority, str(priority))
+        self.requests.labels(name, result).inc()
+        if result != 'admitted':
+            now = time.monotonic()
+            if now - self._shed_logged >= SHED_LOG_INTERVAL:
+                self._shed_logged = now
+                logger.warning("Webhook-запрос отклонен при перегрузке (%s, %s): обрабатывается %d из %d, в очереди %d",
+                               name, result, self.in_flight, self.limit, len(self._waiters))
+
+    def queued(self):
+        """Количество ожидающих по приоритетам"""
+        counts = {}
+        for priority, _, _, _ in list(self._waiters):
+            name = PRIORITY_NAMES.get(priority, str(priority))
+            counts[name] = counts.get(name, 0) + 1
+        return counts
+
+    def stats(self):
+        return {
+            'limit': int(self.limit),
+            'min_limit': self.min_limit,
+            'max_limit': self.max_limit,
+            'new_limit': self._capacity(PRIORITY_NEW),
+            'in_flight': self.in_flight,
+            'queued': self.queued(),
+            'queue_size': self.queue_size,
+            'baseline_ms': round(self._baseline * 1000, 3) if self._baseline is not None else None,
+            'requests': {f'{values[0]}:{values[1]}': counter.value for values, counter in self.requests.items()},
+            'latency': self.latency.snapshot(),
+            'queue_wait': self.queue_wait.snapshot(),
+        }
+
+
+class AdmissionController(_ControllerBase):
+    """Контроллер допуска для потоков (app.py)"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def admit(self, classify):
+        """Допуск запроса: внутри блока True, если запрос принят, и False, если его нужно отклонить.
+
+        classify() возвращает приоритет запроса и вызывается только при нехватке мест
+        (например, чтобы прочитать состояние сессии отправителя).
+        """
+        if not self.enabled:
+            yield True
+            return
+        with self._lock:
+            admitted = self._try_fast(PRIORITY_NEW)
+        if admitted:
+            self._record(PRIORITY_ANY, 'admitted')
+        else:
+            admitted = self._wait(classify())
+        if not admitted:
+            yield False
+            return
+        started = time.monotonic()
+        try:
+            yield True
+        finally:
+            with self._lock:
+                self._finish(time.monotonic() - started)
+
+    def _wait(self, priority):
+        started = time.monotonic()
+        with self._lock:
+            if self._try_fast(priority):
+                self._record(priority, 'admitted')
+                return True
+            waiter = self._enqueue(priority, threading.Event())
+            if waiter is None:
+                self._record(priority, 'queue_full')
+                return False
+        try:
+            waiter[3].wait(self.queue_timeout)
+        except BaseException:
+            with self._lock:
+                self._abandon(waiter)
+            raise
+        with self._lock:
+            result = _RESULTS[waiter[2]]
+            if result == 'timeout':
+                self._abandon(waiter)
+        self._record(priority, result)
+        self.queue_wait.observe(time.monotonic() - started)
+        return result == 'admitted'
+
+    def stats(self):
+        with self._lock:
+            return super().stats()
+
+
+class AsyncAdmissionController(_ControllerBase):
+    """Контроллер допуска для сопрограмм (asgi.py): все обращения - из цикла событий, блокировка не нужна"""
+
+    @asynccontextmanager
+    async def admit(self, classify):
+        """Как AdmissionController.admit, ожидание места не блокирует цикл событий.
+
+        classify возвращает awaitable с приоритетом: чтение сессий выполняется вне цикла событий.
+        """
+        if not self.enabled:
+            yield True
+            return
+        admitted = self._try_fast(PRIORITY_NEW)
+        if admitted:
+            self._record(PRIORITY_ANY, 'admitted')
+        else:
+            admitted = await self._wait(await classify())
+        if not admitted:
+            yield False
+            return
+        started = time.monotonic()
+        try:
+            yield True
+        finally:
+            self._finish(time.monotonic() - started)
+
+    async def _wait(self, priority):
+        started = time.monotonic()
+        if self._try_fast(priority):
+            self._record(priority, 'admitted')
+            return True
+        waiter = self._enqueue(priority, asyncio.Event())
+        if waiter is None:
+            self._record(priority, 'queue_full')
+            return False
+        try:
+            await asyncio.wait_for(waiter[3].wait(), self.queue_timeout)
+        except asyncio.TimeoutError:
+            pass
+        except BaseException:
+            self._abandon(waiter)
+            raise
+        result = _RESULTS[waiter[2]]
+        if result == 'timeout':
+            self._abandon(waiter)
+        self._record(priority, result)
+        self.queue_wait.observe(time.monotonic() - started)
+        return result == 'admitted'
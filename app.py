@@ -1,16 +1,68 @@
-from flask import Flask, request, jsonify, send_from_directory
-import requests
+from flask import Flask, Response, request, jsonify, send_from_directory, g
 import json
 import logging
 import os
+import time
+import atexit
+import uuid
+import contextvars
+import hmac
+import sqlite3
+from contextlib import contextmanager
+from urllib.parse import urlsplit
 from flask_cors import CORS
 from trello import TrelloClient
 from config import (STATES, WAAPI_URL, WAAPI_TOKEN, WAAPI_INSTANCE_ID, TRELLO_API_KEY, 
-                   TRELLO_API_TOKEN, TRELLO_BOARD_ID, TRELLO_LIST_ID, USER_TYPES, 
-                   DEALERSHIP_STATES, CLIENT_STATES, LANGUAGES, MESSAGES)
+                   TRELLO_API_TOKEN, TRELLO_BOARD_ID, TRELLO_LIST_ID, TRELLO_API_URL, USER_TYPES, 
+                   DEALERSHIP_STATES, CLIENT_STATES, LANGUAGES, MESSAGES,
+                   OUTBOUND_QUEUE_SIZE, OUTBOUND_WORKERS, OUTBOUND_SHUTDOWN_TIMEOUT,
+                   OUTBOX_PATH, OUTBOX_FSYNC_BATCH, OUTBOX_FSYNC_INTERVAL, OUTBOX_REPLAY_INTERVAL,
+                   OUTBOX_REPLAY_CONCURRENCY, OUTBOX_REPLAY_DELAY, OUTBOX_REPLAY_BATCH, OUTBOX_MAX_ATTEMPTS,
+                   SESSION_BACKEND, SESSION_DB_PATH, SESSION_MAX_COUNT, SESSION_IDLE_TTL,
+                   SESSION_COMPLETED_TTL, SESSION_SNAPSHOT_PATH, SESSION_SNAPSHOT_INTERVAL,
+                   SESSION_SNAPSHOT_COMPACT_RATIO, DIALOG_FLOW, WEBHOOK_MAX_BYTES, WEBHOOK_MAX_DEPTH,
+                   WEBHOOK_MAX_NODES, DEDUP_BACKEND, DEDUP_DB_PATH, DEDUP_MAX_SIZE, DEDUP_TTL,
+                   SENDER_LOCK_SHARDS, LOG_LEVEL, LOG_FORMAT, LOG_REDACT, LOG_REDACT_FIELDS,
+                   LOG_PAYLOAD_SAMPLE_RATE, MEDIA_DIR, MEDIA_CHUNK_SIZE, MEDIA_MAX_BYTES,
+                   MEDIA_DOWNLOAD_TIMEOUT, MEDIA_ALLOWED_HOSTS,
+                   WAAPI_RATE_LIMIT, WAAPI_RATE_BURST, BROADCAST_DIR, BROADCAST_CONCURRENCY, BROADCAST_TOKEN,
+                   ADMIN_TOKEN, APPLICATIONS_DB_PATH, WAAPI_INSTANCES, REPLY_COALESCE_MAX_CHARS,
+                   TRELLO_UPSERT, TRELLO_CARD_INDEX_PATH, TRELLO_CARD_CACHE_SIZE, TRELLO_CARD_INDEX_REFRESH,
+                   TRACE_SLOW_MS, TRACE_SLOW_LOG_SIZE, ANSWER_MATCHING, ADMISSION_MAX_IN_FLIGHT,
+                   ADMISSION_MIN_IN_FLIGHT, ADMISSION_QUEUE_SIZE, ADMISSION_QUEUE_TIMEOUT, ADMISSION_NEW_SHARE,
+                   ADMISSION_LATENCY_TOLERANCE, ADMISSION_RETRY_AFTER, DELIVERY_TTL, DELIVERY_BUCKET_SECONDS,
+                   DELIVERY_MAX_PENDING, DELIVERY_ALERT_RATIO, DELIVERY_ALERT_MIN)
+from admission import (AdmissionController, PRIORITY_DIALOG, PRIORITY_NEW, PRIORITY_NAMES, PRIORITY_ANY,
+                       ADMISSION_RESULTS)
+from outbound import OutboundDispatcher
+from delivery import DeliveryTracker, mark_inbound
+from rate_limit import InstanceRateLimiter, PRIORITY_INTERACTIVE, PRIORITY_BULK
+from broadcast import BroadcastManager, BroadcastError, normalize_phone, read_recipient_file
+from applications import ApplicationStore, QueryError, parse_filters, export_csv, export_jsonl
+from upstream import UpstreamClient, waapi_http, trello_http, media_http, CircuitOpenError
+from outbox import Outbox, RejectedError
+from trello_index import TrelloCardIndex
+from session_store import Session, MemorySessionStore, create_session_store
+from session_snapshot import SessionSnapshot
+from dialog import DialogEngine
+from matching import MATCH_KINDS, match_counters
+from ingest import PayloadError, parse_json, extract_messages, extract_acks, extract_form, group_by_sender
+from dedup import DedupCache, SQLiteDedupStore, message_key
+from keyed_locks import KeyedLocks
+from logging_setup import setup_logging, set_request_id, get_request_id, should_log_payload
+from media import MediaSpool, MediaFile, MediaError, MultipartFile
+from metrics import Registry, Histogram, Labeled
+import tracing
+from tracing import Tracer, Profiler
 
-# Настройка логирования
-logging.basicConfig(level=logging.INFO)
+# Настройка логирования: запись в отдельном потоке, маскирование персональных данных
+setup_logging(
+    level=LOG_LEVEL,
+    fmt=LOG_FORMAT,
+    redact=LOG_REDACT,
+    redact_fields=LOG_REDACT_FIELDS,
+    payload_sample_rate=LOG_PAYLOAD_SAMPLE_RATE
+)
 logger = logging.getLogger(__name__)
 app = Flask(__name__)
 # Включаем CORS для всех маршрутов
@@ -22,14 +74,8 @@ trello_client = TrelloClient(
     api_secret=TRELLO_API_TOKEN
 )
 
-# Для отладки и мониторинга входящих запросов
-@app.route('/', methods=['GET', 'POST'])
-def index():
-    """Простой индексный маршрут для проверки доступности сервера"""
-    logger.info(f"Получен запрос на индексную страницу: {request.method}")
-    
-    # Добавляем HTML с инструкцией по обходу предупреждения ngrok
-    html = """
+# Страница с инструкцией по обходу предупреждения ngrok
+INDEX_HTML = """
     <html>
         <head>
             <title>WhatsApp Bot Server</title>
@@ -58,57 +104,252 @@ def index():
         </body>
     </html>
     """
-    return html
+
+# Трассировка webhook-запросов по этапам и профилирование по команде (/debug/profile)
+tracer = Tracer(TRACE_SLOW_MS / 1000.0, TRACE_SLOW_LOG_SIZE)
+profiler = Profiler()
+
+@app.before_request
+def assign_request_id():
+    """Идентификатор запроса для записей журнала"""
+    set_request_id(request.headers.get('X-Request-ID') or uuid.uuid4().hex[:16])
+    if request.path == '/webhook':
+        g.trace = tracer.begin(get_request_id(), request.path)
+        g.profile = profiler.begin() if profiler.active else None
+
+@app.teardown_request
+def finish_trace(exc):
+    """Завершение трассировки и профилирования webhook-запроса"""
+    if request.path == '/webhook':
+        profiler.end(g.pop('profile', None))
+        tracer.end(g.pop('trace', None))
+
+# Для отладки и мониторинга входящих запросов
+@app.route('/', methods=['GET', 'POST'])
+def index():
+    """Простой индексный маршрут для проверки доступности сервера"""
+    logger.info("Получен запрос на индексную страницу: %s", request.method)
+    return INDEX_HTML
 
 # Хранение состояний пользователей и их данных
-user_states = {}
-user_data = {}
-user_types = {}  # Хранение типа пользователя: автосалон или клиент
-user_languages = {}  # Хранение выбранного языка пользователя
+session_store = create_session_store(
+    SESSION_BACKEND,
+    SESSION_DB_PATH,
+    max_sessions=SESSION_MAX_COUNT,
+    idle_ttl=SESSION_IDLE_TTL,
+    completed_ttl=SESSION_COMPLETED_TTL,
+    completed_states=(STATES['COMPLETED'], DEALERSHIP_STATES['COMPLETED'], CLIENT_STATES['COMPLETED'])
+)
+
+# Сессии в памяти восстанавливаются из снимка, изменения записываются в его журнал в фоновом потоке
+session_snapshot = None
+if SESSION_SNAPSHOT_PATH and isinstance(session_store, MemorySessionStore):
+    session_snapshot = SessionSnapshot(SESSION_SNAPSHOT_PATH, session_store, SESSION_SNAPSHOT_INTERVAL,
+                                       SESSION_SNAPSHOT_COMPACT_RATIO)
+    session_snapshot.restore()
+    session_snapshot.start()
+    session_snapshot.flush_on_signal()
+    atexit.register(session_snapshot.stop)
+
+# Сессии, загруженные при обработке текущего сообщения, и экземпляр waApi, получивший сообщение
+_session_scope = contextvars.ContextVar('session_scope', default=None)
+_current_instance = contextvars.ContextVar('waapi_instance', default=WAAPI_INSTANCE_ID)
+
+def session_key(phone_number, instance_id=None):
+    """Ключ сессии: номер для экземпляра по умолчанию (как при одном экземпляре), экземпляр:номер для остальных"""
+    instance_id = instance_id or _current_instance.get()
+    return phone_number if instance_id == WAAPI_INSTANCE_ID else f'{instance_id}:{phone_number}'
+
+def split_session_key(key):
+    """Экземпляр waApi и номер по ключу сессии"""
+    instance_id, _, phone_number = key.rpartition(':')
+    return instance_id or WAAPI_INSTANCE_ID, phone_number
+
+def new_session():
+    """Новая сессия: начинаем с выбора языка, по умолчанию русский язык"""
+    return Session(STATES['INITIAL'], USER_TYPES['UNKNOWN'], LANGUAGES['RU'])
+
+@contextmanager
+def session_scope(phone_number, instance_id=None):
+    """Одно чтение сессии из хранилища в начале обработки сообщения и одна запись в конце.
+
+    Сессии внутри scope относятся к экземпляру instance_id: у одного номера может быть свой диалог
+    с каждым номером WhatsApp бота.
+    """
+    scope = {}
+    token = _session_scope.set(scope)
+    instance_token = _current_instance.set(instance_id or WAAPI_INSTANCE_ID)
+    try:
+        # Чтение и запись идут одной транзакцией хранилища, чтобы другой процесс gunicorn
+        # не перезаписал сессию между ними
+        with session_store.transaction(session_key(phone_number, instance_id)):
+            with tracing.span('session'):
+                session = _get_session(phone_number)
+            yield session
+            with tracing.span('session'):
+                for key, session in scope.items():
+                    session_store.save(key, session)
+    finally:
+        _current_instance.reset(instance_token)
+        _session_scope.reset(token)
+
+def _get_session(phone_number):
+    """Сессия пользователя из текущей обработки или из хранилища"""
+    key = session_key(phone_number)
+    scope = _session_scope.get()
+    if scope is not None and key in scope:
+        return scope[key]
+    session = session_store.load(key)
+    if session is None:
+        session = new_session()
+    if scope is not None:
+        scope[key] = session
+    return session
+
+def _commit_session(phone_number, session):
+    """Сохранение изменений, сделанных вне session_scope"""
+    if _session_scope.get() is None:
+        session_store.save(session_key(phone_number), session)
 
 def get_user_state(phone_number):
     """Получение текущего состояния пользователя"""
-    if (phone_number not in user_states):
-        user_states[phone_number] = STATES['INITIAL']  # Начинаем с выбора языка
-        user_data[phone_number] = {}
-        user_types[phone_number] = USER_TYPES['UNKNOWN']
-        user_languages[phone_number] = LANGUAGES['RU']  # По умолчанию русский язык
-    return user_states[phone_number]
+    return _get_session(phone_number).state
 
 def update_user_state(phone_number, new_state):
     """Обновление состояния пользователя"""
-    user_states[phone_number] = new_state
+    session = _get_session(phone_number)
+    session.state = new_state
+    _commit_session(phone_number, session)
+
+def get_user_data(phone_number):
+    """Получение собранных данных пользователя"""
+    return _get_session(phone_number).data or {}
 
 def save_user_data(phone_number, key, value):
     """Сохранение данных пользователя"""
-    if phone_number not in user_data:
-        user_data[phone_number] = {}
-    user_data[phone_number][key] = value
+    session = _get_session(phone_number)
+    if session.data is None:
+        session.data = {}
+    session.data[key] = value
+    _commit_session(phone_number, session)
+
+def clear_user_data(phone_number):
+    """Сброс собранных данных пользователя"""
+    session = _get_session(phone_number)
+    session.data = None
+    _commit_session(phone_number, session)
 
 def set_user_type(phone_number, user_type):
     """Установка типа пользователя"""
-    user_types[phone_number] = user_type
+    session = _get_session(phone_number)
+    session.user_type = user_type
+    _commit_session(phone_number, session)
 
 def get_user_type(phone_number):
     """Получение типа пользователя"""
-    return user_types.get(phone_number, USER_TYPES['UNKNOWN'])
+    return _get_session(phone_number).user_type
 
 def set_user_language(phone_number, language):
     """Установка языка пользователя"""
-    user_languages[phone_number] = language
+    session = _get_session(phone_number)
+    session.language = language
+    _commit_session(phone_number, session)
 
 def get_user_language(phone_number):
     """Получение языка пользователя"""
-    return user_languages.get(phone_number, LANGUAGES['RU'])
+    return _get_session(phone_number).language
 
 def get_message(phone_number, message_key):
     """Получение сообщения на выбранном пользователем языке"""
     language = get_user_language(phone_number)
     return MESSAGES[language].get(message_key, MESSAGES['ru'][message_key])  # Если сообщения нет на выбранном языке, возвращаем на русском
 
+# Ключи уже обработанных сообщений для отбрасывания повторных доставок
+dedup_cache = DedupCache(
+    max_size=DEDUP_MAX_SIZE,
+    ttl=DEDUP_TTL,
+    shared=SQLiteDedupStore(DEDUP_DB_PATH, DEDUP_TTL) if DEDUP_BACKEND == 'sqlite' else None
+)
+
+# Блокировки по номеру отправителя
+sender_locks = KeyedLocks(SENDER_LOCK_SHARDS)
+
+# Допуск webhook-запросов: при перегрузке лишние запросы отклоняются ответом 503, а не ждут потока
+admission = AdmissionController(ADMISSION_MAX_IN_FLIGHT, ADMISSION_MIN_IN_FLIGHT, ADMISSION_QUEUE_SIZE,
+                                ADMISSION_QUEUE_TIMEOUT, ADMISSION_NEW_SHARE, ADMISSION_LATENCY_TOLERANCE)
+
+# Таблица переходов диалога, скомпилированная из config.DIALOG_FLOW, с индексами ключевых слов состояний
+answer_matches = match_counters()
+dialog_engine = DialogEngine(DIALOG_FLOW, MESSAGES, LANGUAGES['RU'], ANSWER_MATCHING, answer_matches)
+
+# Хранилище фото документов из сообщений
+media_spool = MediaSpool(MEDIA_DIR, chunk_size=MEDIA_CHUNK_SIZE, max_bytes=MEDIA_MAX_BYTES,
+                         download_timeout=MEDIA_DOWNLOAD_TIMEOUT,
+                         allowed_hosts=MEDIA_ALLOWED_HOSTS + [urlsplit(WAAPI_URL or '').hostname or ''])
+
+# Заявки для поиска и выгрузки (/applications)
+application_store = ApplicationStore(APPLICATIONS_DB_PATH)
+
+def waapi_media_headers(url):
+    """Заголовок с токеном waApi, если файл загружается с сервера waApi (та же схема, хост и порт), иначе None"""
+    if not WAAPI_URL or not url:
+        return None
+    waapi, target = urlsplit(WAAPI_URL), urlsplit(url)
+    if (target.scheme.lower(), target.netloc.lower()) != (waapi.scheme.lower(), waapi.netloc.lower()):
+        return None
+    return {'Authorization': f'Bearer {WAAPI_TOKEN}'}
+
+def fetch_media(message):
+    """Загрузка файла из сообщения в хранилище, MediaFile или None при ошибке"""
+    try:
+        return media_spool.fetch(media_http, message.media, headers=waapi_media_headers(message.media.url))
+    except CircuitOpenError as e:
+        logger.warning("Файл не загружен: %s", e)
+    except Exception as e:
+        logger.error("Ошибка при загрузке файла из сообщения: %s", e, exc_info=not isinstance(e, MediaError))
+    return None
+
+def prefetch_media(sender_phone, instance_id, batch):
+    """Загрузка файлов пачки до блокировки отправителя, если диалог уже ждет фото документа: медленная загрузка
+    не задерживает обработку других сообщений. Возвращает {id(сообщения): MediaFile или None}"""
+    if all(message.media is None for message in batch):
+        return {}
+    session = session_store.load(session_key(sender_phone, instance_id))
+    if session is None or dialog_engine.media_field(session.state) is None:
+        return {}
+    return {id(message): fetch_media(message) for message in batch if message.media is not None}
+
+def receive_media(session, message, prefetched=None):
+    """Сохранение файла из сообщения, если в текущем состоянии диалога ожидается фото документа.
+
+    prefetched - файлы, загруженные prefetch_media. Возвращает текст для диалога: подпись к файлу
+    или отметку о вложении.
+    """
+    field = dialog_engine.media_field(session.state)
+    if field is None:
+        logger.info("Файл в состоянии %s не ожидается и не загружается", session.state)
+        return message.text
+    
+    if prefetched is not None and id(message) in prefetched:
+        media_file = prefetched[id(message)]
+    else:
+        media_file = fetch_media(message)
+    if media_file is None:
+        return message.text
+    
+    logger.info("Файл %s (%d байт) сохранен для поля %s", media_file.filename, media_file.size, field)
+    if session.data is None:
+        session.data = {}
+    session.data.setdefault('media', {})[field] = media_file.to_dict()
+    return message.text or f"Фото: {media_file.filename}"
+
 def send_to_trello(phone_number):
     """Отправка данных в Trello в виде карточки"""
-    data = user_data[phone_number]
+    return deliver_trello_card(prepare_trello_card(phone_number))
+
+def prepare_trello_card(phone_number):
+    """Формирование карточки Trello по данным пользователя и запись ее в журнал заявок"""
+    data = get_user_data(phone_number)
     user_type = get_user_type(phone_number)
     
     if user_type == USER_TYPES['DEALERSHIP']:
@@ -152,74 +393,251 @@ def send_to_trello(phone_number):
 Пробег: {data.get('car_mileage', '')}
         """
     
+    # Заявка сначала записывается в журнал, чтобы не потеряться при недоступности Trello или сбое процесса.
+    # Список Trello выбирается по экземпляру waApi (номеру WhatsApp), получившему заявку
+    instance_id = _current_instance.get()
+    card = {
+        'phone': phone_number,
+        'user_type': user_type,
+        'fields': {key: value for key, value in data.items() if key != 'media'},
+        'name': card_name,
+        'desc': card_description,
+        'list_id': WAAPI_INSTANCES.get(instance_id) or TRELLO_LIST_ID,
+        'instance': instance_id
+    }
+    if data.get('media'):
+        # Файлы прикрепляются к карточке после ее создания, в журнал пишутся только их хеши
+        card['media'] = list(data['media'].values())
+    card['id'] = trello_outbox.append(card)
+    # Копия заявки для поиска и выгрузки; ошибка хранилища не мешает отправке в Trello
     try:
-        # Прямая отправка в Trello через API вместо использования библиотеки
-        headers = {
-            'Accept': 'application/json',
-            'Content-Type': 'application/json'
-        }
-        
-        query_params = {
-            'key': TRELLO_API_KEY,
-            'token': TRELLO_API_TOKEN,
-            'name': card_name,
-            'desc': card_description,
-            'idList': TRELLO_LIST_ID,
-            'pos': 'top'
-        }
-        
-        trello_api_url = f"https://api.trello.com/1/cards"
-        
-        logger.info(f"Отправка запроса в Trello API: {trello_api_url}")
-        response = requests.post(trello_api_url, params=query_params, headers=headers)
-        
-        if response.status_code == 200 or response.status_code == 201:
-            card_data = response.json()
-            logger.info(f"Карточка успешно создана в Trello, ID: {card_data.get('id')}")
-            return {'result': True, 'card_id': card_data.get('id')}
-        else:
-            logger.error(f"Ошибка при создании карточки в Trello: {response.status_code} - {response.text}")
-            
-            # Запасной вариант - логирование данных локально
-            logger.info(f"Локальное сохранение данных заявки: {card_name}")
-            logger.info(card_description)
-            
-            # Можно сохранить в локальный файл для дальнейшего импорта
-            try:
-                with open('saved_applications.txt', 'a', encoding='utf-8') as f:
-                    f.write(f"\n\n--- НОВАЯ ЗАЯВКА: {card_name} ---\n")
-                    f.write(card_description)
-                    f.write("\n--- КОНЕЦ ЗАЯВКИ ---\n")
-                logger.info("Данные успешно сохранены в локальный файл")
-            except Exception as write_error:
-                logger.error(f"Ошибка при записи в файл: {write_error}")
-            
-            # Успешное завершение, даже если Trello недоступен
-            return {'result': True, 'local_save': True}
-            
+        application_store.add(card['id'], phone_number, USER_TYPE_LABELS.get(user_type, str(user_type)),
+                              card['fields'])
+    except sqlite3.Error as e:
+        logger.error("Заявка %s не записана в хранилище заявок: %s", card['id'], e)
+    return card
+
+def deliver_trello_card(card):
+    """Отправка записанной в журнал карточки в Trello"""
+    with tracing.span('trello'):
+        try:
+            card_id = create_trello_card(card)
+        except RejectedError as e:
+            # Заявку повторит фоновая отправка и после OUTBOX_MAX_ATTEMPTS отказов перенесет в журнал отклоненных
+            logger.error("Trello отклонил заявку %s: %s", card['id'], e)
+            card_id = None
+        return complete_trello_card(card, card_id)
+
+def complete_trello_card(card, card_id):
+    """Отметка о созданной карточке в журнале заявок и результат отправки"""
+    if card_id:
+        trello_outbox.ack(card['id'])
+        return {'result': True, 'card_id': card_id}
+    
+    # Успешное завершение, даже если Trello недоступен: заявку отправит фоновый повтор
+    logger.info("Заявка %s сохранена в журнал для повторной отправки в Trello", card['id'])
+    return {'result': True, 'local_save': True}
+
+def trello_card_request(card):
+    """URL, параметры и заголовки запроса на создание карточки в Trello"""
+    # Прямая отправка в Trello через API вместо использования библиотеки
+    headers = {
+        'Accept': 'application/json',
+        'Content-Type': 'application/json'
+    }
+    
+    query_params = {
+        'key': TRELLO_API_KEY,
+        'token': TRELLO_API_TOKEN,
+        'name': card['name'],
+        'desc': card['desc'],
+        'idList': card['list_id'],
+        'pos': 'top'
+    }
+    
+    return f"{TRELLO_API_URL}/cards", query_params, headers
+
+# Ответы Trello, после которых повтор той же заявки бесполезен (ошибки доступа и 429 - временные)
+TRELLO_REJECTED_STATUSES = (400, 413, 422)
+
+def trello_card_id(response):
+    """ID созданной карточки из ответа Trello или None"""
+    if response.status_code == 200 or response.status_code == 201:
+        card_data = response.json()
+        logger.info("Карточка успешно создана в Trello, ID: %s", card_data.get('id'))
+        return card_data.get('id')
+    
+    logger.error("Ошибка при создании карточки в Trello: %s - %s", response.status_code, response.text)
+    if response.status_code in TRELLO_REJECTED_STATUSES or response.status_code == 404:
+        # Неверный список или поля заявки: повтор той же заявки получит тот же ответ
+        raise RejectedError(f"Trello вернул {response.status_code}: {response.text[:200]}")
+    return None
+
+def existing_trello_card(card):
+    """ID карточки номера заявки в ее списке, если повторные заявки обновляют карточку (TRELLO_UPSERT), иначе None"""
+    if trello_cards is None or not card.get('list_id'):
+        return None
+    return trello_cards.get(card['list_id'], card['phone'])
+
+def remember_trello_card(card, card_id):
+    """Запись созданной карточки в индекс номеров"""
+    if trello_cards is not None and card.get('list_id'):
+        trello_cards.put(card['list_id'], card['phone'], card_id)
+
+def trello_update_request(card, card_id):
+    """Метод, URL, параметры и заголовки запроса на обновление карточки card_id (update) или комментарий (comment)"""
+    headers = {'Accept': 'application/json'}
+    query_params = {'key': TRELLO_API_KEY, 'token': TRELLO_API_TOKEN}
+    if TRELLO_UPSERT == 'update':
+        # Обновленная карточка поднимается наверх списка заявки, как новая: архивная возвращается из архива,
+        # перенесенная в другой список - обратно
+        query_params.update(name=card['name'], desc=card['desc'], pos='top', idList=card['list_id'], closed='false')
+        return 'PUT', f"{TRELLO_API_URL}/cards/{card_id}", query_params, headers
+    query_params['text'] = f"{card['name']}\n{card['desc']}"
+    return 'POST', f"{TRELLO_API_URL}/cards/{card_id}/actions/comments", query_params, headers
+
+def trello_card_moved(card, response):
+    """Карточка из ответа Trello в архиве или не в списке заявки"""
+    try:
+        data = response.json()
+    except ValueError:
+        return False
+    if not isinstance(data, dict):
+        return False
+    if TRELLO_UPSERT == 'comment':
+        # Ответ на комментарий - действие: карточка и список, в котором она сейчас находится
+        action = data.get('data') if isinstance(data.get('data'), dict) else {}
+        card_data = action.get('card') if isinstance(action.get('card'), dict) else {}
+        list_data = action.get('list') if isinstance(action.get('list'), dict) else {}
+        data = {'closed': card_data.get('closed'), 'idList': list_data.get('id')}
+    if data.get('closed'):
+        return True
+    return data.get('idList') is not None and data['idList'] != card.get('list_id')
+
+def trello_update_result(card, card_id, response):
+    """ID обновленной карточки, None при ошибке или False, если карточки больше нет в списке заявки
+    (нужно создать новую)"""
+    if response.status_code in (200, 201):
+        # Архивную или перенесенную карточку Trello обновляет с ответом 200
+        if trello_card_moved(card, response):
+            logger.info("Карточка %s в архиве или в другом списке, создается новая", card_id)
+            trello_cards.discard(card['list_id'], card['phone'])
+            return False
+        logger.info("Карточка %s в Trello обновлена (%s)", card_id, TRELLO_UPSERT)
+        return card_id
+    if response.status_code == 404:
+        # Карточка удалена: соответствие удаляется, заявка создает новую карточку
+        logger.info("Карточка %s не найдена в Trello, создается новая", card_id)
+        trello_cards.discard(card['list_id'], card['phone'])
+        return False
+    logger.error("Ошибка при обновлении карточки %s в Trello: %s - %s", card_id, response.status_code, response.text)
+    if response.status_code in TRELLO_REJECTED_STATUSES:
+        raise RejectedError(f"Trello вернул {response.status_code}: {response.text[:200]}")
+    return None
+
+def fetch_trello_list_cards(list_id):
+    """Открытые карточки списка Trello (id и описание) одним запросом"""
+    response = trello_http.get(f"{TRELLO_API_URL}/lists/{list_id}/cards",
+                               params={'key': TRELLO_API_KEY, 'token': TRELLO_API_TOKEN, 'fields': 'id,desc'},
+                               headers={'Accept': 'application/json'})
+    if response.status_code != 200:
+        raise RuntimeError(f"Trello вернул {response.status_code}: {response.text[:200]}")
+    return response.json()
+
+def create_trello_card(card):
+    """Создание карточки в Trello по записи журнала заявок (или обновление карточки номера при TRELLO_UPSERT),
+    возвращает ID карточки или None"""
+    try:
+        card_id = None
+        existing_id = existing_trello_card(card)
+        if existing_id:
+            # Повторная заявка с того же номера обновляет его карточку (TRELLO_UPSERT)
+            method, trello_api_url, query_params, headers = trello_update_request(card, existing_id)
+            logger.info("Отправка запроса в Trello API: %s", trello_api_url)
+            response = trello_http.request(method, trello_api_url, params=query_params, headers=headers)
+            card_id = trello_update_result(card, existing_id, response)
+        if existing_id is None or card_id is False:
+            trello_api_url, query_params, headers = trello_card_request(card)
+            logger.info("Отправка запроса в Trello API: %s", trello_api_url)
+            response = trello_http.post(trello_api_url, params=query_params, headers=headers)
+            card_id = trello_card_id(response)
+            if card_id:
+                remember_trello_card(card, card_id)
+        if card_id and card.get('media'):
+            attach_media(card_id, card['media'])
+        return card_id
+    except RejectedError:
+        raise
+    except CircuitOpenError as e:
+        logger.warning("Карточка не создана: %s", e)
     except Exception as e:
-        logger.error(f"Ошибка при отправке данных в Trello: {e}", exc_info=True)
-        
-        # Запасной вариант - логирование данных локально
-        logger.info(f"Локальное сохранение данных заявки: {card_name}")
-        logger.info(card_description)
-        
-        # Можно сохранить в локальный файл для дальнейшего импорта
+        logger.error("Ошибка при отправке данных в Trello: %s", e, exc_info=True)
+    return None
+
+def attach_media(card_id, media):
+    """Прикрепление файлов заявки к карточке Trello, файлы передаются частями с диска.
+
+    Ошибка прикрепления не отменяет создание карточки, возвращает количество прикрепленных файлов.
+    """
+    attached = 0
+    for item in media:
+        media_file = MediaFile.from_dict(item)
+        path = media_spool.path(media_file.sha256)
+        if not os.path.exists(path):
+            logger.error("Файл %s не найден в хранилище", media_file.filename)
+            continue
+        body = MultipartFile(path, {'name': media_file.filename, 'mimeType': media_file.mime_type or ''},
+                             'file', media_file.filename, media_file.mime_type, MEDIA_CHUNK_SIZE)
         try:
-            with open('saved_applications.txt', 'a', encoding='utf-8') as f:
-                f.write(f"\n\n--- НОВАЯ ЗАЯВКА: {card_name} ---\n")
-                f.write(card_description)
-                f.write("\n--- КОНЕЦ ЗАЯВКИ ---\n")
-            logger.info("Данные успешно сохранены в локальный файл")
-        except Exception as write_error:
-            logger.error(f"Ошибка при записи в файл: {write_error}")
-        
-        # Успешное завершение, даже если Trello недоступен
-        return {'result': True, 'local_save': True}
+            response = trello_http.post(
+                f"{TRELLO_API_URL}/cards/{card_id}/attachments",
+                params={'key': TRELLO_API_KEY, 'token': TRELLO_API_TOKEN},
+                data=body,
+                headers={'Accept': 'application/json', 'Content-Type': body.content_type}
+            )
+            if response.status_code in (200, 201):
+                attached += 1
+            else:
+                logger.error("Ошибка при прикреплении файла к карточке %s: %s - %s",
+                             card_id, response.status_code, response.text)
+        except CircuitOpenError as e:
+            logger.warning("Файл не прикреплен: %s", e)
+        except Exception as e:
+            logger.error("Ошибка при прикреплении файла к карточке %s: %s", card_id, e, exc_info=True)
+        finally:
+            body.close()
+    logger.info("К карточке %s прикреплено файлов: %d из %d", card_id, attached, len(media))
+    return attached
+
+# Соответствие номеров карточкам Trello для обновления карточек вместо создания дублей
+if TRELLO_UPSERT not in ('create', 'update', 'comment'):
+    raise ValueError(f"Неизвестный режим TRELLO_UPSERT: {TRELLO_UPSERT}")
+trello_cards = None
+if TRELLO_UPSERT != 'create':
+    trello_cards = TrelloCardIndex(TRELLO_CARD_INDEX_PATH, fetch_trello_list_cards,
+                                   cache_size=TRELLO_CARD_CACHE_SIZE, refresh_interval=TRELLO_CARD_INDEX_REFRESH)
+    # Индекс сверяется с карточками списков всех экземпляров waApi одним запросом на список
+    trello_cards.start(WAAPI_INSTANCES.values())
+    atexit.register(trello_cards.stop)
+
+# Журнал заявок с фоновой повторной отправкой в Trello
+trello_outbox = Outbox(
+    OUTBOX_PATH,
+    create_trello_card,
+    fsync_batch=OUTBOX_FSYNC_BATCH,
+    fsync_interval=OUTBOX_FSYNC_INTERVAL,
+    replay_interval=OUTBOX_REPLAY_INTERVAL,
+    replay_concurrency=OUTBOX_REPLAY_CONCURRENCY,
+    replay_delay=OUTBOX_REPLAY_DELAY,
+    replay_batch=OUTBOX_REPLAY_BATCH,
+    max_attempts=OUTBOX_MAX_ATTEMPTS
+)
+trello_outbox.start()
+atexit.register(trello_outbox.stop)
 
-def send_whatsapp_message(phone_number, message):
-    """Отправка сообщения через waApi WhatsApp"""
-    url = f"{WAAPI_URL}/instances/{WAAPI_INSTANCE_ID}/client/action/send-message"
+def waapi_message_request(phone_number, message, instance_id=None):
+    """URL, заголовки и тело запроса на отправку сообщения через экземпляр waApi (None - по умолчанию)"""
+    url = f"{WAAPI_URL}/instances/{instance_id or WAAPI_INSTANCE_ID}/client/action/send-message"
     
     # Удаляем '+' из номера телефона, если есть
     phone = phone_number.replace('+', '')
@@ -239,39 +657,541 @@ def send_whatsapp_message(phone_number, message):
         "previewLink": True
     }
     
+    return url, headers, payload
+
+def waapi_result(response):
+    """Разбор ответа waApi: данные ответа или None при ошибке"""
+    logger.debug("Ответ от waApi: %s", response.text)
+    
+    # Проверка на успешную отправку
+    if response.status_code == 200:
+        try:
+            response_data = response.json()
+            if response_data.get('status') == 'success':
+                logger.info("Сообщение успешно отправлено")
+            else:
+                logger.error("Ошибка при отправке сообщения: %s", response_data)
+            return response_data
+        except Exception as e:
+            logger.error("Ошибка при обработке ответа JSON: %s", e)
+            return None
+    
+    logger.error("Ошибка HTTP при отправке сообщения: %s - %s", response.status_code, response.text)
+    return None
+
+def waapi_message_id(response_data):
+    """ID отправленного сообщения из ответа waApi (data.data.id, data.id или id) или None"""
+    if not isinstance(response_data, dict):
+        return None
+    data = response_data.get('data')
+    for source in (data.get('data') if isinstance(data, dict) else None, data, response_data):
+        if isinstance(source, dict):
+            message_id = source.get('id') or source.get('messageId')
+            if isinstance(message_id, dict):
+                message_id = message_id.get('_serialized')
+            if isinstance(message_id, str) and message_id:
+                return message_id
+    return None
+
+# Отправленные сообщения, ожидающие подтверждения доставки (события waApi message_ack)
+delivery_tracker = DeliveryTracker(DELIVERY_TTL, DELIVERY_BUCKET_SECONDS, DELIVERY_MAX_PENDING, DELIVERY_ALERT_RATIO,
+                                   DELIVERY_ALERT_MIN)
+atexit.register(delivery_tracker.stop)
+
+def track_delivery(response_data, instance_id):
+    """Сообщение отправлено: его ID из ответа waApi ждет подтверждения доставки. Возвращает response_data"""
+    if response_data is not None and response_data.get('status', 'success') == 'success':
+        delivery_tracker.track(waapi_message_id(response_data), instance_id)
+    return response_data
+
+def acknowledge_deliveries(acks):
+    """Подтверждения доставки из webhook-запроса"""
+    for ack in acks:
+        delivery_tracker.acknowledge(ack.message_id, ack.status)
+    webhook_results.labels('ack').inc()
+
+# Темп отправки по экземплярам waApi
+waapi_limiter = InstanceRateLimiter(WAAPI_RATE_LIMIT, WAAPI_RATE_BURST)
+
+# HTTP-клиенты waApi по экземплярам: у каждого номера свой пул соединений и автомат защиты,
+# поэтому медленный или заблокированный номер не задерживает ответы остальных
+waapi_clients = {instance_id: waapi_http if instance_id == WAAPI_INSTANCE_ID else UpstreamClient('waapi')
+                 for instance_id in WAAPI_INSTANCES}
+
+def waapi_client(instance_id=None):
+    """HTTP-клиент экземпляра waApi (None - экземпляр по умолчанию)"""
+    return waapi_clients.get(instance_id or WAAPI_INSTANCE_ID, waapi_http)
+
+def message_instance(message):
+    """Экземпляр waApi, получивший сообщение, или None, если такой экземпляр не настроен"""
+    instance_id = message.instance or WAAPI_INSTANCE_ID
+    return instance_id if instance_id in WAAPI_INSTANCES else None
+
+def send_whatsapp_message(phone_number, message, instance_id=None, priority=PRIORITY_INTERACTIVE):
+    """Отправка сообщения через экземпляр waApi instance_id (None - по умолчанию).
+
+    priority - приоритет в очереди на отправку (см. rate_limit.py), у каждого экземпляра свой лимит частоты.
+    """
+    instance_id = instance_id or WAAPI_INSTANCE_ID
+    url, headers, payload = waapi_message_request(phone_number, message, instance_id)
+    
     try:
-        logger.info(f"Отправка сообщения через waApi: {payload}")
-        response = requests.post(url, headers=headers, json=payload)
-        logger.info(f"Ответ от waApi: {response.text}")
-        
-        # Проверка на успешную отправку
-        if response.status_code == 200:
-            try:
-                response_data = response.json()
-                if response_data.get('status') == 'success':
-                    logger.info("Сообщение успешно отправлено")
-                    return response_data
-                else:
-                    logger.error(f"Ошибка при отправке сообщения: {response_data}")
-            except Exception as e:
-                logger.error(f"Ошибка при обработке ответа JSON: {e}")
-        else:
-            logger.error(f"Ошибка HTTP при отправке сообщения: {response.status_code} - {response.text}")
-        
-        return response.json() if response.status_code == 200 else None
+        logger.info("Отправка сообщения через waApi (экземпляр %s) в чат %s", instance_id, payload['chatId'])
+        logger.debug("Тело запроса к waApi: %s", payload)
+        response = waapi_client(instance_id).post(url, headers=headers, json=payload,
+                                                  rate_limiter=waapi_limiter.bucket(instance_id), priority=priority)
+        return track_delivery(waapi_result(response), instance_id)
+    except CircuitOpenError as e:
+        logger.warning("Сообщение не отправлено: %s", e)
+        return None
     except Exception as e:
-        logger.error(f"Ошибка при отправке сообщения через waApi: {e}", exc_info=True)
+        logger.error("Ошибка при отправке сообщения через waApi: %s", e, exc_info=True)
         return None
 
+# Очередь исходящих сообщений: webhook только ставит ответ в очередь и сразу возвращает OK
+outbound_dispatcher = OutboundDispatcher(
+    tracing.traced('waapi_send', send_whatsapp_message),
+    queue_size=OUTBOUND_QUEUE_SIZE,
+    workers=OUTBOUND_WORKERS,
+    shutdown_timeout=OUTBOUND_SHUTDOWN_TIMEOUT
+)
+atexit.register(outbound_dispatcher.shutdown)
+
+# Метрики в формате Prometheus (/metrics)
+metrics_registry = Registry()
+
+# Метки состояний диалога и типов пользователя
+STATE_LABELS = {}
+for _prefix, _states in (('', STATES), ('dealership_', DEALERSHIP_STATES), ('client_', CLIENT_STATES)):
+    for _name, _value in _states.items():
+        STATE_LABELS.setdefault(_value, _prefix + _name.lower())
+USER_TYPE_LABELS = {value: name.lower() for name, value in USER_TYPES.items()}
+
+webhook_results = metrics_registry.register(
+    'bot_webhook_requests_total', 'counter', 'Webhook-запросы по результату обработки', Labeled(('result',)))
+webhook_latency = metrics_registry.register(
+    'bot_webhook_duration_seconds', 'histogram', 'Время обработки сообщения по состоянию диалога',
+    Labeled(('state',), Histogram))
+# Гистограммы по номеру состояния, чтобы не формировать метки при каждом запросе
+webhook_latency_by_state = {}
+applications_completed = metrics_registry.register(
+    'bot_applications_completed_total', 'counter', 'Завершенные заявки по типу пользователя', Labeled(('user_type',)))
+
+def record_webhook(state, started):
+    """Учет обработанного сообщения: время обработки по состоянию диалога до сообщения"""
+    histogram = webhook_latency_by_state.get(state)
+    if histogram is None:
+        histogram = webhook_latency_by_state[state] = webhook_latency.labels(STATE_LABELS.get(state, str(state)))
+    histogram.observe(time.perf_counter() - started)
+    webhook_results.labels('processed').inc()
+
+def register_upstream_metrics(client, mode, instance_id=None):
+    """Метрики HTTP-клиента внешнего сервиса (mode - sync или async, instance_id - экземпляр waApi)"""
+    labels = {'upstream': client.name, 'mode': mode}
+    if instance_id is not None:
+        labels['instance'] = instance_id
+    metrics_registry.register('bot_upstream_request_duration_seconds', 'histogram',
+                              'Длительность запросов к внешним сервисам', client.latency, labels)
+    metrics_registry.register('bot_upstream_responses_total', 'counter',
+                              'Ответы внешних сервисов по коду (error - ответ не получен)', client.responses, labels)
+    metrics_registry.register('bot_upstream_retries_total', 'counter', 'Повторы запросов', client.retries, labels)
+    metrics_registry.register('bot_upstream_circuit_open', 'gauge', 'Автомат защиты разомкнут (1) или нет (0)',
+                              lambda: int(client.breaker.state != 'closed'), labels)
+
+def register_outbound_metrics(dispatcher, mode):
+    """Метрики очереди исходящих сообщений (mode - sync или async)"""
+    metrics_registry.register('bot_outbound_send_duration_seconds', 'histogram',
+                              'Длительность отправки сообщения через waApi', dispatcher.latency, {'mode': mode})
+    for result in ('sent', 'failed', 'overflow', 'dropped'):
+        metrics_registry.register('bot_outbound_messages_total', 'counter', 'Исходящие сообщения по результату',
+                                  getattr(dispatcher, result), {'mode': mode, 'result': result})
+    metrics_registry.register('bot_outbound_queue_depth', 'gauge', 'Сообщений в очереди на отправку',
+                              dispatcher.depth, {'mode': mode})
+
+def register_rate_limit_metrics(limiter, mode):
+    """Метрики ограничения частоты отправки по экземплярам waApi (mode - sync или async)"""
+    # Ведра настроенных экземпляров создаются сразу, чтобы метрики были видны до первой отправки
+    for instance_id in WAAPI_INSTANCES:
+        limiter.bucket(instance_id)
+    for instance_id, bucket in limiter.items():
+        labels = {'instance': instance_id, 'mode': mode}
+        metrics_registry.register('bot_rate_limit_tokens', 'gauge', 'Доступные токены отправки', bucket.level, labels)
+        metrics_registry.register('bot_rate_limit_waiting', 'gauge', 'Сообщения, ожидающие токен, по приоритету',
+                                  lambda bucket=bucket: [({'priority': name}, count)
+                                                         for name, count in bucket.waiting().items()], labels)
+        metrics_registry.register('bot_rate_limit_wait_seconds', 'histogram', 'Ожидание токена по приоритету',
+                                  bucket.wait_time, labels)
+        metrics_registry.register('bot_rate_limit_throttled_total', 'counter',
+                                  'Паузы в отправке по ответу 429', bucket.throttled, labels)
+
+def register_admission_metrics(controller, mode):
+    """Метрики допуска webhook-запросов (mode - sync или async)"""
+    # Счетчики создаются сразу, чтобы отклонения были видны с нулевого значения
+    for priority in (PRIORITY_NAMES[PRIORITY_DIALOG], PRIORITY_NAMES[PRIORITY_NEW]):
+        for result in ADMISSION_RESULTS:
+            controller.requests.labels(priority, result)
+    controller.requests.labels(PRIORITY_ANY, 'admitted')
+    metrics_registry.register('bot_admission_requests_total', 'counter',
+                              'Webhook-запросы по приоритету и результату допуска (кроме admitted - отклонены)',
+                              controller.requests, {'mode': mode})
+    metrics_registry.register('bot_admission_limit', 'gauge', 'Лимит одновременно обрабатываемых webhook-запросов',
+                              lambda: int(controller.limit), {'mode': mode})
+    metrics_registry.register('bot_admission_in_flight', 'gauge', 'Обрабатываемые webhook-запросы',
+                              lambda: controller.in_flight, {'mode': mode})
+    metrics_registry.register('bot_admission_queued', 'gauge', 'Webhook-запросы в очереди на обработку по приоритету',
+                              lambda: [({'priority': name}, count) for name, count in controller.queued().items()],
+                              {'mode': mode})
+    metrics_registry.register('bot_admission_queue_wait_seconds', 'histogram', 'Ожидание места в очереди на обработку',
+                              controller.queue_wait, {'mode': mode})
+
+def register_delivery_metrics(tracker):
+    """Метрики подтверждений доставки (общие для app.py и asgi.py)"""
+    metrics_registry.register('bot_delivery_acks_total', 'counter', 'Подтверждения статуса исходящих сообщений',
+                              tracker.acks)
+    metrics_registry.register('bot_delivery_unmatched_acks_total', 'counter',
+                              'Подтверждения без ожидающего сообщения (повторные, после перезапуска, истекшие)',
+                              tracker.unmatched)
+    metrics_registry.register('bot_delivery_results_total', 'counter',
+                              'Исходящие сообщения по экземпляру waApi и итогу ожидания подтверждения доставки',
+                              tracker.results)
+    metrics_registry.register('bot_reply_delivery_seconds', 'histogram',
+                              'Время от получения webhook-запроса до доставки ответа на него', tracker.reply_latency)
+    metrics_registry.register('bot_message_delivery_seconds', 'histogram',
+                              'Время от отправки сообщения до подтверждения доставки', tracker.delivery_latency)
+    metrics_registry.register('bot_delivery_pending', 'gauge', 'Сообщения, ожидающие подтверждения доставки',
+                              tracker.pending)
+    metrics_registry.register('bot_delivery_untracked_total', 'counter',
+                              'Сообщения, не поставленные в ожидание подтверждения из-за DELIVERY_MAX_PENDING',
+                              tracker.untracked)
+    metrics_registry.register('bot_delivery_alerts_total', 'counter',
+                              'Предупреждения о доле недоставленных сообщений экземпляра waApi', tracker.alerts)
+
+def active_sessions():
+    return [({'state': STATE_LABELS.get(state, str(state))}, count)
+            for state, count in sorted(session_store.count_by_state().items())]
+
+for _instance_id, _client in waapi_clients.items():
+    register_upstream_metrics(_client, 'sync', _instance_id)
+register_upstream_metrics(trello_http, 'sync')
+register_upstream_metrics(media_http, 'sync')
+register_outbound_metrics(outbound_dispatcher, 'sync')
+register_rate_limit_metrics(waapi_limiter, 'sync')
+register_admission_metrics(admission, 'sync')
+register_delivery_metrics(delivery_tracker)
+metrics_registry.register('bot_sessions_active', 'gauge', 'Сессии по состоянию диалога', active_sessions)
+if session_snapshot is not None:
+    for _file in ('base', 'journal'):
+        metrics_registry.register('bot_session_snapshot_bytes', 'gauge', 'Размер снимка сессий и его журнала',
+                                  lambda file=_file: session_snapshot.stats()[f'{file}_bytes'], {'file': _file})
+    metrics_registry.register('bot_session_snapshot_errors_total', 'counter',
+                              'Ошибки записи и загрузки снимка сессий', session_snapshot.errors)
+metrics_registry.register('bot_dedup_duplicates_total', 'counter', 'Пропущенные повторные доставки', dedup_cache.hits)
+metrics_registry.register('bot_outbox_cards_total', 'counter', 'Заявки, записанные в журнал', trello_outbox.appended)
+metrics_registry.register('bot_outbox_delivered_total', 'counter', 'Заявки, отправленные в Trello',
+                          trello_outbox.delivered)
+metrics_registry.register('bot_outbox_dead_lettered_total', 'counter',
+                          'Заявки, отклоненные Trello и перенесенные в журнал отклоненных', trello_outbox.dead_lettered)
+for _kind in MATCH_KINDS:
+    metrics_registry.register('bot_answer_matches_total', 'counter',
+                              'Ответы на вопросы с вариантами по способу совпадения (miss - ответ не распознан)',
+                              answer_matches[_kind], {'kind': _kind})
+metrics_registry.register('bot_slow_requests_total', 'counter',
+                          'Webhook-запросы дольше TRACE_SLOW_MS вместе с отправкой ответа и карточки', tracer.slow)
+if trello_cards is not None:
+    for _result in ('hits', 'misses'):
+        metrics_registry.register('bot_trello_card_index_lookups_total', 'counter',
+                                  'Поиск карточки номера в индексе (hits - карточка обновляется, misses - создается)',
+                                  getattr(trello_cards, _result), {'result': _result})
+
+# Массовые рассылки
+STATES_BY_LABEL = {label: state for state, label in STATE_LABELS.items()}
+
+def broadcast_recipients(source):
+    """Получатели рассылки: phones (список номеров), file (файл с номерами) или states (состояния диалога
+    с экземпляром waApi рассылки source['instance']).
+
+    Источник проверяется сразу, а получатели читаются по мере обхода возвращаемого итератора.
+    """
+    if source.get('phones'):
+        if not isinstance(source['phones'], list):
+            raise BroadcastError("phones - список номеров")
+        phones = [normalize_phone(phone) for phone in source['phones']]
+        if None in phones:
+            raise BroadcastError("Список получателей содержит некорректные номера")
+        return ((phone, None) for phone in phones)
+    if source.get('file'):
+        if not os.path.isfile(source['file']):
+            raise BroadcastError(f"Файл получателей не найден: {source['file']}")
+        return read_recipient_file(source['file'])
+    if source.get('states'):
+        states = []
+        for state in source['states']:
+            state = STATES_BY_LABEL.get(str(state).lower(), state)
+            if state not in STATE_LABELS:
+                raise BroadcastError(f"Неизвестное состояние диалога: {state}")
+            states.append(state)
+        instance_id = source.get('instance') or WAAPI_INSTANCE_ID
+        def recipients():
+            for key, session in session_store.iter_by_state(states):
+                session_instance, phone = split_session_key(key)
+                if session_instance == instance_id:
+                    yield phone, session.language
+        return recipients()
+    raise BroadcastError("Укажите получателей: phones, file или states")
+
+def broadcast_message(template, phone_number, language=None, instance_id=None):
+    """Текст рассылки на языке получателя (из файла получателей или из сессии с экземпляром рассылки)"""
+    if language is None:
+        session = session_store.load(session_key(phone_number, instance_id))
+        language = session.language if session is not None else LANGUAGES['RU']
+    messages = MESSAGES.get(language, MESSAGES['ru'])
+    return messages.get(template, MESSAGES['ru'][template])
+
+def send_bulk_message(phone_number, message, instance_id=None):
+    """Отправка сообщения рассылки: ответы в диалогах отправляются раньше"""
+    return send_whatsapp_message(phone_number, message, instance_id, priority=PRIORITY_BULK)
+
+broadcasts = BroadcastManager(BROADCAST_DIR, broadcast_recipients, broadcast_message, send_bulk_message,
+                              concurrency=BROADCAST_CONCURRENCY)
+atexit.register(broadcasts.shutdown)
+metrics_registry.register('bot_broadcast_messages_total', 'counter', 'Сообщения рассылок по результату',
+                          broadcasts.results, {'mode': 'sync'})
+
+def is_authorized(authorization, token):
+    """Проверка заголовка Authorization: Bearer <token>; при пустом token доступ запрещен"""
+    return bool(token) and hmac.compare_digest(authorization.encode('utf-8'), f'Bearer {token}'.encode('utf-8'))
+
+def create_broadcast(params, manager=None):
+    """Рассылка по параметрам: template и phones, file или states, instance - экземпляр waApi рассылки;
+    resume - продолжение рассылки"""
+    manager = manager or broadcasts
+    if params.get('resume'):
+        return manager.load(params['resume'])
+    template = params.get('template')
+    if template not in MESSAGES['ru']:
+        raise BroadcastError(f"Неизвестный шаблон сообщения: {template}")
+    if params.get('instance') and str(params['instance']) not in WAAPI_INSTANCES:
+        raise BroadcastError(f"Неизвестный экземпляр waApi: {params['instance']}")
+    source = {key: params[key] for key in ('phones', 'file', 'states') if params.get(key)}
+    if params.get('instance'):
+        source['instance'] = str(params['instance'])
+    concurrency = params.get('concurrency')
+    if concurrency is not None and (not isinstance(concurrency, int) or concurrency < 1):
+        raise BroadcastError("concurrency - положительное целое число")
+    return manager.create(template, source, params.get('campaign'), concurrency)
+
+def broadcast_file(name, directory):
+    """Путь к файлу получателей из HTTP-запроса: через HTTP доступны только файлы каталога рассылок"""
+    directory = os.path.realpath(directory)
+    path = os.path.realpath(os.path.join(directory, str(name)))
+    if path == directory or os.path.commonpath([directory, path]) != directory:
+        raise BroadcastError(f"Файл получателей должен находиться в каталоге {directory}")
+    return path
+
+def handle_broadcast(method, authorization, params, manager=None):
+    """Обработка запроса /broadcast, общая для app.py и asgi.py: код ответа и тело.
+
+    POST запускает рассылку (или продолжает при resume, или отменяет при cancel), GET возвращает
+    показатели всех рассылок процесса или одной (campaign).
+    """
+    manager = manager or broadcasts
+    if not is_authorized(authorization, BROADCAST_TOKEN):
+        return 403, {'error': 'Доступ к рассылкам запрещен'}
+    if not isinstance(params, dict):
+        return 400, {'error': 'Ожидается объект JSON'}
+    try:
+        if method == 'GET':
+            if params.get('campaign'):
+                result = manager.get(params['campaign'])
+                return (200, result) if result is not None else (404, {'error': 'Рассылка не найдена'})
+            return 200, manager.stats()
+        if params.get('cancel'):
+            broadcast = manager.cancel(params['cancel'])
+        else:
+            if params.get('file'):
+                params = dict(params, file=broadcast_file(params['file'], manager.directory))
+            broadcast = manager.start(create_broadcast(params, manager))
+    except BroadcastError as e:
+        return 400, {'error': str(e)}
+    return 202, manager.get(broadcast.id)
+
+def handle_profile(method, authorization, params):
+    """Обработка запроса /debug/profile, общая для app.py и asgi.py: код ответа и тело.
+
+    POST начинает сбор профиля следующих requests webhook-запросов (mode - cprofile или sample,
+    interval_ms - интервал выборки стеков), GET возвращает ход сбора и накопленный профиль (limit строк).
+    """
+    if not is_authorized(authorization, ADMIN_TOKEN):
+        return 403, {'error': 'Доступ запрещен'}
+    if not isinstance(params, dict):
+        return 400, {'error': 'Ожидается объект JSON'}
+    try:
+        limit = int(params.get('limit', 50))
+        if method == 'POST':
+            profiler.start(params.get('mode', 'sample'), int(params.get('requests', 100)),
+                           float(params.get('interval_ms', 5)) / 1000.0)
+            return 202, profiler.report(limit)
+    except (TypeError, ValueError) as e:
+        return 400, {'error': f"Некорректные параметры профилирования: {e}"}
+    return 200, profiler.report(limit)
+
+def slow_requests(authorization, params):
+    """Последние медленные webhook-запросы с разбивкой по этапам (/debug/slow): код ответа и тело"""
+    if not is_authorized(authorization, ADMIN_TOKEN):
+        return 403, {'error': 'Доступ запрещен'}
+    try:
+        limit = int(params.get('limit', 20))
+    except ValueError:
+        return 400, {'error': f"Некорректное значение limit: {params.get('limit')}"}
+    return 200, {'tracing': tracer.stats(), 'requests': tracer.slow_requests(limit)}
+
+# Поиск и выгрузка заявок: столбцы выгрузки - поля диалога в порядке DIALOG_FLOW
+APPLICATION_FIELDS = list(dict.fromkeys(spec['field'] for spec in DIALOG_FLOW.values() if spec.get('field')))
+EXPORT_FORMATS = {'csv': 'text/csv; charset=utf-8', 'jsonl': 'application/x-ndjson; charset=utf-8'}
+
+def query_applications(params):
+    """Страница заявок по параметрам /applications (фильтры, limit, cursor): код ответа и тело"""
+    try:
+        limit = int(params.get('limit', 100))
+    except ValueError:
+        limit = 0
+    if not 1 <= limit <= 1000:
+        return 400, {'error': 'limit - целое число от 1 до 1000'}
+    try:
+        items, next_cursor = application_store.query(parse_filters(params), limit, params.get('cursor'))
+    except QueryError as e:
+        return 400, {'error': str(e)}
+    return 200, {'items': items, 'next_cursor': next_cursor}
+
+def export_applications(params):
+    """Тип содержимого, имя файла и итератор частей выгрузки заявок (QueryError при ошибке в параметрах)"""
+    export_format = params.get('format', 'csv')
+    if export_format not in EXPORT_FORMATS:
+        raise QueryError(f"Неизвестный формат выгрузки: {export_format}")
+    records = application_store.iter_records(parse_filters(params))
+    chunks = export_csv(records, APPLICATION_FIELDS) if export_format == 'csv' else export_jsonl(records)
+    return EXPORT_FORMATS[export_format], f'applications.{export_format}', chunks
+
+def apply_message(sender_phone, incoming_msg):
+    """Применение входящего сообщения к диалогу без обращений к внешним сервисам.
+
+    Возвращает текст ответа и карточку Trello, записанную в журнал, если заявка завершена.
+    """
+    with tracing.span('dialog'):
+        session = _get_session(sender_phone)
+        step = dialog_engine.handle(session, incoming_msg)
+        
+        # Если заявка уже завершена, не отвечаем на сообщения клиента
+        if step is None:
+            logger.info("Игнорирование сообщения от %s в состоянии %s", sender_phone, session.state)
+            return "", None
+        _commit_session(sender_phone, session)
+    
+    card = None
+    if step.submit:
+        # Запись заявки в журнал и хранилище заявок
+        with tracing.span('card'):
+            card = prepare_trello_card(sender_phone)
+        applications_completed.labels(USER_TYPE_LABELS.get(session.user_type, str(session.user_type))).inc()
+    return dialog_engine.reply(step, session.language), card
+
+def handle_message(sender_phone, incoming_msg):
+    """Обработка входящего сообщения по текущему состоянию диалога, возвращает текст ответа"""
+    response_message, card = apply_message(sender_phone, incoming_msg)
+    
+    # Отправка данных в Trello
+    if card is not None:
+        deliver_trello_card(card)
+    
+    return response_message
+
+def sender_batches(messages):
+    """Сообщения webhook-запроса по отправителям: номер, экземпляр waApi и сообщения в порядке поступления.
+
+    Пустые сообщения, повторные доставки и сообщения для ненастроенных экземпляров отбрасываются
+    с учетом в bot_webhook_requests_total.
+    """
+    batches = []
+    for (_, sender_phone), group in group_by_sender(messages).items():
+        # Ответ отправляется через тот же экземпляр waApi (номер WhatsApp), который получил сообщения группы
+        instance_id = message_instance(group[0])
+        batch = []
+        for message in group:
+            # Если нет данных в сообщении, оно пропускается
+            if (not message.text and message.media is None) or not sender_phone:
+                logger.warning("Не найдены необходимые параметры в запросе")
+                webhook_results.labels('empty').inc()
+                continue
+            if instance_id is None:
+                logger.warning("Сообщение для ненастроенного экземпляра waApi %s пропущено", message.instance)
+                webhook_results.labels('rejected').inc()
+                continue
+            logger.info("Сообщение от %s (%d символов, экземпляр %s)", sender_phone, len(message.text), instance_id)
+            logger.debug("Текст сообщения от %s: '%s'", sender_phone, message.text)
+            # Повторная доставка того же сообщения (waApi повторяет webhook при медленном ответе)
+            if dedup_cache.seen(message_key(message)):
+                logger.info("Повторная доставка сообщения %s от %s пропущена", message.message_id, sender_phone)
+                webhook_results.labels('duplicate').inc()
+                continue
+            batch.append(message)
+        if batch:
+            batches.append((sender_phone, instance_id, batch))
+    return batches
+
+def forget_batches(batches):
+    """Снятие отметок дедупликации с сообщений необработанных пачек, чтобы повторная доставка не была отброшена"""
+    dedup_cache.forget(message_key(message) for _, _, batch in batches for message in batch)
+
+def admission_priority(messages):
+    """Приоритет допуска webhook-запроса: выше, если хоть один отправитель уже отвечает на вопросы диалога"""
+    checked = set()
+    for message in messages:
+        instance_id = message_instance(message)
+        if not message.phone or instance_id is None:
+            continue
+        key = session_key(message.phone, instance_id)
+        if key in checked:
+            continue
+        checked.add(key)
+        session = session_store.load(key)
+        if session is not None and session.state != STATES['INITIAL']:
+            return PRIORITY_DIALOG
+    return PRIORITY_NEW
+
+# Ответ на отклоненный при перегрузке запрос: waApi повторит доставку, повторная доставка не отбрасывается,
+# потому что сообщения отклоненного запроса не отмечаются как обработанные
+OVERLOADED_HEADERS = {'Retry-After': str(ADMISSION_RETRY_AFTER)}
+
+# Разделитель ответов, объединенных в одно сообщение
+REPLY_SEPARATOR = '\n\n'
+
+def coalesce_replies(replies, max_chars=REPLY_COALESCE_MAX_CHARS):
+    """Ответы одному чату, объединенные в сообщения не длиннее max_chars (длинный ответ не делится)"""
+    merged = []
+    for reply in replies:
+        if merged and len(merged[-1]) + len(REPLY_SEPARATOR) + len(reply) <= max_chars:
+            merged[-1] += REPLY_SEPARATOR + reply
+        else:
+            merged.append(reply)
+    return merged
+
 @app.route('/webhook', methods=['POST', 'GET'])
 def webhook():
     """Основной обработчик сообщений WhatsApp"""
+    started = time.perf_counter()
+    # Ответы на запрос учитываются во времени от получения до доставки
+    mark_inbound()
     # Логирование входящего запроса
-    logger.info(f"Получен webhook запрос: {request.method}")
+    logger.info("Получен webhook запрос: %s", request.method)
     
-    # Проверка на пустой запрос
+    # Проверка на пустой или слишком большой запрос
+    if request.content_length is not None and request.content_length > WEBHOOK_MAX_BYTES:
+        logger.warning("Получен слишком большой запрос: %s байт", request.content_length)
+        webhook_results.labels('rejected').inc()
+        return "OK", 200
     if request.content_length == 0:
         logger.warning("Получен пустой запрос")
+        webhook_results.labels('empty').inc()
         return "OK", 200  # Возвращаем OK для пустых запросов
     
     # Получение данных из входящего сообщения
@@ -279,217 +1199,87 @@ def webhook():
         logger.info("Получен GET запрос на webhook")
         return "Webhook is active", 200
     
-    # Логирование данных формы и JSON
-    if request.is_json:
-        logger.info(f"JSON данные: {request.json}")
-        data = request.json
-    else:
-        logger.info(f"Данные формы: {request.form}")
-        data = request.form.to_dict()
-    
-    # Получение данных из сообщения waApi
+    # Получение данных из сообщения waApi (в старом формате - всех сообщений пачки)
     try:
-        # Формат данных waApi.app для webhook
-        if request.is_json:
-            # Проверяем формат, который получен в текущем webhook
-            if 'event' in data and data.get('event') == 'message' and 'data' in data:
-                message_data = data.get('data', {}).get('message', {})
-                
-                # Извлекаем тело сообщения
-                incoming_msg = message_data.get('body', '').strip()
-                
-                # Извлекаем номер отправителя, обычно в формате XXXXXXXXXXX@c.us
-                sender_phone = message_data.get('from', '').split('@')[0] if '@' in message_data.get('from', '') else message_data.get('from', '')
-                
-                logger.info(f"Извлечены данные из webhook: сообщение='{incoming_msg}', отправитель={sender_phone}")
-            elif 'messages' in data:
-                # Старый формат для входящих сообщений
-                message = data['messages'][0]
-                if 'text' in message:
-                    incoming_msg = message['text'].get('body', '').strip()
-                elif 'caption' in message:
-                    incoming_msg = message.get('caption', '').strip()
-                else:
-                    incoming_msg = message.get('body', '').strip()
-                
-                sender_phone = message.get('from', '').split('@')[0] if '@' in message.get('from', '') else message.get('from', '')
+        with tracing.span('parse'):
+            if request.is_json:
+                # Тело читается с ограничением размера и разбирается без request.json
+                data = parse_json(request.get_data(cache=False), WEBHOOK_MAX_BYTES)
+                if should_log_payload():
+                    logger.info("JSON данные: %s", data)
+                messages = extract_messages(data, WEBHOOK_MAX_DEPTH, WEBHOOK_MAX_NODES)
+                acks = extract_acks(data)
             else:
-                # Для любых других форматов пытаемся извлечь нужные данные
-                incoming_msg = ''
-                sender_phone = ''
-                
-                # Рекурсивный поиск полей body и from в структуре JSON
-                def extract_fields(obj, path=''):
-                    nonlocal incoming_msg, sender_phone
-                    if isinstance(obj, dict):
-                        for key, value in obj.items():
-                            if key == 'body' and isinstance(value, str) and not incoming_msg:
-                                incoming_msg = value.strip()
-                            elif key == 'from' and isinstance(value, str) and '@' in value and not sender_phone:
-                                sender_phone = value.split('@')[0]
-                            elif isinstance(value, (dict, list)):
-                                extract_fields(value, path + '.' + key if path else key)
-                    elif isinstance(obj, list):
-                        for i, item in enumerate(obj):
-                            extract_fields(item, f"{path}[{i}]")
-                
-                extract_fields(data)
-                
-                logger.info(f"Извлечены данные из альтернативного формата: сообщение='{incoming_msg}', отправитель={sender_phone}")
-        else:
-            # Для тестирования или альтернативных форматов
-            incoming_msg = data.get('body', data.get('Body', '')).strip()
-            sender_phone = data.get('from', data.get('From', '')).replace('whatsapp:', '')
-            if '@' in sender_phone:
-                sender_phone = sender_phone.split('@')[0]
+                # Для тестирования или альтернативных форматов
+                if should_log_payload():
+                    logger.info("Данные формы: %s", request.form.to_dict())
+                messages = [extract_form(request.form.to_dict())]
+                acks = []
+    except PayloadError as e:
+        logger.warning("Отклонен webhook запрос: %s", e)
+        webhook_results.labels('rejected').inc()
+        return "OK", 200
     except Exception as e:
-        logger.error(f"Ошибка при извлечении данных из входящего запроса: {e}", exc_info=True)
+        logger.error("Ошибка при извлечении данных из входящего запроса: %s", e, exc_info=True)
+        webhook_results.labels('error').inc()
         return "OK", 200
     
-    # Если нет данных в запросе, отправляем простой ответ
-    if not incoming_msg or not sender_phone:
-        logger.warning("Не найдены необходимые параметры в запросе")
+    # Подтверждения доставки учитываются без очереди допуска: это несколько обращений к словарю
+    if acks:
+        acknowledge_deliveries(acks)
+    if not messages:
         return "OK", 200
     
-    logger.info(f"Сообщение: '{incoming_msg}' от {sender_phone}")
-    
-    # Получение текущего состояния пользователя
-    current_state = get_user_state(sender_phone)
-    
-    # Если заявка уже завершена, не отвечаем на сообщения клиента
-    if (current_state == STATES['COMPLETED'] and 
-        incoming_msg.lower() not in ['новая заявка', 'жаңа өтінім', '9']):
-        logger.info(f"Игнорирование сообщения от {sender_phone}, т.к. заявка уже завершена")
-        return "OK", 200
-    
-    # Подготовка ответа в зависимости от состояния
-    response_message = ""
-    
-    # Обработка состояний и сообщений
-    if current_state == STATES['INITIAL']:
-        # Запрос языка при первом входе
-        response_message = MESSAGES['ru']['choose_language']  # На обоих языках
-        update_user_state(sender_phone, STATES['WAITING_FOR_LANGUAGE'])
-    
-    elif current_state == STATES['WAITING_FOR_LANGUAGE']:
-        # Обработка выбора языка (текст или цифры)
-        if incoming_msg.lower() in ['рус', 'русский', 'ru', 'rus', '1', '1️⃣']:
-            set_user_language(sender_phone, LANGUAGES['RU'])
-            response_message = get_message(sender_phone, 'select_user_type')
-            update_user_state(sender_phone, STATES['WAITING_FOR_USER_TYPE'])
-        elif incoming_msg.lower() in ['каз', 'қаз', 'казахский', 'қазақша', 'kaz', '2', '2️⃣']:
-            set_user_language(sender_phone, LANGUAGES['KZ'])
-            response_message = get_message(sender_phone, 'select_user_type')
-            update_user_state(sender_phone, STATES['WAITING_FOR_USER_TYPE'])
-        else:
-            # Если язык не распознан, просим выбрать снова
-            response_message = MESSAGES['ru']['invalid_language']
-    
-    elif current_state == STATES['WAITING_FOR_USER_TYPE']:
-        # Обработка выбора типа пользователя (текст или цифры)
-        if incoming_msg.lower() in ['автосалон', 'автосалон', '1', '1️⃣']:
-            set_user_type(sender_phone, USER_TYPES['DEALERSHIP'])
-            response_message = get_message(sender_phone, 'dealership_name')
-            update_user_state(sender_phone, DEALERSHIP_STATES['WAITING_FOR_NAME'])
-        elif incoming_msg.lower() in ['клиент', 'клиент', '2', '2️⃣']:
-            set_user_type(sender_phone, USER_TYPES['CLIENT'])
-            response_message = get_message(sender_phone, 'client_car_number')
-            update_user_state(sender_phone, CLIENT_STATES['WAITING_FOR_CAR_NUMBER'])
-        else:
-            response_message = get_message(sender_phone, 'invalid_user_type')
-    
-    elif current_state == DEALERSHIP_STATES['WAITING_FOR_NAME']:
-        save_user_data(sender_phone, 'name', incoming_msg)
-        response_message = get_message(sender_phone, 'dealership_address')
-        update_user_state(sender_phone, DEALERSHIP_STATES['WAITING_FOR_ADDRESS'])
-    
-    elif current_state == DEALERSHIP_STATES['WAITING_FOR_ADDRESS']:
-        save_user_data(sender_phone, 'address', incoming_msg)
-        response_message = get_message(sender_phone, 'dealership_cooperation')
-        update_user_state(sender_phone, DEALERSHIP_STATES['WAITING_FOR_COOPERATION'])
-    
-    elif current_state == DEALERSHIP_STATES['WAITING_FOR_COOPERATION']:
-        # Обработка ответа о сотрудничестве (текст или цифры)
-        cooperation_response = incoming_msg.lower()
-        if cooperation_response in ['да', 'yes', 'иә', 'иа', '1', '1️⃣']:
-            save_user_data(sender_phone, 'already_cooperates', 'Да')
-        else:
-            save_user_data(sender_phone, 'already_cooperates', 'Нет')
-        
-        # Запрашиваем сначала удостоверение
-        response_message = get_message(sender_phone, 'dealership_id')
-        update_user_state(sender_phone, DEALERSHIP_STATES['WAITING_FOR_ID'])
-    
-    elif current_state == DEALERSHIP_STATES['WAITING_FOR_ID']:
-        # Сохранение информации об удостоверении
-        save_user_data(sender_phone, 'id_document', incoming_msg)
-        
-        # Запрашиваем техпаспорт
-        response_message = get_message(sender_phone, 'dealership_techpassport')
-        update_user_state(sender_phone, DEALERSHIP_STATES['WAITING_FOR_TECHPASSPORT'])
-    
-    elif current_state == DEALERSHIP_STATES['WAITING_FOR_TECHPASSPORT']:
-        # Сохранение информации о техпаспорте
-        save_user_data(sender_phone, 'tech_passport', incoming_msg)
-        
-        # Формирование сообщения о завершении
-        response_message = get_message(sender_phone, 'request_complete') + "\n\n" + get_message(sender_phone, 'new_request')
-        update_user_state(sender_phone, STATES['COMPLETED'])
-        
-        # Отправка данных в Trello
-        send_to_trello(sender_phone)
-    
-    elif current_state == CLIENT_STATES['WAITING_FOR_CAR_NUMBER']:
-        save_user_data(sender_phone, 'car_number', incoming_msg)
-        response_message = get_message(sender_phone, 'client_city')
-        update_user_state(sender_phone, CLIENT_STATES['WAITING_FOR_CITY'])
-    
-    elif current_state == CLIENT_STATES['WAITING_FOR_CITY']:
-        save_user_data(sender_phone, 'city', incoming_msg)
-        response_message = get_message(sender_phone, 'client_mileage')
-        update_user_state(sender_phone, CLIENT_STATES['WAITING_FOR_MILEAGE'])
-    
-    elif current_state == CLIENT_STATES['WAITING_FOR_MILEAGE']:
-        save_user_data(sender_phone, 'mileage', incoming_msg)
-        
-        # Запрашиваем сначала удостоверение
-        response_message = get_message(sender_phone, 'client_id')
-        update_user_state(sender_phone, CLIENT_STATES['WAITING_FOR_ID'])
-    
-    elif current_state == CLIENT_STATES['WAITING_FOR_ID']:
-        # Сохранение информации об удостоверении
-        save_user_data(sender_phone, 'id_document', incoming_msg)
-        
-        # Запрашиваем техпаспорт
-        response_message = get_message(sender_phone, 'client_techpassport')
-        update_user_state(sender_phone, CLIENT_STATES['WAITING_FOR_TECHPASSPORT'])
-    
-    elif current_state == CLIENT_STATES['WAITING_FOR_TECHPASSPORT']:
-        # Сохранение информации о техпаспорте
-        save_user_data(sender_phone, 'tech_passport', incoming_msg)
-        
-        # Формирование сообщения о завершении
-        response_message = get_message(sender_phone, 'request_complete') + "\n\n" + get_message(sender_phone, 'new_request')
-        update_user_state(sender_phone, STATES['COMPLETED'])
-        
-        # Отправка данных в Trello
-        send_to_trello(sender_phone)
-    
-    elif current_state == STATES['COMPLETED']:
-        # Обработка запроса на новую заявку (текст или цифра 9)
-        if incoming_msg.lower() in ['новая заявка', 'жаңа өтінім', '9', '9️⃣']:
-            # Сброс данных для новой заявки, но сохранение выбранного ранее языка
-            prev_language = get_user_language(sender_phone)
-            user_data[sender_phone] = {}
-            set_user_language(sender_phone, prev_language)
+    # При перегрузке запрос отклоняется до отметки сообщений как обработанных
+    with admission.admit(lambda: admission_priority(messages)) as admitted:
+        if not admitted:
+            return "Service Unavailable", 503, OVERLOADED_HEADERS
+        # Сообщения отмечены как обработанные еще при разборе, чтобы параллельный повтор webhook был отброшен.
+        # Если пачка отправителя не обработана до конца, отметки с нее и со следующих пачек снимаются:
+        # запрос завершится ошибкой, и waApi доставит эти сообщения повторно
+        batches = sender_batches(messages)
+        processed = 0
+        try:
+            for sender_phone, instance_id, batch in batches:
+                prefetched = prefetch_media(sender_phone, instance_id, batch)
+                # Сообщения одного отправителя одному номеру бота обрабатываются по очереди, остальные - параллельно
+                cards = []
+                with sender_locks.hold(session_key(sender_phone, instance_id)):
+                    replies = []
+                    # Обработка сообщений отправителя: одно чтение и одна запись сессии на всю пачку
+                    with session_scope(sender_phone, instance_id) as session:
+                        for message in batch:
+                            state = session.state
+                            incoming_msg = message.text
+                            # Фото документа загружается в хранилище, в диалог передается подпись или отметка о файле
+                            if message.media is not None:
+                                with tracing.span('media'):
+                                    incoming_msg = receive_media(session, message, prefetched)
+                            response_message, card = "", None
+                            if incoming_msg:
+                                response_message, card = apply_message(sender_phone, incoming_msg)
+                            if response_message:
+                                replies.append(response_message)
+                            if card is not None:
+                                cards.append(card)
+                            # Время разбора запроса учитывается в первом сообщении, остальные - со своего начала
+                            record_webhook(state, started)
+                            started = time.perf_counter()
+                
+                    # Постановка ответов в очередь на отправку через waApi: ответы на пачку - одним сообщением
+                    for response_message in coalesce_replies(replies):
+                        # Запрос считается завершенным после отправки ответа из очереди
+                        trace = tracing.hold()
+                        if not outbound_dispatcher.submit(sender_phone, response_message, instance_id):
+                            tracing.release(trace)
+                processed += 1
             
-            # Запрос на выбор типа пользователя
-            response_message = get_message(sender_phone, 'select_user_type')
-            update_user_state(sender_phone, STATES['WAITING_FOR_USER_TYPE'])
-    
-    # Отправка ответного сообщения через waApi
-    if response_message:
-        send_whatsapp_message(sender_phone, response_message)
+                # Заявка уже записана в журнал: отправка в Trello не задерживает следующие сообщения отправителя
+                for card in cards:
+                    deliver_trello_card(card)
+        except BaseException:
+            forget_batches(batches[processed:])
+            raise
     
     return "OK", 200
 
@@ -498,10 +1288,78 @@ def favicon():
     """Обработчик для запросов фавиконки"""
     return "", 204  # Возвращаем пустой ответ со статусом 204 No Content
 
+@app.route('/stats')
+def stats():
+    """Показатели очереди исходящих сообщений, журнала заявок, сессий и их снимка, дедупликации, блокировок,
+    допуска запросов, подтверждений доставки, файлов, ограничения частоты отправки, трассировки, HTTP-клиентов и экземпляров waApi"""
+    return jsonify(
+        outbound=outbound_dispatcher.stats(),
+        outbox=trello_outbox.stats(),
+        sessions=session_store.stats(),
+        session_snapshot=session_snapshot.stats() if session_snapshot is not None else None,
+        dedup=dedup_cache.stats(),
+        sender_locks=sender_locks.stats(),
+        admission=admission.stats(),
+        delivery=delivery_tracker.stats(),
+        media=media_spool.stats(),
+        rate_limit=waapi_limiter.stats(),
+        applications=application_store.stats(),
+        tracing=tracer.stats(),
+        trello_cards=trello_cards.stats() if trello_cards is not None else None,
+        upstreams={'waapi': waapi_http.stats(), 'trello': trello_http.stats(), 'media': media_http.stats()},
+        instances={instance_id: {'trello_list_id': WAAPI_INSTANCES[instance_id], 'waapi': client.stats()}
+                   for instance_id, client in waapi_clients.items()}
+    )
+
+@app.route('/broadcast', methods=['GET', 'POST'])
+def broadcast():
+    """Массовые рассылки (нужен заголовок Authorization: Bearer <BROADCAST_TOKEN>)"""
+    params = request.args.to_dict() if request.method == 'GET' else request.get_json(silent=True) or {}
+    status, body = handle_broadcast(request.method, request.headers.get('Authorization', ''), params)
+    return jsonify(body), status
+
+@app.route('/applications')
+def applications():
+    """Поиск заявок (нужен заголовок Authorization: Bearer <ADMIN_TOKEN>)"""
+    if not is_authorized(request.headers.get('Authorization', ''), ADMIN_TOKEN):
+        return jsonify(error='Доступ запрещен'), 403
+    status, body = query_applications(request.args.to_dict())
+    return jsonify(body), status
+
+@app.route('/applications/export')
+def applications_export():
+    """Потоковая выгрузка заявок в CSV или JSON Lines (format=csv|jsonl) с теми же фильтрами"""
+    if not is_authorized(request.headers.get('Authorization', ''), ADMIN_TOKEN):
+        return jsonify(error='Доступ запрещен'), 403
+    try:
+        content_type, filename, chunks = export_applications(request.args.to_dict())
+    except QueryError as e:
+        return jsonify(error=str(e)), 400
+    return Response(chunks, content_type=content_type,
+                    headers={'Content-Disposition': f'attachment; filename={filename}'})
+
+@app.route('/debug/profile', methods=['GET', 'POST'])
+def debug_profile():
+    """Профилирование следующих webhook-запросов (нужен заголовок Authorization: Bearer <ADMIN_TOKEN>)"""
+    params = request.args.to_dict() if request.method == 'GET' else request.get_json(silent=True) or {}
+    status, body = handle_profile(request.method, request.headers.get('Authorization', ''), params)
+    return jsonify(body), status
+
+@app.route('/debug/slow')
+def debug_slow():
+    """Последние медленные webhook-запросы с разбивкой по этапам"""
+    status, body = slow_requests(request.headers.get('Authorization', ''), request.args.to_dict())
+    return jsonify(body), status
+
+@app.route('/metrics')
+def metrics():
+    """Метрики в текстовом формате Prometheus"""
+    return Response(metrics_registry.render(), content_type=Registry.CONTENT_TYPE)
+
 # Добавляем обработчик ошибок для отладки
 @app.errorhandler(Exception)
 def handle_error(e):
-    logger.error(f"Произошла ошибка: {str(e)}", exc_info=True)
+    logger.error("Произошла ошибка: %s", e, exc_info=True)
     return jsonify(error=str(e)), 500
 
 if __name__ == '__main__':
@@ -0,0 +1,208 @@
+import csv
+import datetime
+import io
+import json
+import sqlite3
+import threading
+import time
+
+# Столбцы для поиска заявок (город и номер автомобиля хранятся нормализованными)
+FILTERS = ('phone', 'user_type', 'city', 'car_number')
+
+
+class QueryError(ValueError):
+    """Некорректные параметры запроса заявок"""
+
+
+def normalize_city(value):
+    """Город для поиска: без учета регистра и пробелов по краям (в том числе для кириллицы)"""
+    return value.strip().casefold() if value else None
+
+
+def normalize_car_number(value):
+    """Номер автомобиля для поиска: заглавные буквы без пробелов и дефисов"""
+    return value.replace(' ', '').replace('-', '').upper() if value else None
+
+
+def parse_time(value):
+    """Время из параметра запроса: unix-время или дата/время ISO 8601 (местное время, если без зоны)"""
+    if value is None or value == '':
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    try:
+        return datetime.datetime.fromisoformat(value).timestamp()
+    except ValueError:
+        raise QueryError(f"Некорректное время: {value}")
+
+
+def parse_filters(params):
+    """Фильтры заявок из параметров запроса: phone, user_type, city, car_number, since, until"""
+    return {
+        'phone': params.get('phone', '').replace('+', '').strip() or None,
+        'user_type': params.get('user_type') or None,
+        'city': normalize_city(params.get('city')),
+        'car_number': normalize_car_number(params.get('car_number')),
+        'since': parse_time(params.get('since')),
+        'until': parse_time(params.get('until')),
+    }
+
+
+def encode_cursor(record):
+    return f"{record['created_at']!r}:{record['id']}"
+
+
+def decode_cursor(cursor):
+    created_at, _, record_id = cursor.partition(':')
+    try:
+        return float(created_at), record_id
+    except ValueError:
+        raise QueryError(f"Некорректный курсор: {cursor}")
+
+
+class ApplicationStore:
+    """Заявки в SQLite (режим WAL) с индексами по телефону, типу пользователя, городу, номеру авто и времени.
+
+    Заявки выбираются от новых к старым с постраничной навигацией по курсору (created_at, id),
+    поэтому глубина страницы не влияет на скорость запроса, а выгрузка читает таблицу частями.
+    """
+
+    def __init__(self, path, busy_timeout_ms=5000):
+        self.path = path
+        self._busy_timeout_ms = busy_timeout_ms
+        self._local = threading.local()
+        conn = self._connection()
+        conn.execute(
+            'CREATE TABLE IF NOT EXISTS applications ('
+            ' id TEXT PRIMARY KEY,'
+            ' created_at REAL NOT NULL,'
+            ' phone TEXT NOT NULL,'
+            ' user_type TEXT NOT NULL,'
+            ' city TEXT,'
+            ' car_number TEXT,'
+            ' fields TEXT NOT NULL)'
+        )
+        # Индексы заканчиваются временем создания: фильтр и сортировка обслуживаются одним индексом
+        conn.execute('CREATE INDEX IF NOT EXISTS applications_created ON applications (created_at, id)')
+        for column in FILTERS:
+            conn.execute(f'CREATE INDEX IF NOT EXISTS applications_{column}'
+                         f' ON applications ({column}, created_at, id)')
+        conn.commit()
+
+    def _connection(self):
+        # Соединение SQLite нельзя разделять между потоками, поэтому у каждого потока свое
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=self._busy_timeout_ms / 1000.0)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            conn.execute(f'PRAGMA busy_timeout={int(self._busy_timeout_ms)}')
+            conn.row_factory = sqlite3.Row
+            self._local.conn = conn
+        return conn
+
+    def add(self, record_id, phone, user_type, fields, created_at=None):
+        """Запись заявки (повторная запись с тем же id ничего не меняет)"""
+        conn = self._connection()
+        conn.execute(
+            'INSERT OR IGNORE INTO applications (id, created_at, phone, user_type, city, car_number, fields)'
+            ' VALUES (?, ?, ?, ?, ?, ?, ?)',
+            (record_id, created_at or time.time(), phone, user_type, normalize_city(fields.get('city')),
+             normalize_car_number(fields.get('car_number')), json.dumps(fields, ensure_ascii=False))
+        )
+        conn.commit()
+
+    @staticmethod
+    def _where(filters, cursor=None):
+        clauses = []
+        params = []
+        for column in FILTERS:
+            if filters.get(column):
+                clauses.append(f'{column} = ?')
+                params.append(filters[column])
+        if filters.get('since') is not None:
+            clauses.append('created_at >= ?')
+            params.append(filters['since'])
+        if filters.get('until') is not None:
+            clauses.append('created_at < ?')
+            params.append(filters['until'])
+        if cursor:
+            created_at, record_id = decode_cursor(cursor)
+            clauses.append('(created_at, id) < (?, ?)')
+            params.extend((created_at, record_id))
+        return (' WHERE ' + ' AND '.join(clauses) if clauses else ''), params
+
+    def query(self, filters, limit=100, cursor=None):
+        """Страница заявок (от новых к старым) по фильтрам parse_filters и курсор следующей страницы или None"""
+        where, params = self._where(filters, cursor)
+        rows = self._connection().execute(
+            f'SELECT id, created_at, phone, user_type, fields FROM applications{where}'
+            f' ORDER BY created_at DESC, id DESC LIMIT ?', params + [limit + 1]
+        ).fetchall()
+        items = [self._record(row) for row in rows[:limit]]
+        next_cursor = encode_cursor(items[-1]) if len(rows) > limit else None
+        return items, next_cursor
+
+    def iter_records(self, filters, batch_size=1000):
+        """Все заявки по фильтрам частями по batch_size: в памяти находится только одна часть"""
+        cursor = None
+        while True:
+            items, cursor = self.query(filters, batch_size, cursor)
+            yield from items
+            if cursor is None:
+                return
+
+    @staticmethod
+    def _record(row):
+        return {
+            'id': row['id'],
+            'created_at': row['created_at'],
+            'phone': row['phone'],
+            'user_type': row['user_type'],
+            'fields': json.loads(row['fields']),
+        }
+
+    def count(self):
+        return self._connection().execute('SELECT COUNT(*) FROM applications').fetchone()[0]
+
+    def stats(self):
+        conn = self._connection()
+        page_count = conn.execute('PRAGMA page_count').fetchone()[0]
+        page_size = conn.execute('PRAGMA page_size').fetchone()[0]
+        return {'applications': self.count(), 'approx_bytes': page_count * page_size}
+
+
+def _created_iso(record):
+    return datetime.datetime.fromtimestamp(record['created_at']).isoformat(timespec='seconds')
+
+
+def export_jsonl(records, batch_size=500):
+    """Выгрузка в JSON Lines: строки отдаются частями по batch_size заявок"""
+    lines = []
+    for record in records:
+        lines.append(json.dumps(dict(record, created_at=_created_iso(record)), ensure_ascii=False))
+        if len(lines) >= batch_size:
+            yield '\n'.join(lines) + '\n'
+            lines = []
+    if lines:
+        yield '\n'.join(lines) + '\n'
+
+
+def export_csv(records, columns, batch_size=500):
+    """Выгрузка в CSV со столбцами id, created_at, phone, user_type и полями заявки columns"""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(['id', 'created_at', 'phone', 'user_type'] + list(columns))
+    count = 0
+    for record in records:
+        fields = record['fields']
+        writer.writerow([record['id'], _created_iso(record), record['phone'], record['user_type']]
+                        + [fields.get(column, '') for column in columns])
+        count += 1
+        if count % batch_size == 0:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue()
@@ -0,0 +1,483 @@
+"""Асинхронный режим: ASGI-приложение с теми же маршрутами и логикой диалога, что и app.py.
+
+Запросы к waApi и Trello выполняются асинхронным клиентом httpx, поэтому один процесс может
+держать тысячи одновременных запросов к внешним сервисам. Запуск:
+
+    uvicorn asgi:application --host 0.0.0.0 --port 5050
+"""
+import asyncio
+import json
+import logging
+import time
+import urllib.parse
+import uuid
+
+import app as bot
+import tracing
+from config import (WEBHOOK_MAX_BYTES, WEBHOOK_MAX_DEPTH, WEBHOOK_MAX_NODES, SENDER_LOCK_SHARDS,
+                    OUTBOUND_QUEUE_SIZE, OUTBOUND_SHUTDOWN_TIMEOUT, ASYNC_OUTBOUND_WORKERS,
+                    ASYNC_MAX_CONNECTIONS, WAAPI_INSTANCE_ID, WAAPI_INSTANCES, WAAPI_RATE_LIMIT,
+                    WAAPI_RATE_BURST, BROADCAST_DIR, BROADCAST_CONCURRENCY, ADMIN_TOKEN, ADMISSION_MAX_IN_FLIGHT,
+                    ADMISSION_MIN_IN_FLIGHT, ADMISSION_QUEUE_SIZE, ADMISSION_QUEUE_TIMEOUT, ADMISSION_NEW_SHARE,
+                    ADMISSION_LATENCY_TOLERANCE)
+from admission import AsyncAdmissionController
+from applications import QueryError
+from broadcast import BroadcastManager
+from delivery import mark_inbound
+from ingest import PayloadError, parse_json, extract_messages, extract_acks, extract_form
+from keyed_locks import AsyncKeyedLocks
+from logging_setup import set_request_id, get_request_id, should_log_payload
+from outbound import AsyncOutboundDispatcher
+from outbox import RejectedError
+from rate_limit import AsyncTokenBucket, InstanceRateLimiter, PRIORITY_INTERACTIVE, PRIORITY_BULK
+from upstream import AsyncUpstreamClient, CircuitOpenError
+
+logger = logging.getLogger(__name__)
+
+waapi_async = AsyncUpstreamClient('waapi', max_connections=ASYNC_MAX_CONNECTIONS)
+trello_async = AsyncUpstreamClient('trello', max_connections=ASYNC_MAX_CONNECTIONS)
+waapi_limiter = InstanceRateLimiter(WAAPI_RATE_LIMIT, WAAPI_RATE_BURST, bucket_class=AsyncTokenBucket)
+# У каждого экземпляра waApi (номера WhatsApp) свой пул соединений
+waapi_clients = {instance_id: waapi_async if instance_id == WAAPI_INSTANCE_ID
+                 else AsyncUpstreamClient('waapi', max_connections=ASYNC_MAX_CONNECTIONS)
+                 for instance_id in WAAPI_INSTANCES}
+
+
+async def send_whatsapp_message(phone_number, message, instance_id=None, priority=PRIORITY_INTERACTIVE):
+    """Отправка сообщения через экземпляр waApi instance_id (None - по умолчанию)"""
+    instance_id = instance_id or WAAPI_INSTANCE_ID
+    url, headers, payload = bot.waapi_message_request(phone_number, message, instance_id)
+    try:
+        logger.info("Отправка сообщения через waApi (экземпляр %s) в чат %s", instance_id, payload['chatId'])
+        response = await waapi_clients.get(instance_id, waapi_async).post(
+            url, headers=headers, json=payload, rate_limiter=waapi_limiter.bucket(instance_id), priority=priority)
+        return bot.track_delivery(bot.waapi_result(response), instance_id)
+    except CircuitOpenError as e:
+        logger.warning("Сообщение не отправлено: %s", e)
+        return None
+    except Exception as e:
+        logger.error("Ошибка при отправке сообщения через waApi: %s", e, exc_info=True)
+        return None
+
+
+async def send_to_trello(card):
+    """Создание карточки в Trello по записи журнала заявок (или обновление карточки номера при TRELLO_UPSERT)"""
+    card_id = None
+    try:
+        # Индекс карточек и журнал заявок обращаются к диску (SQLite, fsync): вызовы выполняются в пуле потоков
+        existing_id = await asyncio.to_thread(bot.existing_trello_card, card)
+        if existing_id:
+            # Повторная заявка с того же номера обновляет его карточку (TRELLO_UPSERT)
+            method, trello_api_url, query_params, headers = bot.trello_update_request(card, existing_id)
+            logger.info("Отправка запроса в Trello API: %s", trello_api_url)
+            response = await trello_async.request(method, trello_api_url, params=query_params, headers=headers)
+            card_id = await asyncio.to_thread(bot.trello_update_result, card, existing_id, response)
+        if existing_id is None or card_id is False:
+            trello_api_url, query_params, headers = bot.trello_card_request(card)
+            logger.info("Отправка запроса в Trello API: %s", trello_api_url)
+            response = await trello_async.post(trello_api_url, params=query_params, headers=headers)
+            card_id = bot.trello_card_id(response)
+            if card_id:
+                await asyncio.to_thread(bot.remember_trello_card, card, card_id)
+        if card_id and card.get('media'):
+            # Файлы передаются частями с диска синхронным клиентом в пуле потоков
+            await asyncio.to_thread(bot.attach_media, card_id, card['media'])
+    except RejectedError as e:
+        # Заявку повторит фоновая отправка и после OUTBOX_MAX_ATTEMPTS отказов перенесет в журнал отклоненных
+        logger.error("Trello отклонил заявку %s: %s", card['id'], e)
+    except CircuitOpenError as e:
+        logger.warning("Карточка не создана: %s", e)
+    except Exception as e:
+        logger.error("Ошибка при отправке данных в Trello: %s", e, exc_info=True)
+    return await asyncio.to_thread(bot.complete_trello_card, card, card_id)
+
+
+# Карточка из webhook-запроса отправляется фоновой задачей - отложенным этапом трассировки запроса
+send_request_card = tracing.traced('trello', send_to_trello)
+
+
+outbound_dispatcher = AsyncOutboundDispatcher(
+    tracing.traced('waapi_send', send_whatsapp_message),
+    queue_size=OUTBOUND_QUEUE_SIZE,
+    workers=ASYNC_OUTBOUND_WORKERS,
+    shutdown_timeout=OUTBOUND_SHUTDOWN_TIMEOUT
+)
+sender_locks = AsyncKeyedLocks(SENDER_LOCK_SHARDS)
+admission = AsyncAdmissionController(ADMISSION_MAX_IN_FLIGHT, ADMISSION_MIN_IN_FLIGHT, ADMISSION_QUEUE_SIZE,
+                                     ADMISSION_QUEUE_TIMEOUT, ADMISSION_NEW_SHARE, ADMISSION_LATENCY_TOLERANCE)
+
+# Цикл событий сервера: потоки рассылок отправляют сообщения через него
+_event_loop = None
+
+
+def _send_bulk_message(phone_number, message, instance_id=None):
+    """Отправка сообщения рассылки из ее потока асинхронным клиентом с общим ограничением частоты"""
+    future = asyncio.run_coroutine_threadsafe(
+        send_whatsapp_message(phone_number, message, instance_id, priority=PRIORITY_BULK), _event_loop)
+    return future.result()
+
+
+broadcasts = BroadcastManager(BROADCAST_DIR, bot.broadcast_recipients, bot.broadcast_message, _send_bulk_message,
+                              concurrency=BROADCAST_CONCURRENCY)
+
+for _instance_id, _client in waapi_clients.items():
+    bot.register_upstream_metrics(_client, 'async', _instance_id)
+bot.register_upstream_metrics(trello_async, 'async')
+bot.register_outbound_metrics(outbound_dispatcher, 'async')
+bot.register_rate_limit_metrics(waapi_limiter, 'async')
+bot.register_admission_metrics(admission, 'async')
+bot.metrics_registry.register('bot_broadcast_messages_total', 'counter', 'Сообщения рассылок по результату',
+                              broadcasts.results, {'mode': 'async'})
+
+# Фоновые задачи отправки в Trello (ссылки хранятся, чтобы задачи не были удалены сборщиком мусора)
+_background_tasks = set()
+
+
+def _spawn(coroutine):
+    task = asyncio.ensure_future(coroutine)
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+    return task
+
+
+async def _startup():
+    global _event_loop
+    _event_loop = asyncio.get_running_loop()
+    for client in waapi_clients.values():
+        client.start()
+    trello_async.start()
+    outbound_dispatcher.start()
+
+
+async def _shutdown():
+    # Рассылки отменяются первыми: их потоки ждут отправки в этом цикле событий
+    await asyncio.get_running_loop().run_in_executor(None, broadcasts.shutdown)
+    await outbound_dispatcher.shutdown()
+    if _background_tasks:
+        await asyncio.wait(list(_background_tasks), timeout=OUTBOUND_SHUTDOWN_TIMEOUT)
+    for client in waapi_clients.values():
+        await client.close()
+    await trello_async.close()
+    # Последние изменения сессий записываются до выхода (uvicorn перехватывает SIGTERM сам)
+    if bot.session_snapshot is not None:
+        await asyncio.get_running_loop().run_in_executor(None, bot.session_snapshot.stop)
+
+
+# --- HTTP ---
+
+async def _read_body(receive, limit):
+    """Чтение тела запроса с ограничением размера"""
+    chunks = []
+    size = 0
+    while True:
+        message = await receive()
+        if message['type'] == 'http.disconnect':
+            break
+        chunk = message.get('body', b'')
+        size += len(chunk)
+        if size > limit:
+            raise PayloadError(f"Размер тела запроса превышает {limit} байт")
+        chunks.append(chunk)
+        if not message.get('more_body'):
+            break
+    return b''.join(chunks)
+
+
+def _query_params(scope):
+    """Параметры строки запроса (первое значение каждого параметра)"""
+    query = urllib.parse.parse_qs(scope.get('query_string', b'').decode('utf-8'))
+    return {key: values[0] for key, values in query.items()}
+
+
+async def _respond(send, status, body=b'', content_type='text/html; charset=utf-8', headers=None):
+    if isinstance(body, str):
+        body = body.encode('utf-8')
+    await send({
+        'type': 'http.response.start',
+        'status': status,
+        'headers': [
+            (b'content-type', content_type.encode('ascii')),
+            (b'content-length', str(len(body)).encode('ascii')),
+            # Как CORS(app) во Flask-приложении
+            (b'access-control-allow-origin', b'*'),
+        ] + [(name.lower().encode('ascii'), value.encode('ascii')) for name, value in (headers or {}).items()],
+    })
+    await send({'type': 'http.response.body', 'body': body})
+
+
+async def index(scope, receive, send, headers):
+    """Простой индексный маршрут для проверки доступности сервера"""
+    logger.info("Получен запрос на индексную страницу: %s", scope['method'])
+    await _respond(send, 200, bot.INDEX_HTML)
+
+
+async def favicon(scope, receive, send, headers):
+    """Обработчик для запросов фавиконки"""
+    await _respond(send, 204)
+
+
+async def stats(scope, receive, send, headers):
+    """Показатели асинхронного режима"""
+    body = json.dumps({
+        'outbound': outbound_dispatcher.stats(),
+        'sessions': bot.session_store.stats(),
+        'session_snapshot': bot.session_snapshot.stats() if bot.session_snapshot is not None else None,
+        'dedup': bot.dedup_cache.stats(),
+        'sender_locks': sender_locks.stats(),
+        'admission': admission.stats(),
+        'delivery': bot.delivery_tracker.stats(),
+        'media': bot.media_spool.stats(),
+        'rate_limit': waapi_limiter.stats(),
+        'applications': bot.application_store.stats(),
+        'tracing': bot.tracer.stats(),
+        'trello_cards': bot.trello_cards.stats() if bot.trello_cards is not None else None,
+        'upstreams': {'waapi': waapi_async.stats(), 'trello': trello_async.stats(), 'media': bot.media_http.stats()},
+        'instances': {instance_id: {'trello_list_id': WAAPI_INSTANCES[instance_id], 'waapi': client.stats()}
+                      for instance_id, client in waapi_clients.items()},
+    })
+    await _respond(send, 200, body, 'application/json')
+
+
+async def debug_profile(scope, receive, send, headers):
+    """Профилирование следующих webhook-запросов (нужен заголовок Authorization: Bearer <ADMIN_TOKEN>)"""
+    if scope['method'] == 'GET':
+        params = _query_params(scope)
+    else:
+        try:
+            params = parse_json(await _read_body(receive, WEBHOOK_MAX_BYTES), WEBHOOK_MAX_BYTES)
+        except PayloadError as e:
+            await _respond(send, 400, json.dumps({'error': str(e)}, ensure_ascii=False), 'application/json')
+            return
+    status, body = bot.handle_profile(scope['method'], headers.get(b'authorization', b'').decode('latin-1'), params)
+    await _respond(send, status, json.dumps(body, ensure_ascii=False), 'application/json')
+
+
+async def debug_slow(scope, receive, send, headers):
+    """Последние медленные webhook-запросы с разбивкой по этапам"""
+    status, body = bot.slow_requests(headers.get(b'authorization', b'').decode('latin-1'), _query_params(scope))
+    await _respond(send, status, json.dumps(body, ensure_ascii=False), 'application/json')
+
+
+async def metrics(scope, receive, send, headers):
+    """Метрики в текстовом формате Prometheus"""
+    await _respond(send, 200, bot.metrics_registry.render(), bot.Registry.CONTENT_TYPE)
+
+
+async def broadcast(scope, receive, send, headers):
+    """Массовые рассылки (нужен заголовок Authorization: Bearer <BROADCAST_TOKEN>)"""
+    if scope['method'] == 'GET':
+        params = _query_params(scope)
+    else:
+        try:
+            params = parse_json(await _read_body(receive, WEBHOOK_MAX_BYTES), WEBHOOK_MAX_BYTES)
+        except PayloadError as e:
+            await _respond(send, 400, json.dumps({'error': str(e)}, ensure_ascii=False), 'application/json')
+            return
+    authorization = headers.get(b'authorization', b'').decode('latin-1')
+    # Запуск рассылки читает файлы и сессии, поэтому выполняется в пуле потоков
+    status, body = await asyncio.get_running_loop().run_in_executor(
+        None, bot.handle_broadcast, scope['method'], authorization, params, broadcasts)
+    await _respond(send, status, json.dumps(body, ensure_ascii=False), 'application/json')
+
+
+async def applications(scope, receive, send, headers):
+    """Поиск заявок (нужен заголовок Authorization: Bearer <ADMIN_TOKEN>)"""
+    if not bot.is_authorized(headers.get(b'authorization', b'').decode('latin-1'), ADMIN_TOKEN):
+        await _respond(send, 403, json.dumps({'error': 'Доступ запрещен'}, ensure_ascii=False), 'application/json')
+        return
+    status, body = await asyncio.get_running_loop().run_in_executor(
+        None, bot.query_applications, _query_params(scope))
+    await _respond(send, status, json.dumps(body, ensure_ascii=False), 'application/json')
+
+
+async def applications_export(scope, receive, send, headers):
+    """Потоковая выгрузка заявок: части читаются из SQLite в пуле потоков и отправляются по мере готовности"""
+    if not bot.is_authorized(headers.get(b'authorization', b'').decode('latin-1'), ADMIN_TOKEN):
+        await _respond(send, 403, json.dumps({'error': 'Доступ запрещен'}, ensure_ascii=False), 'application/json')
+        return
+    try:
+        content_type, filename, chunks = bot.export_applications(_query_params(scope))
+    except QueryError as e:
+        await _respond(send, 400, json.dumps({'error': str(e)}, ensure_ascii=False), 'application/json')
+        return
+    loop = asyncio.get_running_loop()
+    await send({
+        'type': 'http.response.start',
+        'status': 200,
+        'headers': [
+            (b'content-type', content_type.encode('ascii')),
+            (b'content-disposition', f'attachment; filename={filename}'.encode('ascii')),
+            (b'access-control-allow-origin', b'*'),
+        ],
+    })
+    while True:
+        chunk = await loop.run_in_executor(None, next, chunks, None)
+        if chunk is None:
+            break
+        await send({'type': 'http.response.body', 'body': chunk.encode('utf-8'), 'more_body': True})
+    await send({'type': 'http.response.body', 'body': b''})
+
+
+def _process_batch(sender_phone, instance_id, batch, started, prefetched):
+    """Обработка сообщений отправителя в пуле потоков: сессия, файлы, журнал и хранилище заявок обращаются
+    к диску и SQLite. Возвращает ответы, записанные заявки и время окончания обработки"""
+    replies = []
+    cards = []
+    with bot.session_scope(sender_phone, instance_id) as session:
+        for message in batch:
+            state = session.state
+            incoming_msg = message.text
+            if message.media is not None:
+                with tracing.span('media'):
+                    incoming_msg = bot.receive_media(session, message, prefetched)
+            response_message, card = bot.apply_message(sender_phone, incoming_msg) if incoming_msg else ("", None)
+            if response_message:
+                replies.append(response_message)
+            if card is not None:
+                cards.append(card)
+            bot.record_webhook(state, started)
+            started = time.perf_counter()
+    return replies, cards, started
+
+
+async def webhook(scope, receive, send, headers):
+    """Основной обработчик сообщений WhatsApp"""
+    started = time.perf_counter()
+    mark_inbound()
+    logger.info("Получен webhook запрос: %s", scope['method'])
+
+    if scope['method'] == 'GET':
+        logger.info("Получен GET запрос на webhook")
+        await _respond(send, 200, "Webhook is active")
+        return
+
+    try:
+        with tracing.span('parse'):
+            raw = await _read_body(receive, WEBHOOK_MAX_BYTES)
+            if not raw:
+                logger.warning("Получен пустой запрос")
+                bot.webhook_results.labels('empty').inc()
+                await _respond(send, 200, "OK")
+                return
+            if headers.get(b'content-type', b'').split(b';')[0].strip() == b'application/json':
+                data = parse_json(raw, WEBHOOK_MAX_BYTES)
+                if should_log_payload():
+                    logger.info("JSON данные: %s", data)
+                messages = extract_messages(data, WEBHOOK_MAX_DEPTH, WEBHOOK_MAX_NODES)
+                acks = extract_acks(data)
+            else:
+                # Для тестирования или альтернативных форматов
+                form = {key: values[0] for key, values in urllib.parse.parse_qs(raw.decode('utf-8')).items()}
+                if should_log_payload():
+                    logger.info("Данные формы: %s", form)
+                messages = [extract_form(form)]
+                acks = []
+    except PayloadError as e:
+        logger.warning("Отклонен webhook запрос: %s", e)
+        bot.webhook_results.labels('rejected').inc()
+        await _respond(send, 200, "OK")
+        return
+    except Exception as e:
+        logger.error("Ошибка при извлечении данных из входящего запроса: %s", e, exc_info=True)
+        bot.webhook_results.labels('error').inc()
+        await _respond(send, 200, "OK")
+        return
+
+    if acks:
+        bot.acknowledge_deliveries(acks)
+    if not messages:
+        await _respond(send, 200, "OK")
+        return
+
+    # Логика диалога общая с app.py; обращения к внешним сервисам выполняются асинхронно, к диску и SQLite
+    # (сессии, дедупликация, журнал заявок) - в пуле потоков, asyncio.to_thread передает контекст трассировки.
+    # При перегрузке запрос отклоняется до отметки сообщений как обработанных
+    async with admission.admit(lambda: asyncio.to_thread(bot.admission_priority, messages)) as admitted:
+        if not admitted:
+            await _respond(send, 503, "Service Unavailable", headers=bot.OVERLOADED_HEADERS)
+            return
+        # Если пачка отправителя не обработана до конца (ошибка или обрыв соединения), отметки дедупликации
+        # с нее и со следующих пачек снимаются, и повторная доставка waApi не будет отброшена
+        batches = await asyncio.to_thread(bot.sender_batches, messages)
+        processed = 0
+        try:
+            for sender_phone, instance_id, batch in batches:
+                prefetched = await asyncio.to_thread(bot.prefetch_media, sender_phone, instance_id, batch)
+                async with sender_locks.hold(bot.session_key(sender_phone, instance_id)):
+                    replies, cards, started = await asyncio.to_thread(
+                        _process_batch, sender_phone, instance_id, batch, started, prefetched)
+                    for response_message in bot.coalesce_replies(replies):
+                        # Запрос считается завершенным после отправки ответа из очереди
+                        trace = tracing.hold()
+                        if not outbound_dispatcher.submit(sender_phone, response_message, instance_id):
+                            tracing.release(trace)
+                processed += 1
+
+                for card in cards:
+                    tracing.hold()
+                    _spawn(send_request_card(card))
+        except BaseException:
+            await asyncio.to_thread(bot.forget_batches, batches[processed:])
+            raise
+
+    await _respond(send, 200, "OK")
+
+
+ROUTES = {
+    '/': (index, ('GET', 'POST')),
+    '/webhook': (webhook, ('GET', 'POST')),
+    '/favicon.ico': (favicon, ('GET',)),
+    '/stats': (stats, ('GET',)),
+    '/metrics': (metrics, ('GET',)),
+    '/broadcast': (broadcast, ('GET', 'POST')),
+    '/applications': (applications, ('GET',)),
+    '/applications/export': (applications_export, ('GET',)),
+    '/debug/profile': (debug_profile, ('GET', 'POST')),
+    '/debug/slow': (debug_slow, ('GET',)),
+}
+
+
+async def _lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            await _startup()
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            await _shutdown()
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+
+async def application(scope, receive, send):
+    """Точка входа ASGI"""
+    if scope['type'] == 'lifespan':
+        await _lifespan(receive, send)
+        return
+    if scope['type'] != 'http':
+        return
+
+    route = ROUTES.get(scope['path'])
+    if route is None:
+        await _respond(send, 404, "Not Found")
+        return
+    handler, methods = route
+    if scope['method'] not in methods:
+        await _respond(send, 405, "Method Not Allowed")
+        return
+
+    headers = dict(scope['headers'])
+    set_request_id(headers.get(b'x-request-id', b'').decode('latin-1') or uuid.uuid4().hex[:16])
+    trace = profile = None
+    if handler is webhook:
+        trace = bot.tracer.begin(get_request_id(), scope['path'])
+        # cProfile в цикле событий учитывает и другие задачи, выполнявшиеся во время профилируемого запроса
+        profile = bot.profiler.begin() if bot.profiler.active else None
+    try:
+        await handler(scope, receive, send, headers)
+    except Exception as e:
+        logger.error("Произошла ошибка: %s", e, exc_info=True)
+        await _respond(send, 500, json.dumps({'error': str(e)}), 'application/json')
+    finally:
+        bot.profiler.end(profile)
+        bot.tracer.end(trace)
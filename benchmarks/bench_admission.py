@@ -0,0 +1,99 @@
+"""Допуск webhook-запросов при перегрузке: AdmissionController перед обработчиком с ограниченным ресурсом.
+
+Обработчик моделирует запрос, который держит одно из нескольких соединений (пул HTTP-клиента, SQLite)
+заданное время, поэтому сервер выдерживает connections / service запросов в секунду. Запросы приходят
+с частотой выше этой (открытая модель: шторм ответов на рассылку не ждет ответов сервера), каждый
+в своем потоке, как у сервера Flask с threaded=True; доля dialog - отправители посередине диалога,
+остальные - новые сессии. Без контроля (ADMISSION_MAX_IN_FLIGHT=0) показывает, как растут очередь потоков
+и задержка, с контролем - задержки по приоритетам, отклоненные запросы (503), время до отказа и итоговый лимит.
+
+Запуск: python benchmarks/bench_admission.py [запросов/с] [секунд] [соединений] [мс на запрос] [доля dialog]
+"""
+import logging
+import os
+import random
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from admission import AdmissionController, PRIORITY_DIALOG, PRIORITY_NEW  # noqa: E402
+from config import (ADMISSION_MIN_IN_FLIGHT, ADMISSION_QUEUE_SIZE, ADMISSION_QUEUE_TIMEOUT,  # noqa: E402
+                    ADMISSION_NEW_SHARE, ADMISSION_LATENCY_TOLERANCE)
+
+
+# Отклонения пишутся в журнал раз в секунду; в выводе теста они не нужны
+logging.getLogger('admission').setLevel(logging.ERROR)
+
+
+def percentile(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * q))] if values else 0.0
+
+
+def run(max_limit, rate, duration, connections, service, dialog_share, warmup=2.0):
+    controller = AdmissionController(max_limit, ADMISSION_MIN_IN_FLIGHT, ADMISSION_QUEUE_SIZE,
+                                     ADMISSION_QUEUE_TIMEOUT, ADMISSION_NEW_SHARE, ADMISSION_LATENCY_TOLERANCE)
+    resource = threading.BoundedSemaphore(connections)
+    results = {PRIORITY_DIALOG: [], PRIORITY_NEW: []}
+    shed = {PRIORITY_DIALOG: [], PRIORITY_NEW: []}
+    peak_threads = [0]
+
+    def request(priority, measured):
+        started = time.perf_counter()
+        with controller.admit(lambda: priority) as admitted:
+            if admitted:
+                with resource:
+                    time.sleep(service)
+        if measured:
+            (results if admitted else shed)[priority].append(time.perf_counter() - started)
+
+    # Обычная нагрузка (половина пропускной способности), по которой контроллер узнает время обработки
+    phases = [(connections / service / 2, warmup, False), (rate, duration, True)]
+    threads = []
+    for phase_rate, phase_duration, measured in phases:
+        started = time.perf_counter()
+        for n in range(int(phase_rate * phase_duration)):
+            delay = started + n / phase_rate - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            priority = PRIORITY_DIALOG if random.random() < dialog_share else PRIORITY_NEW
+            thread = threading.Thread(target=request, args=(priority, measured), daemon=True)
+            thread.start()
+            threads.append(thread)
+            peak_threads[0] = max(peak_threads[0], threading.active_count())
+    for thread in threads:
+        thread.join()
+
+    dialog, new = results[PRIORITY_DIALOG], results[PRIORITY_NEW]
+    shed_all = shed[PRIORITY_DIALOG] + shed[PRIORITY_NEW]
+    total = sum(len(values) for values in (dialog, new, shed_all))
+    print(f"{max_limit or '-':>6}{percentile(dialog, 0.5) * 1000:>9.0f}{percentile(dialog, 0.99) * 1000:>9.0f}"
+          f"{percentile(new, 0.5) * 1000:>9.0f}{percentile(new, 0.99) * 1000:>9.0f}"
+          f"{len(shed[PRIORITY_DIALOG]) / max(1, len(dialog) + len(shed[PRIORITY_DIALOG])):>10.1%}"
+          f"{len(shed[PRIORITY_NEW]) / max(1, len(new) + len(shed[PRIORITY_NEW])):>10.1%}"
+          f"{percentile(shed_all, 0.5) * 1000:>10.2f}{(len(dialog) + len(new)) / duration:>10.0f}"
+          f"{peak_threads[0]:>9}{(int(controller.limit) if controller.enabled else '-'):>7}"
+          f"   ({total} запросов)")
+
+
+def main():
+    rate = float(sys.argv[1]) if len(sys.argv) > 1 else 800
+    duration = float(sys.argv[2]) if len(sys.argv) > 2 else 5
+    connections = int(sys.argv[3]) if len(sys.argv) > 3 else 8
+    service = float(sys.argv[4]) / 1000 if len(sys.argv) > 4 else 0.02
+    dialog_share = float(sys.argv[5]) if len(sys.argv) > 5 else 0.2
+
+    print(f"{rate:.0f} запросов/с в течение {duration:.0f} с, пропускная способность {connections / service:.0f}/с "
+          f"({connections} соединений по {service * 1000:.0f} мс), {dialog_share:.0%} из диалога")
+    print(f"{'лимит':>6}{'dialog':>9}{'':>9}{'new':>9}{'':>9}{'503':>10}{'503':>10}{'503 за':>10}{'принято':>10}"
+          f"{'потоков':>9}{'итог':>7}")
+    print(f"{'':>6}{'p50, мс':>9}{'p99, мс':>9}{'p50, мс':>9}{'p99, мс':>9}{'dialog':>10}{'new':>10}{'мс':>10}"
+          f"{'в сек.':>10}")
+    for max_limit in (0, 64):
+        run(max_limit, rate, duration, connections, service, dialog_share)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,91 @@
+"""Сопоставление ответов с ключевыми словами: доля распознанных ответов и стоимость поиска.
+
+Корпус (benchmarks/answer_corpus.tsv) - ответы пользователей на вопросы с вариантами (язык, автосалон или
+клиент, сотрудничество, новая заявка) с ожидаемым вариантом. Для каждого способа ANSWER_MATCHING показывает
+распознанные ответы, ошибочные совпадения (ответ, который не должен совпасть, или совпадение с другим
+вариантом), лишние повторные вопросы (каждый - исходящее сообщение waApi и еще один webhook-запрос)
+и время поиска в индексе на ответ.
+
+Запуск: python benchmarks/bench_answers.py [повторов корпуса для замера времени]
+"""
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from config import (DIALOG_FLOW, MESSAGES, LANGUAGES, STATES, DEALERSHIP_STATES, LANGUAGE_RU_KEYWORDS,  # noqa: E402
+                    LANGUAGE_KZ_KEYWORDS, DEALERSHIP_KEYWORDS, CLIENT_KEYWORDS, YES_KEYWORDS, NEW_REQUEST_KEYWORDS)
+from dialog import DialogEngine  # noqa: E402
+from matching import MODES  # noqa: E402
+
+CORPUS = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'answer_corpus.tsv')
+STATE_NAMES = {
+    'language': STATES['WAITING_FOR_LANGUAGE'],
+    'user_type': STATES['WAITING_FOR_USER_TYPE'],
+    'cooperation': DEALERSHIP_STATES['WAITING_FOR_COOPERATION'],
+    'completed': STATES['COMPLETED'],
+}
+# Вариант ответа - по первому ключевому слову его списка
+EXPECTED_KEYWORDS = {
+    'ru': LANGUAGE_RU_KEYWORDS[0], 'kz': LANGUAGE_KZ_KEYWORDS[0], 'dealership': DEALERSHIP_KEYWORDS[0],
+    'client': CLIENT_KEYWORDS[0], 'yes': YES_KEYWORDS[0], 'new': NEW_REQUEST_KEYWORDS[0],
+}
+
+
+def read_corpus(path=CORPUS):
+    with open(path, encoding='utf-8') as f:
+        return [line.rstrip('\n').split('\t') for line in f if line.strip() and not line.startswith('#')]
+
+
+def main():
+    repeat = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    corpus = read_corpus()
+    print(f"Корпус: {len(corpus)} ответов, из них {sum(expected != '-' for _, _, expected in corpus)} "
+          f"должны совпасть с вариантом")
+    print(f"{'способ':<12}{'распознано':>12}{'ошибочно':>10}{'повторов вопроса':>18}{'мкс/ответ':>11}"
+          f"{'мкс/нераспознанный':>20}")
+    for mode in MODES:
+        engine = DialogEngine(DIALOG_FLOW, MESSAGES, LANGUAGES['RU'], mode)
+        cases = []
+        for state_name, text, expected in corpus:
+            compiled = engine.states[STATE_NAMES[state_name]]
+            target = compiled.keywords.get(EXPECTED_KEYWORDS[expected]) if expected != '-' else None
+            cases.append((compiled, text, target))
+
+        recognized = wrong = reprompts = 0
+        missed = []
+        for compiled, text, target in cases:
+            step = compiled.keywords.get(text)
+            if step is not None and step is target:
+                recognized += 1
+            elif step is not None:
+                wrong += 1
+            elif target is not None:
+                missed.append(text)
+                # Без default (язык, тип пользователя) нераспознанный ответ - повторный вопрос
+                if compiled.default is not None and compiled.default.next_state is None:
+                    reprompts += 1
+
+        started = time.perf_counter()
+        for _ in range(repeat):
+            for compiled, text, _ in cases:
+                compiled.keywords.get(text)
+        per_answer = (time.perf_counter() - started) / (repeat * len(cases)) * 1e6
+        unmatched = [(compiled, text) for compiled, text, _ in cases if compiled.keywords.get(text) is None]
+        started = time.perf_counter()
+        for _ in range(repeat):
+            for compiled, text in unmatched:
+                compiled.keywords.get(text)
+        per_miss = (time.perf_counter() - started) / (repeat * len(unmatched)) * 1e6 if unmatched else 0.0
+
+        expected_total = sum(target is not None for _, _, target in cases)
+        print(f"{mode:<12}{recognized:>6} ({recognized / expected_total:>4.0%}){wrong:>10}{reprompts:>18}"
+              f"{per_answer:>11.2f}{per_miss:>20.2f}")
+        if missed:
+            print(f"{'':<12}не распознаны ({len(missed)} из {expected_total}): "
+                  + ', '.join(repr(text) for text in missed[:12]) + (' ...' if len(missed) > 12 else ''))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,104 @@
+"""Хранилище заявок: время поиска по индексам и выгрузка большой таблицы с постоянной памятью.
+
+Заполняет временную базу заданным количеством заявок, затем измеряет запросы /applications
+(по телефону, городу за неделю, номеру автомобиля, глубокую страницу по курсору) и полную выгрузку
+в CSV и JSON Lines с пиковой памятью процесса.
+
+Запуск: python benchmarks/bench_applications.py [заявок]
+"""
+import json
+import os
+import random
+import resource
+import sys
+import tempfile
+import time
+import uuid
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from applications import ApplicationStore, parse_filters, export_csv, export_jsonl  # noqa: E402
+
+CITIES = ['Алматы', 'Астана', 'Шымкент', 'Караганда', 'Актобе', 'Тараз', 'Павлодар', 'Атырау']
+COLUMNS = ['name', 'address', 'already_cooperates', 'id_document', 'tech_passport', 'car_number', 'city', 'mileage']
+
+
+def peak_rss_mb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def fill(store, count):
+    """Заявки за последние 90 дней: две трети клиентов, треть автосалонов"""
+    now = time.time()
+    conn = store._connection()
+    rows = []
+    for n in range(count):
+        created_at = now - random.uniform(0, 90 * 86400)
+        phone = f'7700{n % (count // 2 or 1):07d}'
+        if n % 3:
+            fields = {'car_number': f'{n % 1000:03d}ABC{n % 20:02d}', 'city': random.choice(CITIES),
+                      'mileage': str(n * 7 % 300000), 'id_document': f'Фото: id-{n}.jpg',
+                      'tech_passport': f'Фото: tp-{n}.jpg'}
+            rows.append((uuid.uuid4().hex, created_at, phone, 'client', fields['city'].casefold(),
+                         fields['car_number'], json.dumps(fields, ensure_ascii=False)))
+        else:
+            fields = {'name': f'Автосалон {n}', 'address': f'ул. Абая, {n}', 'already_cooperates': 'Да',
+                      'id_document': f'Фото: id-{n}.jpg', 'tech_passport': f'Фото: tp-{n}.jpg'}
+            rows.append((uuid.uuid4().hex, created_at, phone, 'dealership', None, None,
+                         json.dumps(fields, ensure_ascii=False)))
+        if len(rows) >= 10000:
+            conn.executemany('INSERT INTO applications VALUES (?, ?, ?, ?, ?, ?, ?)', rows)
+            rows = []
+    conn.executemany('INSERT INTO applications VALUES (?, ?, ?, ?, ?, ?, ?)', rows)
+    conn.commit()
+
+
+def timed(func, repeat=20):
+    started = time.perf_counter()
+    for _ in range(repeat):
+        result = func()
+    return (time.perf_counter() - started) / repeat * 1000, result
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+    store = ApplicationStore(os.path.join(tempfile.mkdtemp(prefix='bench-applications-'), 'applications.db'))
+    started = time.perf_counter()
+    fill(store, count)
+    print(f"Заявок: {count}, заполнение {time.perf_counter() - started:.1f} с, "
+          f"размер базы {store.stats()['approx_bytes'] / 1024 / 1024:.0f} МБ")
+
+    week_ago = time.strftime('%Y-%m-%d', time.localtime(time.time() - 7 * 86400))
+    cases = [
+        ('по телефону', {'phone': '77000000042'}),
+        ('клиенты из Алматы за неделю', {'user_type': 'client', 'city': 'алматы', 'since': week_ago}),
+        ('по номеру автомобиля', {'car_number': '042 abc 02'}),
+        ('все, первая страница', {}),
+    ]
+    print(f"{'запрос':<32}{'мс':>8}{'найдено':>10}")
+    for name, params in cases:
+        filters = parse_filters(params)
+        elapsed, (items, _) = timed(lambda: store.query(filters, 100))
+        print(f"{name:<32}{elapsed:>8.2f}{len(items):>10}")
+
+    # Глубокая страница: курсор после 100 страниц стоит столько же, сколько первая страница
+    filters = parse_filters({})
+    cursor = None
+    for _ in range(100):
+        _, cursor = store.query(filters, 100, cursor)
+    elapsed, _ = timed(lambda: store.query(filters, 100, cursor))
+    print(f"{'страница 101 по курсору':<32}{elapsed:>8.2f}{100:>10}")
+
+    rss_before = peak_rss_mb()
+    for name, exporter in (('CSV', lambda records: export_csv(records, COLUMNS)), ('JSON Lines', export_jsonl)):
+        started = time.perf_counter()
+        size = 0
+        for chunk in exporter(store.iter_records(filters)):
+            size += len(chunk.encode('utf-8'))
+        elapsed = time.perf_counter() - started
+        print(f"Выгрузка {name}: {size / 1024 / 1024:.0f} МБ за {elapsed:.1f} с ({count / elapsed:.0f} заявок/с), "
+              f"пиковая память процесса {peak_rss_mb():.0f} МБ (до выгрузки {rss_before:.0f} МБ)")
+
+
+if __name__ == '__main__':
+    main()
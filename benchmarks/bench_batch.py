@@ -0,0 +1,89 @@
+"""Пачки сообщений в старом формате webhook ({"messages": [...]}) против доставки по одному сообщению.
+
+Каждый отправитель проходит диалог автосалона (8 сообщений) быстрой серией. Сообщения отправляются
+запросами по batch штук подряд: batch=1 - каждое сообщение отдельным запросом. Показывает время
+сервера бота на одно сообщение (процессорное - вместе с отправкой ответов, по часам - прием запросов)
+и количество отправок в waApi: ответы на пачку сообщений одного отправителя объединяются в одно сообщение.
+
+Запуск: python benchmarks/bench_batch.py [отправителей] [режим flask|asgi] [размеры пачек через запятую]
+"""
+import os
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+from stubs import StubUpstream, start_bot_server, stop_bot_server
+
+SCRIPT = ['Здравствуйте', '1', 'автосалон', 'Автосалон {n}', 'ул. Абая, {n}', 'да', 'фото', 'фото']
+
+
+def cpu_seconds(pid):
+    """Процессорное время процесса (user + system)"""
+    with open(f'/proc/{pid}/stat') as f:
+        fields = f.read().rsplit(')', 1)[1].split()
+    return (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK')
+
+
+def deliveries(senders, batch):
+    """Запросы: сообщения каждого отправителя подряд, нарезанные на пачки по batch (свои номера на каждый batch)"""
+    stream = [{'from': f'77{batch:02d}{n:07d}@c.us', 'id': f'{batch}-{n}-{step}', 'timestamp': 1700000000 + step,
+               'text': {'body': text.format(n=n)}}
+              for n in range(senders) for step, text in enumerate(SCRIPT)]
+    return [{'messages': stream[i:i + batch]} for i in range(0, len(stream), batch)]
+
+
+def run_batch(url, pid, stub, senders, batch):
+    # Пачки одного отправителя идут по порядку, разные отправители - параллельно
+    requests_by_sender = {}
+    for payload in deliveries(senders, batch):
+        requests_by_sender.setdefault(payload['messages'][0]['from'], []).append(payload)
+
+    def post_all(payloads):
+        with requests.Session() as session:
+            for payload in payloads:
+                session.post(url + '/webhook', json=payload, timeout=30)
+
+    stub.reset()
+    messages = senders * len(SCRIPT)
+    cpu_before = cpu_seconds(pid)
+    started = time.perf_counter()
+    with ThreadPoolExecutor(16) as pool:
+        list(pool.map(post_all, requests_by_sender.values()))
+    elapsed = time.perf_counter() - started
+    # Ответы отправляются из очереди после ответа на webhook: ждем, пока отправки в waApi прекратятся
+    stub.wait_for('cards', senders, timeout=30)
+    sent = -1
+    while sent != stub.counts['messages']:
+        sent = stub.counts['messages']
+        time.sleep(1)
+    # Процессорное время - вместе с отправкой ответов и карточек
+    cpu = cpu_seconds(pid) - cpu_before
+    requests_count = sum(len(payloads) for payloads in requests_by_sender.values())
+    print(f"{batch:>6}{requests_count:>10}{cpu / messages * 1e6:>18.0f}{elapsed / messages * 1e6:>20.0f}"
+          f"{stub.counts['messages']:>16}{stub.counts['cards']:>10}")
+
+
+def main():
+    senders = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+    mode = sys.argv[2] if len(sys.argv) > 2 else 'flask'
+    batches = [int(size) for size in (sys.argv[3] if len(sys.argv) > 3 else '1,2,4,8').split(',')]
+
+    stub = StubUpstream(latency=0.005).start()
+    tmp_dir = tempfile.mkdtemp(prefix='bench-batch-')
+    process, url = start_bot_server(mode, stub.url, tmp_dir)
+    try:
+        print(f"{senders} отправителей по {len(SCRIPT)} сообщений, режим {mode}")
+        print(f"{'пачка':>6}{'запросов':>10}{'CPU, мкс/сообщ':>18}{'время, мкс/сообщ':>20}"
+              f"{'отправок waApi':>16}{'карточек':>10}")
+        for batch in batches:
+            run_batch(url, process.pid, stub, senders, batch)
+    finally:
+        stop_bot_server(process)
+        stub.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,67 @@
+"""Массовая рассылка через POST /broadcast: устойчивый темп отправки и память сервера бота.
+
+Создает файл с заданным количеством номеров, запускает заглушку waApi и сервер бота с ограничением
+частоты WAAPI_RATE_LIMIT и ждет завершения рассылки. Показывает темп отправки (должен быть близок
+к лимиту) и пиковую память процесса сервера, которая не должна расти с количеством получателей.
+
+Запуск: python benchmarks/bench_broadcast.py [получателей] [сообщений/с] [режим flask|asgi] [задержка заглушки, мс]
+"""
+import os
+import sys
+import tempfile
+import time
+
+import requests
+
+from stubs import StubUpstream, start_bot_server, stop_bot_server
+
+TOKEN = 'bench'
+
+
+def peak_rss_mb(pid):
+    with open(f'/proc/{pid}/status') as f:
+        for line in f:
+            if line.startswith('VmHWM:'):
+                return int(line.split()[1]) / 1024
+    return 0.0
+
+
+def main():
+    recipients = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    rate = float(sys.argv[2]) if len(sys.argv) > 2 else 500
+    mode = sys.argv[3] if len(sys.argv) > 3 else 'flask'
+    latency = float(sys.argv[4]) / 1000 if len(sys.argv) > 4 else 0.02
+
+    tmp_dir = tempfile.mkdtemp(prefix='bench-broadcast-')
+    # Через HTTP доступны только файлы каталога рассылок
+    os.makedirs(os.path.join(tmp_dir, 'broadcasts'))
+    path = os.path.join(tmp_dir, 'broadcasts', 'recipients.csv')
+    with open(path, 'w', encoding='utf-8') as f:
+        for n in range(recipients):
+            f.write(f'+7701{n:07d},{"kz" if n % 3 == 0 else "ru"}\n')
+
+    stub = StubUpstream(latency=latency).start()
+    process, url = start_bot_server(mode, stub.url, tmp_dir, env={
+        'WAAPI_RATE_LIMIT': str(rate), 'WAAPI_RATE_BURST': str(int(rate)), 'BROADCAST_TOKEN': TOKEN,
+        'BROADCAST_DIR': os.path.join(tmp_dir, 'broadcasts'), 'BROADCAST_CONCURRENCY': '32'})
+    headers = {'Authorization': f'Bearer {TOKEN}'}
+    try:
+        print(f"Память сервера до рассылки: {peak_rss_mb(process.pid):.0f} МБ")
+        campaign = requests.post(url + '/broadcast', json={'template': 'new_request', 'file': 'recipients.csv'},
+                                 headers=headers).json()
+        while True:
+            time.sleep(1)
+            stats = requests.get(url + '/broadcast', params={'campaign': campaign['id']}, headers=headers).json()
+            if stats['status'] != 'running':
+                break
+        print(f"Рассылка {stats['status']}: отправлено {stats['sent']}, ошибок {stats['failed']} "
+              f"за {stats['elapsed_s']:.1f} с - {stats['messages_per_s']:.1f} сообщений/с при лимите {rate:.0f}")
+        print(f"Заглушка получила {stub.counts['messages']} сообщений; "
+              f"пиковая память сервера {peak_rss_mb(process.pid):.0f} МБ")
+    finally:
+        stop_bot_server(process)
+        stub.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,101 @@
+"""Ожидание подтверждений доставки: стоимость track() и acknowledge(), память на ожидающее сообщение
+и время, за которое фоновый поток снимает устаревшие корзины.
+
+Отправка и подтверждение выполняются в потоках обработки (отправители очереди и webhook), поэтому их время
+добавляется к каждому сообщению; снятие корзин - только в фоновом потоке. Подтверждается доля сообщений
+(остальные истекают как недоставленные), часть подтверждений не находит сообщения (повторные, после
+перезапуска).
+
+Запуск: python benchmarks/bench_delivery.py [сообщений] [потоков] [доля подтвержденных]
+"""
+import logging
+import os
+import random
+import sys
+import threading
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from delivery import DeliveryTracker, STATUS_DELIVERED, STATUS_READ  # noqa: E402
+
+# Предупреждение о недоставленных в выводе теста не нужно
+logging.getLogger('delivery').setLevel(logging.CRITICAL)
+
+INSTANCES = ('101', '102', '103')
+
+
+def message_ids(count):
+    return [f'true_7700{i:07d}@c.us_3EB0{i:016X}' for i in range(count)]
+
+
+def measure_memory(ids):
+    tracker = DeliveryTracker(ttl=900, bucket_seconds=30, max_pending=len(ids) * 2)
+    tracemalloc.start()
+    baseline = tracemalloc.get_traced_memory()[0]
+    for i, message_id in enumerate(ids):
+        tracker.track(message_id, INSTANCES[i % len(INSTANCES)])
+    used = tracemalloc.get_traced_memory()[0] - baseline
+    tracemalloc.stop()
+    tracker.stop()
+    return used
+
+
+def run_threads(count, threads, target):
+    chunks = [range(n, count, threads) for n in range(threads)]
+    workers = [threading.Thread(target=target, args=(chunk,)) for chunk in chunks]
+    started = time.perf_counter()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    return time.perf_counter() - started
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+    threads = int(sys.argv[2]) if len(sys.argv) > 2 else 8
+    acked_share = float(sys.argv[3]) if len(sys.argv) > 3 else 0.8
+    ids = message_ids(count)
+
+    used = measure_memory(ids)
+    print(f"{count} ожидающих подтверждения: {used / 1024 / 1024:.1f} МБ, {used / count:.0f} байт на сообщение")
+
+    # Короткий ttl, чтобы снятие корзин можно было дождаться
+    tracker = DeliveryTracker(ttl=2, bucket_seconds=1, max_pending=count * 2, alert_min=count)
+
+    def track(chunk):
+        for i in chunk:
+            tracker.track(ids[i], INSTANCES[i % len(INSTANCES)])
+
+    acked = random.sample(range(count), int(count * acked_share))
+    # Часть подтверждений - повторные (прочтение после доставки) и не находят сообщения
+    acks = [(ids[i], STATUS_DELIVERED) for i in acked] + [(ids[i], STATUS_READ) for i in acked[::4]]
+    random.shuffle(acks)
+
+    def acknowledge(chunk):
+        for i in chunk:
+            tracker.acknowledge(*acks[i])
+
+    elapsed = run_threads(count, threads, track)
+    print(f"track():       {elapsed / count * 1e6:6.2f} мкс на сообщение ({threads} потоков, "
+          f"{count / elapsed:,.0f} в секунду)")
+    elapsed = run_threads(len(acks), threads, acknowledge)
+    print(f"acknowledge(): {elapsed / len(acks) * 1e6:6.2f} мкс на подтверждение ({threads} потоков, "
+          f"{len(acks) / elapsed:,.0f} в секунду), без сообщения: {tracker.unmatched.value}")
+
+    # Корзины снимаются здесь, чтобы измерить проход фонового потока
+    tracker.stop()
+    pending = tracker.pending()
+    time.sleep(tracker.ttl + tracker.bucket_seconds * 2)
+    started = time.perf_counter()
+    tracker._expire()
+    elapsed = time.perf_counter() - started
+    undelivered = sum(counter.value for values, counter in tracker.results.items() if values[1] == 'undelivered')
+    print(f"снятие корзин: {pending} ожидающих, {undelivered} учтено недоставленными за {elapsed * 1000:.1f} мс, "
+          f"осталось {tracker.pending()}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,105 @@
+"""Микробенчмарк разбора webhook-запросов: прежний рекурсивный обход и ingest.py.
+
+Запуск: python benchmarks/bench_ingest.py [количество повторов]
+"""
+import json
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import ingest  # noqa: E402
+
+MAX_BYTES = 2 * 1024 * 1024
+MAX_DEPTH = 32
+MAX_NODES = 10000
+
+WAAPI_EVENT = {
+    'event': 'message',
+    'instanceId': '1',
+    'data': {
+        'message': {
+            'id': {'fromMe': False, 'remote': '77011234567@c.us', 'id': '3EB0C767D26A1D6D9A0E', '_serialized': 'false_77011234567@c.us_3EB0C767D26A1D6D9A0E'},
+            'body': 'Русский',
+            'type': 'chat',
+            'timestamp': 1700000000,
+            'from': '77011234567@c.us',
+            'to': '77000000000@c.us',
+            'hasMedia': False,
+        }
+    }
+}
+
+LEGACY = {'messages': [{'from': '77011234567@c.us', 'text': {'body': '1'}, 'timestamp': 1700000000}]}
+
+# Событие с метаданными группы: много участников, поле body глубоко внутри
+GROUP_METADATA = {
+    'event': 'group_update',
+    'data': {
+        'participants': [{'id': {'user': str(77000000000 + i), 'server': 'c.us'}, 'isAdmin': False} for i in range(2000)],
+        'message': {'body': 'Новая заявка', 'from': '77011234567@c.us'},
+    }
+}
+
+# Медиа-сообщение с большим встроенным полем
+MEDIA = {
+    'event': 'message',
+    'data': {
+        'message': {'body': '', 'caption': 'фото', 'from': '77011234567@c.us', 'hasMedia': True},
+        'media': {'mimetype': 'image/jpeg', 'data': 'A' * 1024 * 1024},
+    }
+}
+
+
+def legacy_extract(raw):
+    """Прежний способ: json.loads и рекурсивный обход всего документа"""
+    data = json.loads(raw)
+    if 'event' in data and data.get('event') == 'message' and 'data' in data:
+        message_data = data.get('data', {}).get('message', {})
+        return message_data.get('body', '').strip(), message_data.get('from', '').split('@')[0]
+    if 'messages' in data:
+        message = data['messages'][0]
+        return message['text'].get('body', '').strip(), message.get('from', '').split('@')[0]
+    found = {'body': '', 'from': ''}
+
+    def extract_fields(obj, path=''):
+        if isinstance(obj, dict):
+            for key, value in obj.items():
+                if key == 'body' and isinstance(value, str) and not found['body']:
+                    found['body'] = value.strip()
+                elif key == 'from' and isinstance(value, str) and '@' in value and not found['from']:
+                    found['from'] = value.split('@')[0]
+                elif isinstance(value, (dict, list)):
+                    extract_fields(value, path + '.' + key if path else key)
+        elif isinstance(obj, list):
+            for i, item in enumerate(obj):
+                extract_fields(item, f"{path}[{i}]")
+
+    extract_fields(data)
+    return found['body'], found['from']
+
+
+def new_extract(raw):
+    data = ingest.parse_json(raw, MAX_BYTES)
+    message = ingest.extract_message(data, MAX_DEPTH, MAX_NODES)
+    return message.text, message.phone
+
+
+def main():
+    number = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    import logging
+    logging.disable(logging.WARNING)
+    print(f"orjson: {'да' if ingest.orjson is not None else 'нет'}")
+    print(f"{'payload':<16}{'байт':>10}{'прежний, мкс':>16}{'ingest, мкс':>14}")
+    for name, payload in (('waapi_event', WAAPI_EVENT), ('legacy', LEGACY),
+                          ('group_metadata', GROUP_METADATA), ('media_1mb', MEDIA)):
+        raw = json.dumps(payload, ensure_ascii=False).encode('utf-8')
+        assert legacy_extract(raw)[1] == new_extract(raw)[1]
+        old = min(timeit.repeat(lambda: legacy_extract(raw), number=number, repeat=3)) / number
+        new = min(timeit.repeat(lambda: new_extract(raw), number=number, repeat=3)) / number
+        print(f"{name:<16}{len(raw):>10}{old * 1e6:>16.1f}{new * 1e6:>14.1f}")
+
+
+if __name__ == '__main__':
+    main()
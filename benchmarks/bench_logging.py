@@ -0,0 +1,79 @@
+"""Задержка обработки webhook при разных настройках журнала.
+
+sync  - как раньше: синхронная запись в файл, полное тело каждого запроса
+async - запись через очередь в отдельном потоке, маскирование, тело 1% запросов
+off   - журнал отключен
+
+Запуск: python benchmarks/bench_logging.py [запросов]
+"""
+import logging
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+_tmp_dir = tempfile.mkdtemp(prefix='bench-logging-')
+os.environ['OUTBOX_PATH'] = os.path.join(_tmp_dir, 'outbox.jsonl')
+os.environ['SESSION_BACKEND'] = 'memory'
+os.environ['SESSION_SNAPSHOT_PATH'] = os.path.join(_tmp_dir, 'sessions.snapshot')
+
+import app  # noqa: E402
+import logging_setup  # noqa: E402
+from config import LOG_REDACT_FIELDS  # noqa: E402
+
+
+def run(client, count, offset):
+    latencies = []
+    for i in range(count):
+        phone = str(77000000000 + offset + i)
+        payload = {'event': 'message', 'data': {'message': {
+            'id': {'_serialized': f'bench-{offset + i}'}, 'body': 'Здравствуйте', 'from': f'{phone}@c.us',
+            'timestamp': 1700000000 + i, 'type': 'chat', 'hasMedia': False}}}
+        started = time.perf_counter()
+        client.post('/webhook', json=payload)
+        latencies.append(time.perf_counter() - started)
+    latencies.sort()
+    return latencies
+
+
+def configure(mode, log_file):
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    logging.disable(logging.NOTSET)
+    if mode == 'sync':
+        handler = logging.StreamHandler(log_file)
+        handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s %(name)s %(message)s'))
+        root.addHandler(handler)
+        root.setLevel(logging.INFO)
+        logging_setup._payload_sample_rate = 1.0
+        return None
+    if mode == 'async':
+        return logging_setup.setup_logging(redact_fields=LOG_REDACT_FIELDS, payload_sample_rate=0.01,
+                                           stream=log_file)
+    logging.disable(logging.CRITICAL)
+    return None
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    app.outbound_dispatcher._send_func = lambda phone, message, instance_id=None: {}
+    client = app.app.test_client()
+    run(client, 200, 10 ** 6)  # прогрев
+
+    print(f"{'режим':<8}{'среднее, мкс':>14}{'p50, мкс':>12}{'p99, мкс':>12}")
+    for index, mode in enumerate(('sync', 'async', 'off')):
+        with open(os.path.join(_tmp_dir, f'{mode}.log'), 'w') as log_file:
+            listener = configure(mode, log_file)
+            latencies = run(client, count, index * count)
+            if listener is not None:
+                logging_setup.stop_listener(listener)
+        mean = sum(latencies) / len(latencies)
+        print(f"{mode:<8}{mean * 1e6:>14.1f}{latencies[len(latencies) // 2] * 1e6:>12.1f}"
+              f"{latencies[int(len(latencies) * 0.99)] * 1e6:>12.1f}")
+
+
+if __name__ == '__main__':
+    main()
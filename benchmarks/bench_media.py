@@ -0,0 +1,110 @@
+"""Загрузка фото документов в хранилище и прикрепление к карточкам Trello: скорость и пиковая память.
+
+Заглушка отдает файлы заданного размера частями (содержимое генерируется, а не хранится в памяти)
+и принимает вложения Trello, читая тело частями. Сначала измеряется потоковый режим (media.py),
+затем для сравнения - чтение файлов целиком (response.content и files= в requests).
+Пиковая память процесса (ru_maxrss) только растет, поэтому потоковый режим измеряется первым.
+
+Запуск: python benchmarks/bench_media.py [файлов] [размер_МБ] [потоков]
+"""
+import os
+import resource
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import requests  # noqa: E402
+
+from media import MediaSpool, MediaRef, MultipartFile  # noqa: E402
+from upstream import UpstreamClient  # noqa: E402
+from stubs import StubUpstream, CHUNK  # noqa: E402
+
+
+def peak_rss_mb():
+    # ru_maxrss в килобайтах в Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def run_streaming(base_url, count, size, threads, directory):
+    http = UpstreamClient('bench', pool_size=threads)
+    # Заглушка слушает 127.0.0.1, поэтому адрес явно разрешен для загрузки
+    spool = MediaSpool(directory, chunk_size=CHUNK, max_bytes=size * 2, allowed_hosts=('127.0.0.1',))
+
+    def download(index):
+        return spool.download(http, MediaRef(f'{base_url}/media/{index}', mime_type='image/jpeg'))
+
+    def upload(media_file):
+        body = MultipartFile(spool.path(media_file.sha256), {'name': media_file.filename}, 'file',
+                             media_file.filename, media_file.mime_type, CHUNK)
+        try:
+            response = http.post(f'{base_url}/cards/x/attachments', data=body,
+                                 headers={'Content-Type': body.content_type})
+            return response.status_code
+        finally:
+            body.close()
+
+    with ThreadPoolExecutor(threads) as pool:
+        started = time.perf_counter()
+        files = list(pool.map(download, range(count)))
+        downloaded = time.perf_counter() - started
+        # Повторная загрузка тех же файлов не создает новых копий в хранилище
+        list(pool.map(download, range(min(count, 10))))
+        started = time.perf_counter()
+        list(pool.map(upload, files))
+        uploaded = time.perf_counter() - started
+    return downloaded, uploaded, spool.stats()
+
+
+def run_buffered(base_url, count, size, threads, directory):
+    session = requests.Session()
+
+    def download(index):
+        content = session.get(f'{base_url}/media/{index}').content
+        path = os.path.join(directory, f'buffered-{index}')
+        with open(path, 'wb') as f:
+            f.write(content)
+        return path
+
+    def upload(path):
+        with open(path, 'rb') as f:
+            return session.post(f'{base_url}/cards/x/attachments',
+                                files={'file': (os.path.basename(path), f.read(), 'image/jpeg')}).status_code
+
+    with ThreadPoolExecutor(threads) as pool:
+        started = time.perf_counter()
+        paths = list(pool.map(download, range(count)))
+        downloaded = time.perf_counter() - started
+        started = time.perf_counter()
+        list(pool.map(upload, paths))
+        uploaded = time.perf_counter() - started
+    return downloaded, uploaded
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    size = int(float(sys.argv[2]) * 1024 * 1024) if len(sys.argv) > 2 else 8 * 1024 * 1024
+    threads = int(sys.argv[3]) if len(sys.argv) > 3 else 16
+    total_mb = count * size / 1024 / 1024
+
+    stub = StubUpstream(media_size=size).start()
+    base_url = stub.url
+    directory = tempfile.mkdtemp(prefix='bench-media-')
+    print(f"{count} файлов по {size / 1024 / 1024:.1f} МБ, {threads} потоков")
+    print(f"Память до загрузки: {peak_rss_mb():.0f} МБ")
+
+    downloaded, uploaded, stats = run_streaming(base_url, count, size, threads, directory)
+    print(f"  потоково: загрузка {total_mb / downloaded:7.0f} МБ/с, прикрепление {total_mb / uploaded:7.0f} МБ/с, "
+          f"пиковая память {peak_rss_mb():.0f} МБ")
+    print(f"  хранилище: сохранено {stats['stored']}, повторов {stats['deduplicated']}")
+
+    downloaded, uploaded = run_buffered(base_url, count, size, threads, directory)
+    print(f"   целиком: загрузка {total_mb / downloaded:7.0f} МБ/с, прикрепление {total_mb / uploaded:7.0f} МБ/с, "
+          f"пиковая память {peak_rss_mb():.0f} МБ")
+    stub.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,106 @@
+"""Стоимость сбора метрик: счетчики и гистограммы metrics.py против варианта с блокировкой на каждое обновление.
+
+Показывает время одной операции в одном потоке и при одновременных обновлениях из нескольких потоков,
+стоимость метрик одного webhook-запроса (как в app.py) и время формирования /metrics.
+
+Запуск: python benchmarks/bench_metrics.py [операций] [потоков]
+"""
+import bisect
+import os
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from metrics import Counter, Histogram, Labeled, Registry  # noqa: E402
+
+
+class LockedCounter:
+    """Счетчик с блокировкой на каждое увеличение (прежняя реализация)"""
+
+    def __init__(self):
+        self._value = 0
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self._lock:
+            self._value += amount
+
+
+class LockedHistogram:
+    """Гистограмма с блокировкой на каждое наблюдение (прежняя реализация)"""
+
+    def __init__(self, buckets=Histogram.DEFAULT_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        self._counts = [0] * (len(self.buckets) + 1)
+        self._sum = 0.0
+        self._count = 0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            self._counts[index] += 1
+            self._sum += value
+            self._count += 1
+
+
+def per_op_ns(func, operations, threads):
+    def worker():
+        for _ in range(operations):
+            func()
+
+    workers = [threading.Thread(target=worker) for _ in range(threads)]
+    started = time.perf_counter()
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+    return (time.perf_counter() - started) / (operations * threads) * 1e9
+
+
+def main():
+    operations = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+    threads = int(sys.argv[2]) if len(sys.argv) > 2 else 8
+
+    cases = [
+        ('Counter.inc', Counter().inc, LockedCounter().inc),
+        ('Histogram.observe', lambda h=Histogram(): h.observe(0.042),
+         lambda h=LockedHistogram(): h.observe(0.042)),
+    ]
+    print(f"{'операция':<22}{'потоков':>8}{'metrics.py, нс':>16}{'с блокировкой, нс':>20}")
+    for name, fast, locked in cases:
+        for thread_count in (1, threads):
+            print(f"{name:<22}{thread_count:>8}{per_op_ns(fast, operations, thread_count):>16.0f}"
+                  f"{per_op_ns(locked, operations, thread_count):>20.0f}")
+
+    # Метрики одного webhook-запроса: гистограмма состояния и счетчик результата
+    by_state = {}
+    latency = Labeled(('state',), Histogram)
+    results = Labeled(('result',))
+
+    def webhook_metrics():
+        histogram = by_state.get(3)
+        if histogram is None:
+            histogram = by_state[3] = latency.labels('waiting_for_name')
+        histogram.observe(0.004)
+        results.labels('processed').inc()
+
+    print(f"Метрики webhook-запроса: {per_op_ns(webhook_metrics, operations, 1):.0f} нс")
+
+    # Формирование /metrics: 30 состояний, 10 кодов ответов
+    registry = Registry()
+    registry.register('bot_webhook_duration_seconds', 'histogram', 'Время обработки', latency)
+    registry.register('bot_webhook_requests_total', 'counter', 'Запросы', results)
+    for state in range(30):
+        latency.labels(f'state_{state}').observe(0.01)
+    for status in range(200, 210):
+        results.labels(str(status)).inc()
+    started = time.perf_counter()
+    body = registry.render()
+    print(f"/metrics: {len(body.splitlines())} строк за {(time.perf_counter() - started) * 1000:.2f} мс")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,66 @@
+"""Сравнение синхронного (Flask) и асинхронного (ASGI) режимов при медленном waApi.
+
+Поднимает заглушку waApi/Trello с заданной задержкой ответа, запускает сервер бота в выбранном
+режиме отдельным процессом и отправляет одновременные webhook-запросы. Показывает пропускную
+способность приема, задержки ответов и время, за которое все ответы дошли до waApi.
+
+Запуск: python benchmarks/bench_modes.py [запросов] [параллельно] [задержка_мс]
+"""
+import statistics
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+from stubs import StubUpstream, start_bot_server, stop_bot_server
+
+
+def run_mode(mode, total, concurrency, stub, tmp_dir):
+    stub.reset()
+    process, url = start_bot_server(mode, stub.url, tmp_dir)
+    local = threading.local()
+
+    def post(index):
+        session = getattr(local, 'session', None)
+        if session is None:
+            session = local.session = requests.Session()
+        payload = {'data': {'message': {'body': 'привет', 'from': f'7700{index:07d}@c.us',
+                                        'id': f'bench-{mode}-{index}'}}}
+        started = time.perf_counter()
+        session.post(url + '/webhook', json=payload, timeout=30)
+        return time.perf_counter() - started
+
+    try:
+        started = time.perf_counter()
+        with ThreadPoolExecutor(concurrency) as pool:
+            latencies = sorted(pool.map(post, range(total)))
+        accepted = time.perf_counter() - started
+        stub.wait_for('messages', total)
+        delivered = time.perf_counter() - started
+    finally:
+        stop_bot_server(process)
+
+    print(f"{mode:>6}: прием {total / accepted:8.0f} запр/с, "
+          f"p50 {statistics.median(latencies) * 1000:7.1f} мс, "
+          f"p99 {latencies[int(len(latencies) * 0.99) - 1] * 1000:7.1f} мс, "
+          f"доставлено {stub.counts['messages']}/{total} за {delivered:6.2f} с")
+
+
+def main():
+    total = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    concurrency = int(sys.argv[2]) if len(sys.argv) > 2 else 64
+    latency = (float(sys.argv[3]) if len(sys.argv) > 3 else 200) / 1000
+
+    stub = StubUpstream(latency=latency).start()
+    tmp_dir = tempfile.mkdtemp(prefix='bench-modes-')
+    print(f"{total} сообщений, {concurrency} одновременно, задержка waApi {latency * 1000:.0f} мс")
+    for mode in ('flask', 'asgi'):
+        run_mode(mode, total, concurrency, stub, tmp_dir)
+    stub.stop()
+
+
+if __name__ == '__main__':
+    main()
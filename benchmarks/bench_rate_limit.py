@@ -0,0 +1,71 @@
+"""Ограничение частоты отправки при смешанной нагрузке: массовая рассылка и ответы в диалоге.
+
+Потоки рассылки непрерывно занимают ведро токенов с приоритетом bulk, а ответы в диалоге приходят
+с заданной частотой. Показывает фактический темп отправки и ожидание токена по приоритетам:
+ответы в диалоге не должны ждать за очередью рассылки.
+
+Запуск: python benchmarks/bench_rate_limit.py [сообщений/с] [всплеск] [секунд] [ответов/с]
+"""
+import os
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from rate_limit import TokenBucket, PRIORITY_BULK, PRIORITY_INTERACTIVE  # noqa: E402
+
+
+def percentile(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * q))] if values else 0.0
+
+
+def main():
+    rate = float(sys.argv[1]) if len(sys.argv) > 1 else 50
+    burst = int(sys.argv[2]) if len(sys.argv) > 2 else 10
+    duration = float(sys.argv[3]) if len(sys.argv) > 3 else 10
+    interactive_rate = float(sys.argv[4]) if len(sys.argv) > 4 else 5
+
+    bucket = TokenBucket(rate, burst)
+    waits = {'bulk': [], 'interactive': []}
+    lock = threading.Lock()
+    deadline = time.monotonic() + duration
+
+    def bulk_sender():
+        while time.monotonic() < deadline:
+            wait = bucket.acquire(PRIORITY_BULK)
+            with lock:
+                waits['bulk'].append(wait)
+
+    def interactive_reply():
+        wait = bucket.acquire(PRIORITY_INTERACTIVE)
+        with lock:
+            waits['interactive'].append(wait)
+
+    # Потоков рассылки больше, чем токенов в секунду: очередь bulk не пустеет
+    senders = [threading.Thread(target=bulk_sender, daemon=True) for _ in range(int(rate) + 8)]
+    started = time.monotonic()
+    for thread in senders:
+        thread.start()
+    replies = []
+    while time.monotonic() < deadline:
+        thread = threading.Thread(target=interactive_reply, daemon=True)
+        thread.start()
+        replies.append(thread)
+        time.sleep(1 / interactive_rate)
+    for thread in replies + senders:
+        thread.join()
+    elapsed = time.monotonic() - started
+
+    total = len(waits['bulk']) + len(waits['interactive'])
+    print(f"Лимит {rate:.0f} сообщений/с (всплеск {burst}), фактически {total / elapsed:.1f} сообщений/с "
+          f"за {elapsed:.1f} с")
+    print(f"{'приоритет':<14}{'сообщений':>10}{'p50 мс':>10}{'p99 мс':>10}")
+    for name, values in waits.items():
+        print(f"{name:<14}{len(values):>10}{percentile(values, 0.5) * 1000:>10.1f}"
+              f"{percentile(values, 0.99) * 1000:>10.1f}")
+
+
+if __name__ == '__main__':
+    main()
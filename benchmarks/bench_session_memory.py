@@ -0,0 +1,79 @@
+"""Сравнение памяти на одну сессию: четыре словаря (прежняя схема) и MemorySessionStore.
+
+Запуск: python benchmarks/bench_session_memory.py [количество сессий]
+"""
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from session_store import MemorySessionStore, Session  # noqa: E402
+
+# Типичное распределение: большинство пользователей только выбрали язык, часть завершила заявку
+COMPLETED_DATA = {
+    'name': 'Автосалон Пример',
+    'address': 'г. Алматы, ул. Абая 1',
+    'already_cooperates': 'Да',
+    'id_document': 'фото',
+    'tech_passport': 'фото',
+}
+
+
+def make_phone(i):
+    return str(77000000000 + i)
+
+
+def fill_legacy(count):
+    user_states, user_data, user_types, user_languages = {}, {}, {}, {}
+    for i in range(count):
+        phone = make_phone(i)
+        completed = i % 10 == 0
+        user_states[phone] = 8 if completed else 2
+        user_data[phone] = dict(COMPLETED_DATA) if completed else {}
+        user_types[phone] = 1 if completed else 0
+        user_languages[phone] = 'ru'
+    return user_states, user_data, user_types, user_languages
+
+
+def fill_store(count, **options):
+    store = MemorySessionStore(max_sessions=count * 2, **options)
+    for i in range(count):
+        phone = make_phone(i)
+        completed = i % 10 == 0
+        session = Session(8 if completed else 2, 1 if completed else 0, 'ru',
+                          dict(COMPLETED_DATA) if completed else None)
+        store.save(phone, session)
+    return store
+
+
+def measure(builder, count):
+    tracemalloc.start()
+    baseline = tracemalloc.get_traced_memory()[0]
+    result = builder(count)
+    used = tracemalloc.get_traced_memory()[0] - baseline
+    tracemalloc.stop()
+    return result, used
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+
+    _, legacy_bytes = measure(fill_legacy, count)
+    store, store_bytes = measure(fill_store, count)
+    print(f"Сессий: {count}")
+    print(f"Четыре словаря:     {legacy_bytes / count:8.1f} байт/сессия")
+    print(f"MemorySessionStore: {store_bytes / count:8.1f} байт/сессия")
+    print(f"Оценка store.stats(): {store.stats()['approx_bytes'] / count:8.1f} байт/сессия")
+
+    # Проверка вытеснения: завершенные сессии удаляются по completed_ttl
+    store = fill_store(count, completed_ttl=0.0, completed_states=(8,), sweep_interval=0.0)
+    started = time.perf_counter()
+    store.sweep()
+    elapsed = time.perf_counter() - started
+    print(f"После удаления завершенных: {store.count()} сессий, проход занял {elapsed * 1000:.1f} мс")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,97 @@
+"""Снимок сессий: размер и время записи базового снимка, записи изменений в журнал и восстановления при запуске.
+
+Сессии - как в bench_session_memory.py: большинство пользователей только выбрали язык, каждая десятая
+завершила заявку. После снимка часть сессий меняется и записывается в журнал, затем сессии загружаются
+в новое хранилище, как при перезапуске. Отдельно - цена учета изменений в save() на пути запроса.
+
+Запуск: python benchmarks/bench_session_snapshot.py [количество сессий] [измененных после снимка]
+"""
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from session_snapshot import SessionSnapshot  # noqa: E402
+from session_store import MemorySessionStore, Session  # noqa: E402
+
+COMPLETED_DATA = {
+    'name': 'Автосалон Пример',
+    'address': 'г. Алматы, ул. Абая 1',
+    'already_cooperates': 'Да',
+    'id_document': 'фото',
+    'tech_passport': 'фото',
+}
+
+
+def make_session(i):
+    completed = i % 10 == 0
+    return Session(8 if completed else 2, 1 if completed else 0, 'ru', dict(COMPLETED_DATA) if completed else None)
+
+
+def fill(store, count):
+    for i in range(count):
+        store.save(str(77000000000 + i), make_session(i))
+
+
+def measure_save(count, tracked):
+    store = MemorySessionStore(max_sessions=count * 2)
+    if tracked:
+        store.track_changes()
+    sessions = [make_session(i) for i in range(count)]
+    started = time.perf_counter()
+    for i, session in enumerate(sessions):
+        store.save(str(77000000000 + i), session)
+    return (time.perf_counter() - started) / count * 1e6
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 300000
+    changed = int(sys.argv[2]) if len(sys.argv) > 2 else 10000
+    tmp_dir = tempfile.mkdtemp(prefix='bench-snapshot-')
+    path = os.path.join(tmp_dir, 'sessions.snapshot')
+    try:
+        store = MemorySessionStore(max_sessions=count * 2)
+        snapshot = SessionSnapshot(path, store, compact_ratio=1.0)
+        snapshot.start()
+        snapshot.stop()
+        fill(store, count)
+
+        started = time.perf_counter()
+        # Журнал со всеми сессиями больше пустого снимка: запись сразу сжимается в базовый снимок
+        snapshot.flush()
+        elapsed = time.perf_counter() - started
+        print(f"{count} сессий: снимок {snapshot.stats()['base_bytes'] / 1024 / 1024:.1f} МБ "
+              f"({snapshot.stats()['base_bytes'] / count:.0f} байт на сессию), запись {elapsed * 1000:.0f} мс")
+
+        for i in range(0, changed * 2, 2):
+            session = store.load(str(77000000000 + i))
+            session.state += 1
+            store.save(str(77000000000 + i), session)
+        started = time.perf_counter()
+        written = snapshot.flush()
+        elapsed = time.perf_counter() - started
+        print(f"журнал: {written} измененных сессий, {snapshot.stats()['journal_bytes'] / 1024:.0f} КБ, "
+              f"запись с fsync {elapsed * 1000:.1f} мс")
+
+        restored_store = MemorySessionStore(max_sessions=count * 2)
+        restored = SessionSnapshot(path, restored_store)
+        started = time.perf_counter()
+        restored.restore()
+        elapsed = time.perf_counter() - started
+        sample = str(77000000000 + 2)
+        assert restored_store.count() == count
+        assert restored_store.load(sample).state == store.load(sample).state
+        print(f"восстановление: {restored_store.count()} сессий за {elapsed * 1000:.0f} мс")
+
+        plain = measure_save(min(count, 200000), tracked=False)
+        tracked = measure_save(min(count, 200000), tracked=True)
+        print(f"save(): {plain:.2f} мкс без учета изменений, {tracked:.2f} мкс с учетом")
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
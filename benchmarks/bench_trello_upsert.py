@@ -0,0 +1,87 @@
+"""Повторные заявки с одного номера: новая карточка на каждую заявку (TRELLO_UPSERT=create) против
+обновления (update) или комментария (comment) к карточке номера по индексу номеров.
+
+Каждый номер проходит диалог автосалона и затем оформляет повторные заявки через "9" (Новая заявка).
+У части номеров карточка уже есть в списке до запуска сервера: ее находит сверка индекса с карточками
+списка (один запрос на список). Показывает запросы к Trello по видам и количество карточек-дублей;
+для сравнения приводится расчет для поиска карточки номера запросом к Trello на каждую заявку.
+
+Запуск: python benchmarks/bench_trello_upsert.py [номеров] [заявок на номер] [доля номеров с карточкой]
+"""
+import collections
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+from stubs import StubUpstream, start_bot_server, stop_bot_server
+
+FIRST = ['Здравствуйте', '1', 'автосалон', 'Автосалон {n}', 'ул. Абая, {n}', 'да', 'фото', 'фото']
+REPEAT = ['9', 'автосалон', 'Автосалон {n}', 'ул. Абая, {n}', 'нет', 'фото', 'фото']
+
+
+def run_mode(mode, stub, tmp_dir, phones, repeats, existing):
+    list_id = f'list-{mode}'
+    prefix = {'create': '7703', 'update': '7704', 'comment': '7705'}[mode]
+    numbers = [f'{prefix}{n:07d}' for n in range(phones)]
+    # Карточки, созданные до запуска сервера (например, предыдущей версией бота)
+    for number in numbers[:int(phones * existing)]:
+        stub.add_card(list_id, f'Информация об автосалоне:\nТелефон: {number}\n')
+
+    stub.reset()
+    process, url = start_bot_server('flask', stub.url, tmp_dir, env={
+        'TRELLO_UPSERT': mode, 'TRELLO_LIST_ID': list_id, 'TRELLO_CARD_INDEX_PATH': f'{tmp_dir}/{mode}-cards.db'})
+    try:
+        if mode != 'create':
+            while not requests.get(url + '/stats').json()['trello_cards']['refreshes']:
+                time.sleep(0.1)
+
+        def dialog(n):
+            with requests.Session() as session:
+                script = FIRST + REPEAT * (repeats - 1)
+                for step, text in enumerate(script):
+                    payload = {'messages': [{'from': f'{numbers[n]}@c.us', 'id': f'{mode}-{n}-{step}',
+                                             'text': {'body': text.format(n=n)}}]}
+                    session.post(url + '/webhook', json=payload, timeout=30)
+
+        with ThreadPoolExecutor(16) as pool:
+            list(pool.map(dialog, range(phones)))
+        applications = phones * repeats
+        while stub.counts['cards'] + stub.counts['card_updates'] + stub.counts['comments'] < applications:
+            time.sleep(0.1)
+    finally:
+        stop_bot_server(process)
+
+    per_phone = collections.Counter(card['desc'].split('Телефон: ')[1].split()[0]
+                                    for card in stub.cards.values() if card['idList'] == list_id)
+    duplicates = sum(count - 1 for count in per_phone.values())
+    calls = sum(stub.counts[name] for name in ('cards', 'card_updates', 'comments', 'list_fetches'))
+    print(f"{mode:<10}{applications:>8}{stub.counts['list_fetches']:>10}{stub.counts['cards']:>10}"
+          f"{stub.counts['card_updates']:>12}{stub.counts['comments']:>14}{calls:>10}{duplicates:>10}")
+    return applications
+
+
+def main():
+    phones = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    repeats = int(sys.argv[2]) if len(sys.argv) > 2 else 3
+    existing = float(sys.argv[3]) if len(sys.argv) > 3 else 0.3
+
+    stub = StubUpstream().start()
+    tmp_dir = tempfile.mkdtemp(prefix='bench-trello-upsert-')
+    print(f"{phones} номеров по {repeats} заявки, у {existing:.0%} номеров карточка уже есть в списке")
+    print(f"{'режим':<10}{'заявок':>8}{'выборок':>10}{'создано':>10}{'обновлено':>12}{'комментариев':>14}"
+          f"{'запросов':>10}{'дублей':>10}")
+    try:
+        for mode in ('create', 'update', 'comment'):
+            applications = run_mode(mode, stub, tmp_dir, phones, repeats, existing)
+    finally:
+        stub.stop()
+    # Без индекса каждая заявка сначала ищет карточку номера запросом к Trello, затем создает или обновляет ее
+    print(f"{'поиск':<10}{applications:>8}{applications:>10}{'':>10}{'':>12}{'':>14}{applications * 2:>10}{0:>10}"
+          f"   (расчет: поиск карточки запросом на каждую заявку)")
+
+
+if __name__ == '__main__':
+    main()
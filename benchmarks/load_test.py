@@ -0,0 +1,249 @@
+"""Нагрузочный тест: полные диалоги автосалонов и клиентов через /webhook с заданной частотой.
+
+Запускает заглушки waApi и Trello (stubs.py) и сервер бота в выбранном режиме, затем начинает новые
+диалоги с частотой --rate в секунду независимо от скорости ответов сервера (открытая модель нагрузки).
+Сообщения одного диалога отправляются по очереди. Показывает пропускную способность и задержки
+p50/p95/p99 по состояниям диалога, а также время, за которое ответы и карточки дошли до заглушек.
+
+Примеры:
+    python benchmarks/load_test.py --conversations 500 --rate 50
+    python benchmarks/load_test.py --mode asgi --latency 200 --error-rate 0.02 --media
+    python benchmarks/load_test.py --max-p99 100 --json result.json   # код возврата 1 при превышении
+
+С --url тест отправляет запросы в уже запущенный сервер бота; заглушки тогда запускаются отдельно
+(python benchmarks/stubs.py), и время доставки не измеряется.
+"""
+import argparse
+import itertools
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+from stubs import StubUpstream, start_bot_server, stop_bot_server
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from config import STATES, DEALERSHIP_STATES, CLIENT_STATES  # noqa: E402
+
+# Имена состояний для отчета
+STATE_NAMES = {}
+for _prefix, _states in (('', STATES), ('DEALERSHIP.', DEALERSHIP_STATES), ('CLIENT.', CLIENT_STATES)):
+    for _name, _value in _states.items():
+        STATE_NAMES.setdefault(_value, _prefix + _name)
+
+# Сценарии диалогов: состояние, в котором отправляется сообщение, и текст (None - фото документа)
+DEALERSHIP_SCRIPT = [
+    (STATES['INITIAL'], 'Здравствуйте'),
+    (STATES['WAITING_FOR_LANGUAGE'], '1'),
+    (STATES['WAITING_FOR_USER_TYPE'], 'автосалон'),
+    (DEALERSHIP_STATES['WAITING_FOR_NAME'], 'Автосалон {n}'),
+    (DEALERSHIP_STATES['WAITING_FOR_ADDRESS'], 'ул. Абая, {n}'),
+    (DEALERSHIP_STATES['WAITING_FOR_COOPERATION'], 'да'),
+    (DEALERSHIP_STATES['WAITING_FOR_ID'], None),
+    (DEALERSHIP_STATES['WAITING_FOR_TECHPASSPORT'], None),
+]
+CLIENT_SCRIPT = [
+    (STATES['INITIAL'], 'Здравствуйте'),
+    (STATES['WAITING_FOR_LANGUAGE'], 'рус'),
+    (STATES['WAITING_FOR_USER_TYPE'], 'клиент'),
+    (CLIENT_STATES['WAITING_FOR_CAR_NUMBER'], '{n:03d}ABC02'),
+    (CLIENT_STATES['WAITING_FOR_CITY'], 'Алматы'),
+    (CLIENT_STATES['WAITING_FOR_MILEAGE'], '{n}000'),
+    (CLIENT_STATES['WAITING_FOR_ID'], None),
+    (CLIENT_STATES['WAITING_FOR_TECHPASSPORT'], None),
+]
+
+
+def percentile(values, q):
+    """Перцентиль отсортированного списка"""
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(len(values) * q))]
+
+
+class LoadGenerator:
+    """Отправка диалогов с заданной частотой и сбор задержек по состояниям"""
+
+    def __init__(self, url, rate, conversations, concurrency, think_time=0.0, media_url=None):
+        self.url = url + '/webhook'
+        self.rate = rate
+        self.conversations = conversations
+        self.think_time = think_time
+        self.media_url = media_url
+        self._pool = ThreadPoolExecutor(concurrency)
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._message_ids = itertools.count()
+        self.latencies = defaultdict(list)
+        self.errors = defaultdict(int)
+        self.start_lag = []
+        self.messages = 0
+
+    def _session(self):
+        session = getattr(self._local, 'session', None)
+        if session is None:
+            session = self._local.session = requests.Session()
+        return session
+
+    def _payload(self, phone, n, step, text):
+        message = {'from': f'{phone}@c.us', 'id': f'load-{next(self._message_ids)}', 'timestamp': int(time.time())}
+        if text is None:
+            if self.media_url:
+                message.update(body='', hasMedia=True, mediaUrl=f'{self.media_url}/media/{phone}-{step}')
+            else:
+                message['body'] = f'Документ {n}-{step}'
+        else:
+            message['body'] = text.format(n=n)
+        return {'event': 'message', 'data': {'message': message}}
+
+    def _conversation(self, n, scheduled):
+        self.start_lag.append(time.perf_counter() - scheduled)
+        script = DEALERSHIP_SCRIPT if n % 2 == 0 else CLIENT_SCRIPT
+        phone = f'7700{n:07d}'
+        session = self._session()
+        for step, (state, text) in enumerate(script):
+            payload = self._payload(phone, n, step, text)
+            started = time.perf_counter()
+            try:
+                ok = session.post(self.url, json=payload, timeout=30).status_code == 200
+            except requests.RequestException:
+                ok = False
+            elapsed = time.perf_counter() - started
+            with self._lock:
+                self.messages += 1
+                if ok:
+                    self.latencies[state].append(elapsed)
+                else:
+                    self.errors[state] += 1
+            if self.think_time:
+                time.sleep(self.think_time)
+
+    def run(self):
+        """Запуск всех диалогов, возвращает длительность теста"""
+        started = time.perf_counter()
+        futures = []
+        for n in range(self.conversations):
+            scheduled = started + n / self.rate
+            delay = scheduled - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            futures.append(self._pool.submit(self._conversation, n, scheduled))
+        for future in futures:
+            future.result()
+        self._pool.shutdown()
+        return time.perf_counter() - started
+
+    def report(self, duration):
+        states = {}
+        for state in sorted(set(self.latencies) | set(self.errors)):
+            values = sorted(self.latencies[state])
+            states[STATE_NAMES.get(state, str(state))] = {
+                'count': len(values),
+                'errors': self.errors[state],
+                'p50_ms': percentile(values, 0.50) * 1000,
+                'p95_ms': percentile(values, 0.95) * 1000,
+                'p99_ms': percentile(values, 0.99) * 1000,
+            }
+        all_values = sorted(value for values in self.latencies.values() for value in values)
+        lag = sorted(self.start_lag)
+        return {
+            'conversations': self.conversations,
+            'messages': self.messages,
+            'errors': sum(self.errors.values()),
+            'duration_s': duration,
+            'conversations_per_s': self.conversations / duration,
+            'messages_per_s': self.messages / duration,
+            'p50_ms': percentile(all_values, 0.50) * 1000,
+            'p95_ms': percentile(all_values, 0.95) * 1000,
+            'p99_ms': percentile(all_values, 0.99) * 1000,
+            # Отставание начала диалогов от расписания: растет, если сервер не успевает
+            'start_lag_p99_ms': percentile(lag, 0.99) * 1000,
+            'states': states,
+        }
+
+
+def print_report(result):
+    print(f"Диалогов: {result['conversations']}, сообщений: {result['messages']}, ошибок: {result['errors']}, "
+          f"длительность {result['duration_s']:.1f} с")
+    print(f"Пропускная способность: {result['conversations_per_s']:.1f} диалогов/с, "
+          f"{result['messages_per_s']:.1f} сообщений/с; отставание от расписания p99 "
+          f"{result['start_lag_p99_ms']:.1f} мс")
+    print(f"{'состояние':<34}{'кол-во':>8}{'ошибки':>8}{'p50 мс':>9}{'p95 мс':>9}{'p99 мс':>9}")
+    for name, row in result['states'].items():
+        print(f"{name:<34}{row['count']:>8}{row['errors']:>8}"
+              f"{row['p50_ms']:>9.1f}{row['p95_ms']:>9.1f}{row['p99_ms']:>9.1f}")
+    print(f"{'все':<34}{result['messages'] - result['errors']:>8}{result['errors']:>8}"
+          f"{result['p50_ms']:>9.1f}{result['p95_ms']:>9.1f}{result['p99_ms']:>9.1f}")
+    if 'delivery' in result:
+        delivery = result['delivery']
+        print(f"Заглушки: ответов {delivery['messages']}, карточек {delivery['cards']}, "
+              f"вложений {delivery['attachments']}, ошибок {delivery['errors']}; "
+              f"доставка завершена через {delivery['drain_s']:.2f} с после последнего запроса")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Нагрузочный тест диалогов через /webhook')
+    parser.add_argument('--mode', choices=('flask', 'asgi'), default='flask')
+    parser.add_argument('--url', help='адрес уже запущенного сервера бота')
+    parser.add_argument('--conversations', type=int, default=200)
+    parser.add_argument('--rate', type=float, default=20, help='новых диалогов в секунду')
+    parser.add_argument('--concurrency', type=int, default=64, help='одновременных диалогов')
+    parser.add_argument('--think', type=float, default=0, help='пауза между сообщениями диалога, мс')
+    parser.add_argument('--latency', type=float, default=20, help='задержка ответа заглушек, мс')
+    parser.add_argument('--jitter', type=float, default=0, help='случайная добавка к задержке, мс')
+    parser.add_argument('--error-rate', type=float, default=0, help='доля ответов заглушек с ошибкой 503')
+    parser.add_argument('--media', action='store_true', help='отправлять документы фотографиями')
+    parser.add_argument('--media-size', type=int, default=256, help='размер фото, КБ')
+    parser.add_argument('--json', help='файл для записи результатов')
+    parser.add_argument('--max-p99', type=float, help='допустимая задержка p99 по каждому состоянию, мс')
+    args = parser.parse_args()
+
+    stub = process = None
+    if args.url:
+        url = args.url.rstrip('/')
+    else:
+        stub = StubUpstream(latency=args.latency / 1000, jitter=args.jitter / 1000, error_rate=args.error_rate,
+                            media_size=args.media_size * 1024).start()
+        process, url = start_bot_server(args.mode, stub.url, tempfile.mkdtemp(prefix='load-test-'))
+
+    try:
+        generator = LoadGenerator(url, args.rate, args.conversations, args.concurrency, args.think / 1000,
+                                  media_url=(stub.url if stub else args.url) if args.media else None)
+        duration = generator.run()
+        result = generator.report(duration)
+        result['mode'] = 'external' if args.url else args.mode
+        if stub is not None:
+            # Каждое сообщение сценария получает ответ, каждый диалог завершается заявкой
+            expected = generator.messages - result['errors']
+            drain = stub.wait_for('messages', expected, timeout=60)
+            drain += stub.wait_for('cards', args.conversations, timeout=60)
+            result['delivery'] = dict(stub.counts, drain_s=drain)
+    finally:
+        if process is not None:
+            stop_bot_server(process)
+        if stub is not None:
+            stub.stop()
+
+    print_report(result)
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump(result, f, ensure_ascii=False, indent=2)
+
+    failed = result['errors'] > 0
+    if args.max_p99 is not None:
+        slow = [name for name, row in result['states'].items() if row['p99_ms'] > args.max_p99]
+        if slow:
+            print(f"p99 выше {args.max_p99:.0f} мс: {', '.join(slow)}")
+            failed = True
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,99 @@
+"""Нагрузочная проверка порядка обработки: тысячи чередующихся диалогов через тестовый клиент Flask.
+
+Все сообщения одного диалога отправляются одновременно из разных потоков. Каждое сообщение - "1",
+поэтому диалог автосалона завершается ровно за 8 сообщений при любом порядке их обработки;
+потерянное обновление состояния оставит диалог незавершенным.
+
+Запуск: python benchmarks/stress_ordering.py [диалогов] [потоков] [--unlocked]
+"""
+import logging
+import os
+import sys
+import tempfile
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# Журнал заявок пишется во временный каталог
+_tmp_dir = tempfile.mkdtemp(prefix='stress-')
+os.environ['OUTBOX_PATH'] = os.path.join(_tmp_dir, 'outbox.jsonl')
+os.environ['SESSION_BACKEND'] = 'memory'
+os.environ['SESSION_SNAPSHOT_PATH'] = os.path.join(_tmp_dir, 'sessions.snapshot')
+
+import app  # noqa: E402
+from config import STATES, MESSAGES  # noqa: E402
+
+MESSAGES_PER_DIALOG = 8
+
+
+class _NoLocks:
+    """Замена блокировок для демонстрации гонок"""
+
+    def hold(self, key):
+        return nullcontext()
+
+
+def main():
+    args = [arg for arg in sys.argv[1:] if not arg.startswith('--')]
+    dialogs = int(args[0]) if args else 1000
+    threads = int(args[1]) if len(args) > 1 else 32
+    logging.disable(logging.WARNING)
+
+    replies = defaultdict(list)
+    replies_lock = threading.Lock()
+
+    def record_reply(phone, message, instance_id=None):
+        with replies_lock:
+            replies[phone].append(message)
+        return {}
+
+    app.outbound_dispatcher._send_func = record_reply
+    app.create_trello_card = lambda card: 'stress-card'
+    if '--unlocked' in sys.argv:
+        app.sender_locks = _NoLocks()
+
+    local = threading.local()
+
+    def post(phone, index):
+        client = getattr(local, 'client', None)
+        if client is None:
+            client = local.client = app.app.test_client()
+        payload = {'event': 'message', 'data': {'message': {
+            'id': {'_serialized': f'{phone}-{index}'}, 'body': '1', 'from': f'{phone}@c.us', 'timestamp': index}}}
+        started = time.perf_counter()
+        client.post('/webhook', json=payload)
+        return time.perf_counter() - started
+
+    phones = [str(77000000000 + i) for i in range(dialogs)]
+    # Сообщения одного диалога идут подряд, чтобы они обрабатывались одновременно
+    tasks = [(phone, index) for phone in phones for index in range(MESSAGES_PER_DIALOG)]
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        latencies = list(executor.map(lambda task: post(*task), tasks))
+    elapsed = time.perf_counter() - started
+    app.outbound_dispatcher.shutdown()
+
+    completed = sum(1 for phone in phones if app.get_user_state(phone) == STATES['COMPLETED'])
+    expected_last = MESSAGES['ru']['request_complete'] + '\n\n' + MESSAGES['ru']['new_request']
+    ordered = sum(1 for phone in phones
+                  if len(replies[phone]) == MESSAGES_PER_DIALOG and replies[phone][-1] == expected_last)
+    latencies.sort()
+
+    print(f"Запросов: {len(tasks)} за {elapsed:.2f} с ({len(tasks) / elapsed:.0f} запросов/с), потоков: {threads}")
+    print(f"Задержка p50={latencies[len(latencies) // 2] * 1000:.2f} мс, "
+          f"p99={latencies[int(len(latencies) * 0.99)] * 1000:.2f} мс")
+    print(f"Завершенных диалогов: {completed}/{dialogs}, ответы по порядку: {ordered}/{dialogs}")
+    if not isinstance(app.sender_locks, _NoLocks):
+        stats = app.sender_locks.stats()
+        print(f"Ожидание блокировки (корзины, с): {stats['wait_time']['buckets']}")
+        print(f"Ожидающих впереди: {stats['contention']['buckets']}")
+    sys.exit(0 if completed == dialogs and ordered == dialogs else 1)
+
+
+if __name__ == '__main__':
+    main()
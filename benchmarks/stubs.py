@@ -0,0 +1,266 @@
+"""Локальные заглушки waApi и Trello для нагрузочных тестов.
+
+Заглушка отвечает на отправку сообщения waApi (/instances/<id>/client/action/send-message, в ответе - ID
+сообщения, как у waApi), создание, обновление и комментирование карточки Trello (/cards, /cards/<id>,
+/cards/<id>/actions/comments), прикрепление файла (/cards/<id>/attachments) и выборку карточек списка
+(/lists/<id>/cards), отдает файлы для загрузки (/media/<номер>) и считает запросы. Задержка ответа и доля ошибок задаются параметрами.
+
+Отдельный запуск (например, для сервера бота, запущенного вручную с WAAPI_URL и TRELLO_API_URL):
+    python benchmarks/stubs.py [--port 8081] [--latency 50] [--jitter 20] [--error-rate 0.01]
+"""
+import argparse
+import hashlib
+import itertools
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import threading
+import time
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+CHUNK = 64 * 1024
+
+
+class StubUpstream(ThreadingHTTPServer):
+    """Заглушка waApi и Trello.
+
+    latency и jitter - задержка ответа в секундах, error_rate - доля ответов с кодом error_status,
+    media_size - размер файлов, отдаваемых по /media/<номер>.
+    """
+    daemon_threads = True
+    request_queue_size = 1024
+
+    def __init__(self, port=0, latency=0.0, jitter=0.0, error_rate=0.0, error_status=503,
+                 media_size=256 * 1024):
+        super().__init__(('127.0.0.1', port), _StubHandler)
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.media_size = media_size
+        self.counts = {'messages': 0, 'cards': 0, 'card_updates': 0, 'comments': 0, 'list_fetches': 0,
+                       'attachments': 0, 'media': 0, 'errors': 0}
+        # Созданные карточки: ID -> список и описание (для выборки карточек списка)
+        self.cards = {}
+        self._card_ids = itertools.count(1)
+        # ID отправленных сообщений в порядке отправки (для подтверждений доставки message_ack)
+        self.sent_ids = []
+        self._message_ids = itertools.count(1)
+        self._lock = threading.Lock()
+        self._thread = None
+
+    @property
+    def url(self):
+        return f'http://127.0.0.1:{self.server_port}'
+
+    def count(self, name):
+        with self._lock:
+            self.counts[name] += 1
+
+    def reset(self):
+        with self._lock:
+            for name in self.counts:
+                self.counts[name] = 0
+
+    def start(self):
+        self._thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+    def handle_error(self, request, client_address):
+        # Клиенты закрывают соединения при остановке теста
+        if not isinstance(sys.exc_info()[1], (ConnectionResetError, BrokenPipeError)):
+            super().handle_error(request, client_address)
+
+    def add_card(self, list_id, desc):
+        """Карточка в списке list_id, возвращает ее ID"""
+        with self._lock:
+            card_id = f'stub-card-{next(self._card_ids)}'
+            self.cards[card_id] = {'idList': list_id, 'desc': desc, 'closed': False}
+        return card_id
+
+    def wait_for(self, name, expected, timeout=120):
+        """Ожидание, пока заглушка получит expected запросов вида name, возвращает время ожидания"""
+        started = time.monotonic()
+        while self.counts[name] < expected and time.monotonic() - started < timeout:
+            time.sleep(0.05)
+        return time.monotonic() - started
+
+
+class _StubHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def _delay(self):
+        server = self.server
+        delay = server.latency + (random.uniform(0, server.jitter) if server.jitter else 0)
+        if delay > 0:
+            time.sleep(delay)
+
+    def _send_json(self, status, body):
+        data = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        path = self.path.split('?')[0]
+        if path.startswith('/lists/') and path.endswith('/cards'):
+            self.server.count('list_fetches')
+            list_id = path.split('/')[2]
+            # Новые карточки - наверху списка
+            cards = [{'id': card_id, 'desc': card['desc']}
+                     for card_id, card in reversed(list(self.server.cards.items()))
+                     if card['idList'] == list_id and not card['closed']]
+            self._send_json(200, cards)
+            return
+        if not self.path.startswith('/media/'):
+            self._send_json(404, {'error': 'not found'})
+            return
+        self.server.count('media')
+        # Содержимое зависит от пути, чтобы у разных файлов были разные хеши
+        seed = hashlib.sha256(self.path.encode('utf-8')).digest() * (CHUNK // 32)
+        self.send_response(200)
+        self.send_header('Content-Type', 'image/jpeg')
+        self.send_header('Content-Length', str(self.server.media_size))
+        self.end_headers()
+        remaining = self.server.media_size
+        while remaining:
+            chunk = seed[:min(CHUNK, remaining)]
+            self.wfile.write(chunk)
+            remaining -= len(chunk)
+
+    def do_POST(self):
+        # Тело читается частями и не хранится
+        remaining = int(self.headers.get('Content-Length') or 0)
+        while remaining:
+            remaining -= len(self.rfile.read(min(CHUNK, remaining)))
+        self._delay()
+
+        server = self.server
+        if server.error_rate and random.random() < server.error_rate:
+            server.count('errors')
+            self._send_json(server.error_status, {'error': 'injected'})
+            return
+        path, _, query = self.path.partition('?')
+        if path.endswith('/send-message'):
+            server.count('messages')
+            message_id = f'true_stub@c.us_{next(server._message_ids):016X}'
+            server.sent_ids.append(message_id)
+            self._send_json(200, {'status': 'success', 'data': {'status': 'success',
+                                                                'data': {'id': {'_serialized': message_id}}}})
+        elif path.endswith('/attachments'):
+            server.count('attachments')
+            self._send_json(200, {'id': 'stub-attachment'})
+        elif path.endswith('/actions/comments'):
+            if path.split('/')[2] not in server.cards:
+                self._send_json(404, {'error': 'card not found'})
+                return
+            server.count('comments')
+            card = server.cards[path.split('/')[2]]
+            self._send_json(200, {'id': 'stub-comment', 'data': {'card': {'id': path.split('/')[2]},
+                                                                 'list': {'id': card['idList']}}})
+        elif path.endswith('/cards'):
+            server.count('cards')
+            params = urllib.parse.parse_qs(query)
+            card_id = server.add_card(params.get('idList', [''])[0], params.get('desc', [''])[0])
+            self._send_json(200, {'id': card_id})
+        else:
+            self._send_json(404, {'error': 'not found'})
+
+    def do_PUT(self):
+        self._delay()
+        path, _, query = self.path.partition('?')
+        card = self.server.cards.get(path.rsplit('/', 1)[-1]) if path.startswith('/cards/') else None
+        if card is None:
+            self._send_json(404, {'error': 'card not found'})
+            return
+        self.server.count('card_updates')
+        params = urllib.parse.parse_qs(query)
+        card['desc'] = params.get('desc', [card['desc']])[0]
+        card['idList'] = params.get('idList', [card['idList']])[0]
+        card['closed'] = params.get('closed', ['true' if card['closed'] else 'false'])[0] == 'true'
+        self._send_json(200, {'id': path.rsplit('/', 1)[-1], 'idList': card['idList'], 'closed': card['closed']})
+
+    def log_message(self, format, *args):
+        pass
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def start_bot_server(mode, stub_url, tmp_dir, port=None, env=None):
+    """Запуск сервера бота отдельным процессом: mode - flask или asgi. Возвращает процесс и URL"""
+    port = port or free_port()
+    server_env = dict(os.environ,
+                      WAAPI_URL=stub_url, TRELLO_API_URL=stub_url,
+                      OUTBOX_PATH=os.path.join(tmp_dir, f'{mode}-outbox.jsonl'),
+                      MEDIA_DIR=os.path.join(tmp_dir, 'media'),
+                      BROADCAST_DIR=os.path.join(tmp_dir, 'broadcasts'),
+                      APPLICATIONS_DB_PATH=os.path.join(tmp_dir, f'{mode}-applications.db'),
+                      TRELLO_CARD_INDEX_PATH=os.path.join(tmp_dir, f'{mode}-trello-cards.db'),
+                      SESSION_SNAPSHOT_PATH=os.path.join(tmp_dir, f'{mode}-sessions.snapshot'),
+                      SESSION_BACKEND='memory', LOG_LEVEL='ERROR',
+                      OUTBOUND_QUEUE_SIZE='100000', WAAPI_RATE_LIMIT='0')
+    server_env.update(env or {})
+    if mode == 'flask':
+        code = f"import app; app.app.run(host='127.0.0.1', port={port}, threaded=True)"
+        command = [sys.executable, '-c', code]
+    else:
+        command = [sys.executable, '-m', 'uvicorn', 'asgi:application', '--host', '127.0.0.1',
+                   '--port', str(port), '--log-level', 'error', '--no-access-log']
+    process = subprocess.Popen(command, cwd=ROOT, env=server_env,
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    url = f'http://127.0.0.1:{port}'
+    for _ in range(100):
+        try:
+            requests.get(url + '/', timeout=0.5)
+            return process, url
+        except requests.ConnectionError:
+            time.sleep(0.1)
+    process.kill()
+    raise RuntimeError(f'Сервер {mode} не запустился')
+
+
+def stop_bot_server(process):
+    process.terminate()
+    try:
+        process.wait(10)
+    except subprocess.TimeoutExpired:
+        process.kill()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Заглушки waApi и Trello')
+    parser.add_argument('--port', type=int, default=8081)
+    parser.add_argument('--latency', type=float, default=0, help='задержка ответа, мс')
+    parser.add_argument('--jitter', type=float, default=0, help='случайная добавка к задержке, мс')
+    parser.add_argument('--error-rate', type=float, default=0, help='доля ответов с ошибкой')
+    parser.add_argument('--error-status', type=int, default=503)
+    args = parser.parse_args()
+
+    stub = StubUpstream(args.port, args.latency / 1000, args.jitter / 1000, args.error_rate, args.error_status)
+    print(f"Заглушки waApi и Trello: {stub.url}")
+    try:
+        stub.serve_forever()
+    except KeyboardInterrupt:
+        print(json.dumps(stub.counts))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,362 @@
+import functools
+import json
+import logging
+import os
+import queue
+import re
+import threading
+import time
+import uuid
+
+from metrics import Counter, Labeled
+
+logger = logging.getLogger(__name__)
+
+# Идентификатор рассылки - имя файлов в каталоге рассылок
+CAMPAIGN_ID_RE = re.compile(r'^[A-Za-z0-9_-]{1,64}$')
+
+# Маркер окончания списка получателей для потоков отправки
+_DONE = object()
+
+
+class BroadcastError(ValueError):
+    """Некорректные параметры рассылки"""
+
+
+def normalize_phone(value):
+    """Номер без '+', пробелов и суффикса @c.us или None, если это не номер"""
+    phone = str(value).strip().split('@')[0].replace('+', '').replace(' ', '').replace('-', '')
+    return phone if phone.isdigit() else None
+
+
+def read_recipient_file(path):
+    """Получатели из файла по одному в строке: номер и необязательный язык через запятую или табуляцию.
+
+    Файл читается построчно, поэтому его размер не ограничен. Пустые строки, комментарии (#)
+    и строки без номера (например, заголовок CSV) пропускаются.
+    """
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            parts = re.split(r'[,;\t]', line)
+            phone = normalize_phone(parts[0])
+            if phone is None:
+                continue
+            language = parts[1].strip() if len(parts) > 1 and parts[1].strip() else None
+            yield phone, language
+
+
+class Broadcast:
+    """Рассылка одного шаблона сообщения по списку получателей.
+
+    Получатели читаются из источника по мере отправки через ограниченную очередь, поэтому в памяти
+    находится не весь список, а только номера, уже получившие сообщение. Результат по каждому
+    получателю дописывается в <directory>/<id>.progress, параметры рассылки хранятся в
+    <directory>/<id>.json. При повторном запуске рассылки с тем же идентификатором получатели
+    с отметкой sent пропускаются, остальные получают сообщение.
+    """
+
+    def __init__(self, directory, campaign_id, template, source, recipients, render, send_func,
+                 concurrency=8, progress_interval=10.0, results=None):
+        if not CAMPAIGN_ID_RE.match(campaign_id):
+            raise BroadcastError(f"Недопустимый идентификатор рассылки: {campaign_id}")
+        self.id = campaign_id
+        self.template = template
+        self.source = source
+        self._recipients = recipients
+        self._render = render
+        self._send_func = send_func
+        self._concurrency = max(1, concurrency)
+        self._progress_interval = progress_interval
+        # Общие счетчики результатов всех рассылок процесса (для /metrics)
+        self._results = results
+        self._meta_path = os.path.join(directory, f'{campaign_id}.json')
+        self._progress_path = os.path.join(directory, f'{campaign_id}.progress')
+        self._lock = threading.Lock()
+        self._stop_event = threading.Event()
+
+        self.status = 'created'
+        self.error = None
+        self.created_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self.enqueued = 0
+        self.skipped = 0
+        self.sent = Counter()
+        self.failed = Counter()
+        # Поставленные в очередь, но не отправленные из-за отмены
+        self.abandoned = Counter()
+
+    def _write_meta(self):
+        meta = {
+            'id': self.id,
+            'template': self.template,
+            'source': self.source,
+            'status': self.status,
+            'error': self.error,
+            'created_at': self.created_at,
+            'stats': self.stats(),
+        }
+        tmp_path = self._meta_path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(meta, f, ensure_ascii=False)
+        os.replace(tmp_path, self._meta_path)
+
+    def _load_progress(self):
+        """Номера, уже получившие сообщение в предыдущих запусках"""
+        delivered = set()
+        if not os.path.exists(self._progress_path):
+            return delivered
+        with open(self._progress_path, encoding='utf-8') as f:
+            for line in f:
+                phone, _, status = line.rstrip('\n').partition('\t')
+                if status == 'sent':
+                    delivered.add(phone)
+                else:
+                    delivered.discard(phone)
+        return delivered
+
+    def _worker(self, work_queue, progress):
+        while True:
+            item = work_queue.get()
+            if item is _DONE:
+                return
+            if self._stop_event.is_set():
+                self.abandoned.inc()
+                continue
+            phone, language = item
+            try:
+                ok = self._send_func(phone, self._render(self.template, phone, language)) is not None
+            except Exception as e:
+                logger.error("Рассылка %s: ошибка отправки: %s", self.id, e, exc_info=True)
+                ok = False
+            (self.sent if ok else self.failed).inc()
+            if self._results is not None:
+                self._results.labels('sent' if ok else 'failed').inc()
+            with self._lock:
+                progress.write(f"{phone}\t{'sent' if ok else 'failed'}\n")
+
+    def run(self):
+        """Выполнение рассылки в текущем потоке до конца списка или отмены"""
+        self.status = 'running'
+        self.started_at = time.monotonic()
+        self._write_meta()
+        delivered = self._load_progress()
+        resumed = len(delivered)
+        if resumed:
+            logger.info("Рассылка %s: продолжение, уже отправлено %d", self.id, resumed)
+
+        # Очередь вдвое длиннее числа потоков: чтение источника не опережает отправку
+        work_queue = queue.Queue(maxsize=self._concurrency * 2)
+        progress = open(self._progress_path, 'a', encoding='utf-8', buffering=1)
+        workers = [threading.Thread(target=self._worker, args=(work_queue, progress), name=f'broadcast-{i}',
+                                    daemon=True) for i in range(self._concurrency)]
+        for thread in workers:
+            thread.start()
+        next_report = time.monotonic() + self._progress_interval
+        status = 'failed'
+        try:
+            for phone, language in self._recipients():
+                if self._stop_event.is_set():
+                    break
+                if phone in delivered:
+                    self.skipped += 1
+                    continue
+                # Повторы номера в источнике тоже пропускаются
+                delivered.add(phone)
+                work_queue.put((phone, language))
+                self.enqueued += 1
+                if time.monotonic() >= next_report:
+                    next_report = time.monotonic() + self._progress_interval
+                    self._report()
+            status = 'cancelled' if self._stop_event.is_set() else 'completed'
+        except Exception as e:
+            logger.error("Рассылка %s: ошибка чтения получателей: %s", self.id, e, exc_info=True)
+            self.error = str(e)
+        finally:
+            for _ in workers:
+                work_queue.put(_DONE)
+            for thread in workers:
+                thread.join()
+            progress.flush()
+            os.fsync(progress.fileno())
+            progress.close()
+            # Рассылка завершена, только когда потоки отправили все поставленные в очередь сообщения
+            if self._stop_event.is_set() and status == 'completed':
+                status = 'cancelled'
+            self.status = status
+            self.finished_at = time.monotonic()
+            self._write_meta()
+        self._report()
+        return self.stats()
+
+    def cancel(self):
+        """Остановка рассылки: уже поставленные в очередь сообщения не отправляются"""
+        self._stop_event.set()
+
+    def _report(self):
+        stats = self.stats()
+        logger.info("Рассылка %s (%s): отправлено %d, ошибок %d, пропущено %d, %.1f сообщений/с", self.id, self.status,
+                    stats['sent'], stats['failed'], stats['skipped'], stats['messages_per_s'])
+
+    def stats(self):
+        if self.started_at is None:
+            elapsed = 0.0
+        else:
+            elapsed = (self.finished_at or time.monotonic()) - self.started_at
+        sent = self.sent.value
+        failed = self.failed.value
+        abandoned = self.abandoned.value
+        return {
+            'status': self.status,
+            'enqueued': self.enqueued,
+            'sent': sent,
+            'failed': failed,
+            'skipped': self.skipped,
+            'in_flight': max(0, self.enqueued - sent - failed - abandoned),
+            'elapsed_s': round(elapsed, 3),
+            # Средний темп с начала запуска: при ограничении частоты отправки он близок к лимиту
+            'messages_per_s': round((sent + failed) / elapsed, 2) if elapsed > 0 else 0.0,
+        }
+
+
+class BroadcastManager:
+    """Запуск, продолжение и отмена рассылок в фоновых потоках.
+
+    recipients_func(source) возвращает итератор пар (номер, язык или None) по описанию источника,
+    render(template, phone, language, instance_id) - текст сообщения, send_func(phone, text, instance_id) -
+    отправка (None при ошибке). instance_id - экземпляр waApi рассылки source['instance'] или None.
+    """
+
+    def __init__(self, directory, recipients_func, render, send_func, concurrency=8, progress_interval=10.0):
+        self.directory = directory
+        self._recipients_func = recipients_func
+        self._render = render
+        self._send_func = send_func
+        self._concurrency = concurrency
+        self._progress_interval = progress_interval
+        self._campaigns = {}
+        self._threads = {}
+        self._lock = threading.Lock()
+        self.results = Labeled(('result',))
+        os.makedirs(directory, exist_ok=True)
+
+    def create(self, template, source, campaign_id=None, concurrency=None):
+        """Новая рассылка (или продолжение рассылки campaign_id с теми же параметрами)"""
+        campaign_id = campaign_id or time.strftime('%Y%m%d-%H%M%S-') + uuid.uuid4().hex[:6]
+        # recipients_func проверяет источник сразу, а читает получателей только при обходе итератора
+        self._recipients_func(source)
+        instance_id = source.get('instance')
+        return Broadcast(self.directory, campaign_id, template, source, lambda: self._recipients_func(source),
+                         functools.partial(self._render, instance_id=instance_id),
+                         functools.partial(self._send_func, instance_id=instance_id),
+                         concurrency=concurrency or self._concurrency, progress_interval=self._progress_interval,
+                         results=self.results)
+
+    def load(self, campaign_id):
+        """Рассылка по сохраненным параметрам для продолжения"""
+        if not CAMPAIGN_ID_RE.match(campaign_id):
+            raise BroadcastError(f"Недопустимый идентификатор рассылки: {campaign_id}")
+        path = os.path.join(self.directory, f'{campaign_id}.json')
+        if not os.path.exists(path):
+            raise BroadcastError(f"Рассылка {campaign_id} не найдена")
+        with open(path, encoding='utf-8') as f:
+            meta = json.load(f)
+        return self.create(meta['template'], meta['source'], campaign_id)
+
+    def start(self, broadcast):
+        """Запуск рассылки в фоновом потоке"""
+        with self._lock:
+            running = self._threads.get(broadcast.id)
+            if running is not None and running.is_alive():
+                raise BroadcastError(f"Рассылка {broadcast.id} уже выполняется")
+            self._campaigns[broadcast.id] = broadcast
+            thread = threading.Thread(target=broadcast.run, name=f'broadcast-{broadcast.id}', daemon=True)
+            self._threads[broadcast.id] = thread
+        thread.start()
+        logger.info("Запущена рассылка %s: шаблон %s", broadcast.id, broadcast.template)
+        return broadcast
+
+    def cancel(self, campaign_id):
+        broadcast = self._campaigns.get(campaign_id)
+        if broadcast is None:
+            raise BroadcastError(f"Рассылка {campaign_id} не выполняется")
+        broadcast.cancel()
+        return broadcast
+
+    def shutdown(self, timeout=5.0):
+        """Отмена выполняющихся рассылок: их можно продолжить после перезапуска"""
+        for broadcast in list(self._campaigns.values()):
+            broadcast.cancel()
+        for thread in list(self._threads.values()):
+            thread.join(timeout)
+
+    def get(self, campaign_id):
+        """Показатели рассылки: текущего процесса или сохраненные в каталоге рассылок"""
+        broadcast = self._campaigns.get(campaign_id)
+        if broadcast is not None:
+            return dict(broadcast.stats(), id=broadcast.id, template=broadcast.template)
+        if not CAMPAIGN_ID_RE.match(campaign_id):
+            return None
+        path = os.path.join(self.directory, f'{campaign_id}.json')
+        if not os.path.exists(path):
+            return None
+        with open(path, encoding='utf-8') as f:
+            meta = json.load(f)
+        return dict(meta['stats'], id=meta['id'], template=meta['template'])
+
+    def stats(self):
+        return {campaign_id: dict(broadcast.stats(), template=broadcast.template)
+                for campaign_id, broadcast in list(self._campaigns.items())}
+
+
+def main():
+    """Запуск рассылки из командной строки.
+
+    Примеры:
+        python broadcast.py --template new_request --file numbers.csv
+        python broadcast.py --template new_request --state dealership_completed --state client_completed
+        python broadcast.py --resume 20240101-120000-a1b2c3
+
+    Рассылка выполняется в этом процессе со своим ограничением частоты WAAPI_RATE_LIMIT; чтобы делить
+    лимит с работающим сервером бота, запускайте рассылку через POST /broadcast.
+    """
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Массовая рассылка сообщения из MESSAGES')
+    parser.add_argument('--template', help='ключ сообщения в MESSAGES')
+    parser.add_argument('--file', help='файл с номерами (номер[,язык] в строке)')
+    parser.add_argument('--phone', action='append', dest='phones', help='номер получателя (можно несколько)')
+    parser.add_argument('--state', action='append', dest='states', help='состояние диалога (можно несколько)')
+    parser.add_argument('--instance', help='экземпляр waApi (номер WhatsApp), через который идет рассылка')
+    parser.add_argument('--campaign', help='идентификатор новой рассылки')
+    parser.add_argument('--resume', help='продолжить рассылку с этим идентификатором')
+    parser.add_argument('--concurrency', type=int, help='одновременных отправок')
+    args = parser.parse_args()
+
+    import app as bot
+
+    params = {key: value for key, value in vars(args).items() if value}
+    try:
+        broadcast = bot.broadcasts.start(bot.create_broadcast(params))
+    except BroadcastError as e:
+        parser.error(str(e))
+    try:
+        while broadcast.status in ('created', 'running'):
+            time.sleep(1)
+            stats = broadcast.stats()
+            print(f"\rотправлено {stats['sent']}, ошибок {stats['failed']}, пропущено {stats['skipped']}, "
+                  f"{stats['messages_per_s']:.1f} сообщений/с", end='', flush=True)
+    except KeyboardInterrupt:
+        broadcast.cancel()
+    bot.broadcasts.shutdown(timeout=60)
+    print()
+    print(json.dumps(dict(broadcast.stats(), id=broadcast.id), ensure_ascii=False, indent=2))
+    if broadcast.status != 'completed':
+        print(f"Продолжить: python broadcast.py --resume {broadcast.id}")
+
+
+if __name__ == '__main__':
+    main()
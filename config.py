@@ -14,6 +14,144 @@ TRELLO_API_KEY = os.getenv('TRELLO_API_KEY')
 TRELLO_API_TOKEN = os.getenv('TRELLO_API_TOKEN')
 TRELLO_BOARD_ID = os.getenv('TRELLO_BOARD_ID')
 TRELLO_LIST_ID = os.getenv('TRELLO_LIST_ID')
+TRELLO_API_URL = os.getenv('TRELLO_API_URL', 'https://api.trello.com/1')
+
+# Несколько номеров WhatsApp в одном процессе: экземпляры waApi через запятую, у каждого может быть свой
+# список Trello (экземпляр:список), например 101:5f1a...,102:5f1b... Сообщения без идентификатора экземпляра
+# обрабатываются экземпляром WAAPI_INSTANCE_ID, он обслуживается всегда
+WAAPI_INSTANCES = {WAAPI_INSTANCE_ID: TRELLO_LIST_ID}
+for _item in os.getenv('WAAPI_INSTANCES', '').split(','):
+    _instance_id, _, _list_id = _item.strip().partition(':')
+    if _instance_id:
+        WAAPI_INSTANCES[_instance_id] = _list_id or TRELLO_LIST_ID
+
+# Ограничения на разбор входящих webhook-запросов
+WEBHOOK_MAX_BYTES = int(os.getenv('WEBHOOK_MAX_BYTES', str(2 * 1024 * 1024)))
+WEBHOOK_MAX_DEPTH = int(os.getenv('WEBHOOK_MAX_DEPTH', '32'))
+WEBHOOK_MAX_NODES = int(os.getenv('WEBHOOK_MAX_NODES', '10000'))
+
+# Отбрасывание повторных доставок webhook: memory (в процессе) или sqlite (общее для процессов).
+# По умолчанию sqlite, если сессии хранятся в SQLite: такой бот запускают в нескольких процессах gunicorn
+DEDUP_BACKEND = os.getenv('DEDUP_BACKEND', 'sqlite' if os.getenv('SESSION_BACKEND') == 'sqlite' else 'memory')
+DEDUP_DB_PATH = os.getenv('DEDUP_DB_PATH', os.getenv('SESSION_DB_PATH', 'sessions.db'))
+DEDUP_MAX_SIZE = int(os.getenv('DEDUP_MAX_SIZE', '50000'))
+DEDUP_TTL = float(os.getenv('DEDUP_TTL', '3600'))
+
+# Количество сегментов блокировок по номеру отправителя
+SENDER_LOCK_SHARDS = int(os.getenv('SENDER_LOCK_SHARDS', '256'))
+
+# Допуск webhook-запросов при перегрузке: наибольший и наименьший лимит одновременно обрабатываемых
+# (лимит подстраивается под время обработки; 0 - без ограничения), размер очереди и наибольшее ожидание в ней (с),
+# доля лимита для новых сессий, допустимое замедление обработки (во сколько раз) до уменьшения лимита
+# и Retry-After (с) в ответе 503 на отклоненный запрос
+ADMISSION_MAX_IN_FLIGHT = int(os.getenv('ADMISSION_MAX_IN_FLIGHT', '64'))
+ADMISSION_MIN_IN_FLIGHT = int(os.getenv('ADMISSION_MIN_IN_FLIGHT', '4'))
+ADMISSION_QUEUE_SIZE = int(os.getenv('ADMISSION_QUEUE_SIZE', '128'))
+ADMISSION_QUEUE_TIMEOUT = float(os.getenv('ADMISSION_QUEUE_TIMEOUT', '2'))
+ADMISSION_NEW_SHARE = float(os.getenv('ADMISSION_NEW_SHARE', '0.8'))
+ADMISSION_LATENCY_TOLERANCE = float(os.getenv('ADMISSION_LATENCY_TOLERANCE', '2'))
+ADMISSION_RETRY_AFTER = int(os.getenv('ADMISSION_RETRY_AFTER', '5'))
+
+# HTTP-клиенты внешних сервисов (waApi, Trello)
+HTTP_CONNECT_TIMEOUT = float(os.getenv('HTTP_CONNECT_TIMEOUT', '3.05'))
+HTTP_READ_TIMEOUT = float(os.getenv('HTTP_READ_TIMEOUT', '10'))
+HTTP_MAX_RETRIES = int(os.getenv('HTTP_MAX_RETRIES', '2'))
+HTTP_BACKOFF_BASE = float(os.getenv('HTTP_BACKOFF_BASE', '0.5'))
+HTTP_BACKOFF_MAX = float(os.getenv('HTTP_BACKOFF_MAX', '5'))
+HTTP_POOL_SIZE = int(os.getenv('HTTP_POOL_SIZE', '10'))
+CIRCUIT_FAILURE_THRESHOLD = int(os.getenv('CIRCUIT_FAILURE_THRESHOLD', '5'))
+CIRCUIT_RESET_TIMEOUT = float(os.getenv('CIRCUIT_RESET_TIMEOUT', '30'))
+
+# Журнал заявок для Trello и их повторная отправка
+OUTBOX_PATH = os.getenv('OUTBOX_PATH', 'outbox.jsonl')
+OUTBOX_FSYNC_BATCH = int(os.getenv('OUTBOX_FSYNC_BATCH', '16'))
+OUTBOX_FSYNC_INTERVAL = float(os.getenv('OUTBOX_FSYNC_INTERVAL', '1'))
+OUTBOX_REPLAY_INTERVAL = float(os.getenv('OUTBOX_REPLAY_INTERVAL', '15'))
+OUTBOX_REPLAY_CONCURRENCY = int(os.getenv('OUTBOX_REPLAY_CONCURRENCY', '4'))
+OUTBOX_REPLAY_DELAY = float(os.getenv('OUTBOX_REPLAY_DELAY', '60'))
+OUTBOX_REPLAY_BATCH = int(os.getenv('OUTBOX_REPLAY_BATCH', '500'))
+# Сколько раз Trello может отклонить заявку (400/404/413/422), прежде чем она переносится в <OUTBOX_PATH>.dead
+OUTBOX_MAX_ATTEMPTS = int(os.getenv('OUTBOX_MAX_ATTEMPTS', '5'))
+
+# Повторная заявка с того же номера: create - новая карточка (как раньше), update - обновление карточки
+# этого номера в списке, comment - комментарий к ней. Соответствие номеров карточкам хранится в SQLite
+# и сверяется с карточками списков при запуске и каждые TRELLO_CARD_INDEX_REFRESH секунд
+TRELLO_UPSERT = os.getenv('TRELLO_UPSERT', 'create')
+TRELLO_CARD_INDEX_PATH = os.getenv('TRELLO_CARD_INDEX_PATH', 'trello_cards.db')
+TRELLO_CARD_CACHE_SIZE = int(os.getenv('TRELLO_CARD_CACHE_SIZE', '10000'))
+TRELLO_CARD_INDEX_REFRESH = float(os.getenv('TRELLO_CARD_INDEX_REFRESH', '3600'))
+
+# Очередь исходящих сообщений
+OUTBOUND_QUEUE_SIZE = int(os.getenv('OUTBOUND_QUEUE_SIZE', '1000'))
+OUTBOUND_WORKERS = int(os.getenv('OUTBOUND_WORKERS', '4'))
+OUTBOUND_SHUTDOWN_TIMEOUT = float(os.getenv('OUTBOUND_SHUTDOWN_TIMEOUT', '10'))
+# Ответы на пачку сообщений одного отправителя объединяются в одно сообщение не длиннее (символов)
+REPLY_COALESCE_MAX_CHARS = int(os.getenv('REPLY_COALESCE_MAX_CHARS', '4096'))
+
+# Ограничение частоты отправки через один экземпляр waApi: сообщений в секунду (0 - без ограничения)
+# и допустимый всплеск. Сообщения сверх лимита ждут своей очереди, ответы в диалоге - впереди рассылок и повторов
+WAAPI_RATE_LIMIT = float(os.getenv('WAAPI_RATE_LIMIT', '20'))
+WAAPI_RATE_BURST = int(os.getenv('WAAPI_RATE_BURST', '40'))
+
+# Подтверждения доставки исходящих сообщений (события waApi message_ack): сколько секунд ждать подтверждения
+# (0 - учет отключен), шаг корзин по времени отправки (с), наибольшее число ожидающих подтверждения,
+# доля и наименьшее количество недоставленных через один экземпляр waApi, при которых в журнал пишется ошибка
+DELIVERY_TTL = float(os.getenv('DELIVERY_TTL', '900'))
+DELIVERY_BUCKET_SECONDS = float(os.getenv('DELIVERY_BUCKET_SECONDS', '30'))
+DELIVERY_MAX_PENDING = int(os.getenv('DELIVERY_MAX_PENDING', '200000'))
+DELIVERY_ALERT_RATIO = float(os.getenv('DELIVERY_ALERT_RATIO', '0.2'))
+DELIVERY_ALERT_MIN = int(os.getenv('DELIVERY_ALERT_MIN', '10'))
+
+# Асинхронный режим (asgi.py): количество сопрограмм-отправителей и соединений к каждому сервису
+ASYNC_OUTBOUND_WORKERS = int(os.getenv('ASYNC_OUTBOUND_WORKERS', '256'))
+ASYNC_MAX_CONNECTIONS = int(os.getenv('ASYNC_MAX_CONNECTIONS', '1000'))
+
+# Хранилище сессий диалогов: memory (один процесс) или sqlite (общее для нескольких процессов)
+SESSION_BACKEND = os.getenv('SESSION_BACKEND', 'memory')
+SESSION_DB_PATH = os.getenv('SESSION_DB_PATH', 'sessions.db')
+# Ограничения на количество и время жизни сессий (сек)
+SESSION_MAX_COUNT = int(os.getenv('SESSION_MAX_COUNT', '100000'))
+SESSION_IDLE_TTL = float(os.getenv('SESSION_IDLE_TTL', '604800'))
+SESSION_COMPLETED_TTL = float(os.getenv('SESSION_COMPLETED_TTL', '86400'))
+# Снимок сессий в памяти для восстановления диалогов после перезапуска (только SESSION_BACKEND=memory):
+# файл снимка (пустой - снимок отключен), интервал записи изменений в журнал (с) и размер журнала
+# относительно снимка, после которого пишется новый снимок
+SESSION_SNAPSHOT_PATH = os.getenv('SESSION_SNAPSHOT_PATH', 'sessions.snapshot')
+SESSION_SNAPSHOT_INTERVAL = float(os.getenv('SESSION_SNAPSHOT_INTERVAL', '1'))
+SESSION_SNAPSHOT_COMPACT_RATIO = float(os.getenv('SESSION_SNAPSHOT_COMPACT_RATIO', '1'))
+
+# Журнал: уровень, формат (text или json), маскирование персональных данных
+LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO')
+LOG_FORMAT = os.getenv('LOG_FORMAT', 'text')
+LOG_REDACT = os.getenv('LOG_REDACT', '1') == '1'
+LOG_REDACT_FIELDS = os.getenv('LOG_REDACT_FIELDS', 'body,caption,id_document,tech_passport').split(',')
+# Доля запросов, для которых в журнал записывается полное тело (от 0 до 1)
+LOG_PAYLOAD_SAMPLE_RATE = float(os.getenv('LOG_PAYLOAD_SAMPLE_RATE', '0.01'))
+# Трассировка webhook-запросов по этапам: запросы дольше порога (мс, вместе с отправкой ответа и карточки)
+# записываются в журнал с разбивкой по этапам (0 - трассировка отключена), последние хранятся для /debug/slow
+TRACE_SLOW_MS = float(os.getenv('TRACE_SLOW_MS', '1000'))
+TRACE_SLOW_LOG_SIZE = int(os.getenv('TRACE_SLOW_LOG_SIZE', '100'))
+
+# Файлы из сообщений (фото документов): каталог хранилища, размер части при загрузке, предельный размер
+MEDIA_DIR = os.getenv('MEDIA_DIR', 'media')
+MEDIA_CHUNK_SIZE = int(os.getenv('MEDIA_CHUNK_SIZE', str(64 * 1024)))
+MEDIA_MAX_BYTES = int(os.getenv('MEDIA_MAX_BYTES', str(16 * 1024 * 1024)))
+# Общее время загрузки файла по ссылке (сек) и хосты, с которых, кроме хоста WAAPI_URL, разрешена загрузка
+# (через запятую, ".example.com" - хост и его поддомены)
+MEDIA_DOWNLOAD_TIMEOUT = float(os.getenv('MEDIA_DOWNLOAD_TIMEOUT', '30'))
+MEDIA_ALLOWED_HOSTS = os.getenv('MEDIA_ALLOWED_HOSTS', '').split(',')
+
+# Токен доступа к служебным маршрутам (/applications, /debug); пустой - маршруты отключены
+ADMIN_TOKEN = os.getenv('ADMIN_TOKEN', '')
+
+# Массовые рассылки: каталог с параметрами и ходом рассылок, одновременных отправок,
+# токен доступа к /broadcast (по умолчанию ADMIN_TOKEN, пустой - рассылки через HTTP отключены)
+BROADCAST_DIR = os.getenv('BROADCAST_DIR', 'broadcasts')
+BROADCAST_CONCURRENCY = int(os.getenv('BROADCAST_CONCURRENCY', '8'))
+BROADCAST_TOKEN = os.getenv('BROADCAST_TOKEN', ADMIN_TOKEN)
+
+# Хранилище заявок для поиска и выгрузки (SQLite)
+APPLICATIONS_DB_PATH = os.getenv('APPLICATIONS_DB_PATH', 'applications.db')
 
 # Доступные языки
 LANGUAGES = {
@@ -61,6 +199,101 @@ CLIENT_STATES = {
     'COMPLETED': 25
 }
 
+# Сопоставление ответов с ключевыми словами: exact - точное совпадение без учета регистра, normalized - без
+# знаков препинания, эмодзи и различий казахских и русских букв, fuzzy - еще с опечатками и по началу слова
+ANSWER_MATCHING = os.getenv('ANSWER_MATCHING', 'normalized')
+
+# Ключевые слова для ответов пользователя
+LANGUAGE_RU_KEYWORDS = ['рус', 'русский', 'орысша', 'ru', 'rus', '1', '1️⃣']
+LANGUAGE_KZ_KEYWORDS = ['каз', 'қаз', 'казахский', 'қазақша', 'кз', 'kaz', 'kz', 'qazaq', '2', '2️⃣']
+DEALERSHIP_KEYWORDS = ['автосалон', '1', '1️⃣']
+CLIENT_KEYWORDS = ['клиент', '2', '2️⃣']
+YES_KEYWORDS = ['да', 'yes', 'иә', 'иа', '1', '1️⃣']
+NEW_REQUEST_KEYWORDS = ['новая заявка', 'жаңа өтінім', '9', '9️⃣']
+
+# Описание диалога. Для каждого состояния:
+#   field    - поле, в которое сохраняется ответ пользователя
+#   choices  - варианты ответа: keywords (ключевые слова) и действия при совпадении
+#   default  - действия, если ответ не совпал ни с одним вариантом (без default сообщение игнорируется)
+#   prompt   - ключ (или список ключей) сообщения из MESSAGES, которое отправляется в ответ
+#   next     - следующее состояние
+#   media    - в состоянии принимается файл (фото документа), он прикрепляется к карточке Trello
+# Действия варианта: value (значение для field), language, user_type, reset_data (сброс собранных данных),
+# submit (отправка заявки в Trello), prompt_language (язык ответа независимо от выбора пользователя).
+# Значения, не указанные в варианте, берутся из описания состояния.
+DIALOG_FLOW = {
+    STATES['INITIAL']: {
+        'default': {'prompt': 'choose_language', 'prompt_language': LANGUAGES['RU'],
+                    'next': STATES['WAITING_FOR_LANGUAGE']}
+    },
+    STATES['WAITING_FOR_LANGUAGE']: {
+        'prompt': 'select_user_type',
+        'next': STATES['WAITING_FOR_USER_TYPE'],
+        'choices': [
+            {'keywords': LANGUAGE_RU_KEYWORDS, 'language': LANGUAGES['RU']},
+            {'keywords': LANGUAGE_KZ_KEYWORDS, 'language': LANGUAGES['KZ']}
+        ],
+        'default': {'prompt': 'invalid_language', 'prompt_language': LANGUAGES['RU'], 'next': None}
+    },
+    STATES['WAITING_FOR_USER_TYPE']: {
+        'choices': [
+            {'keywords': DEALERSHIP_KEYWORDS, 'user_type': USER_TYPES['DEALERSHIP'],
+             'prompt': 'dealership_name', 'next': DEALERSHIP_STATES['WAITING_FOR_NAME']},
+            {'keywords': CLIENT_KEYWORDS, 'user_type': USER_TYPES['CLIENT'],
+             'prompt': 'client_car_number', 'next': CLIENT_STATES['WAITING_FOR_CAR_NUMBER']}
+        ],
+        'default': {'prompt': 'invalid_user_type', 'next': None}
+    },
+
+    # Автосалон
+    DEALERSHIP_STATES['WAITING_FOR_NAME']: {
+        'field': 'name', 'prompt': 'dealership_address', 'next': DEALERSHIP_STATES['WAITING_FOR_ADDRESS']
+    },
+    DEALERSHIP_STATES['WAITING_FOR_ADDRESS']: {
+        'field': 'address', 'prompt': 'dealership_cooperation', 'next': DEALERSHIP_STATES['WAITING_FOR_COOPERATION']
+    },
+    DEALERSHIP_STATES['WAITING_FOR_COOPERATION']: {
+        'field': 'already_cooperates',
+        'prompt': 'dealership_id',
+        'next': DEALERSHIP_STATES['WAITING_FOR_ID'],
+        'choices': [{'keywords': YES_KEYWORDS, 'value': 'Да'}],
+        'default': {'value': 'Нет'}
+    },
+    DEALERSHIP_STATES['WAITING_FOR_ID']: {
+        'field': 'id_document', 'media': True, 'prompt': 'dealership_techpassport', 'next': DEALERSHIP_STATES['WAITING_FOR_TECHPASSPORT']
+    },
+    DEALERSHIP_STATES['WAITING_FOR_TECHPASSPORT']: {
+        'field': 'tech_passport', 'media': True, 'prompt': ['request_complete', 'new_request'], 'next': STATES['COMPLETED'],
+        'submit': True
+    },
+
+    # Клиент
+    CLIENT_STATES['WAITING_FOR_CAR_NUMBER']: {
+        'field': 'car_number', 'prompt': 'client_city', 'next': CLIENT_STATES['WAITING_FOR_CITY']
+    },
+    CLIENT_STATES['WAITING_FOR_CITY']: {
+        'field': 'city', 'prompt': 'client_mileage', 'next': CLIENT_STATES['WAITING_FOR_MILEAGE']
+    },
+    CLIENT_STATES['WAITING_FOR_MILEAGE']: {
+        'field': 'mileage', 'prompt': 'client_id', 'next': CLIENT_STATES['WAITING_FOR_ID']
+    },
+    CLIENT_STATES['WAITING_FOR_ID']: {
+        'field': 'id_document', 'media': True, 'prompt': 'client_techpassport', 'next': CLIENT_STATES['WAITING_FOR_TECHPASSPORT']
+    },
+    CLIENT_STATES['WAITING_FOR_TECHPASSPORT']: {
+        'field': 'tech_passport', 'media': True, 'prompt': ['request_complete', 'new_request'], 'next': STATES['COMPLETED'],
+        'submit': True
+    },
+
+    # Заявка завершена: отвечаем только на запрос новой заявки, выбранный язык сохраняется
+    STATES['COMPLETED']: {
+        'choices': [
+            {'keywords': NEW_REQUEST_KEYWORDS, 'reset_data': True, 'prompt': 'select_user_type',
+             'next': STATES['WAITING_FOR_USER_TYPE']}
+        ]
+    }
+}
+
 # Тексты на разных языках
 MESSAGES = {
     'ru': {
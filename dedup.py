@@ -0,0 +1,149 @@
+import hashlib
+import itertools
+import logging
+import sqlite3
+import sys
+import threading
+import time
+
+from metrics import Counter
+
+logger = logging.getLogger(__name__)
+
+
+def message_key(message):
+    """Ключ для поиска повторных доставок.
+
+    Используется идентификатор сообщения waApi, а без него - хеш отправителя, текста и времени.
+    Если нет ни идентификатора, ни времени, сообщение не проверяется (возвращается None).
+    """
+    if message.message_id:
+        source = f"id:{message.message_id}"
+    elif message.timestamp:
+        source = f"hash:{message.phone}|{message.text}|{message.timestamp}"
+    else:
+        return None
+    if message.instance:
+        # Сообщения разных экземпляров waApi (номеров WhatsApp) не считаются повторами друг друга
+        source = f"{message.instance}|{source}"
+    # Ключи хранятся как 16-байтовые дайджесты, чтобы размер записи не зависел от длины идентификатора
+    return hashlib.blake2b(source.encode('utf-8'), digest_size=16).digest()
+
+
+class SQLiteDedupStore:
+    """Общая для нескольких процессов таблица обработанных сообщений"""
+
+    def __init__(self, path, ttl, busy_timeout_ms=5000):
+        self.path = path
+        self._ttl = ttl
+        self._busy_timeout_ms = busy_timeout_ms
+        self._local = threading.local()
+        self._next_purge = 0.0
+        conn = self._connection()
+        conn.execute('CREATE TABLE IF NOT EXISTS seen_messages (key BLOB PRIMARY KEY, seen_at REAL NOT NULL)')
+        conn.execute('CREATE INDEX IF NOT EXISTS seen_messages_seen_at ON seen_messages (seen_at)')
+        conn.commit()
+
+    def _connection(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=self._busy_timeout_ms / 1000.0)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+        return conn
+
+    def add(self, key):
+        """Запись ключа, возвращает False, если ключ уже был записан"""
+        now = time.time()
+        conn = self._connection()
+        if now >= self._next_purge:
+            self._next_purge = now + self._ttl
+            conn.execute('DELETE FROM seen_messages WHERE seen_at < ?', (now - self._ttl,))
+        cursor = conn.execute('INSERT OR IGNORE INTO seen_messages (key, seen_at) VALUES (?, ?)', (key, now))
+        conn.commit()
+        return cursor.rowcount == 1
+
+    def discard(self, keys):
+        """Удаление записанных ключей"""
+        conn = self._connection()
+        conn.executemany('DELETE FROM seen_messages WHERE key = ?', [(key,) for key in keys])
+        conn.commit()
+
+
+class DedupCache:
+    """Ограниченный по размеру и времени жизни набор ключей обработанных сообщений"""
+
+    def __init__(self, max_size=50000, ttl=3600.0, shared=None):
+        self._entries = {}
+        self._lock = threading.Lock()
+        self._max_size = max_size
+        self._ttl = ttl
+        self._shared = shared
+        self.hits = Counter()
+        self.misses = Counter()
+
+    def _expire_locked(self, now):
+        # Время жизни одинаково для всех ключей, поэтому порядок вставки совпадает с порядком истечения
+        expired = 0
+        for key, expires_at in self._entries.items():
+            if expires_at > now:
+                break
+            expired += 1
+        for key in list(itertools.islice(self._entries, expired)):
+            del self._entries[key]
+
+    def seen(self, key):
+        """Проверка и запись ключа. True - сообщение уже обрабатывалось"""
+        if key is None:
+            return False
+        now = time.monotonic()
+        with self._lock:
+            expires_at = self._entries.get(key)
+            if expires_at is not None and expires_at > now:
+                self.hits.inc()
+                return True
+            self._entries.pop(key, None)
+            self._entries[key] = now + self._ttl
+            if len(self._entries) > self._max_size:
+                del self._entries[next(iter(self._entries))]
+            self._expire_locked(now)
+        if self._shared is not None:
+            try:
+                if not self._shared.add(key):
+                    # Сообщение уже обработал другой процесс
+                    self.hits.inc()
+                    return True
+            except sqlite3.Error as e:
+                logger.error("Ошибка общего хранилища обработанных сообщений: %s", e)
+        self.misses.inc()
+        return False
+
+    def forget(self, keys):
+        """Снятие отметок с сообщений, обработка которых не завершилась: повторная доставка обработается заново"""
+        keys = [key for key in keys if key is not None]
+        if not keys:
+            return
+        with self._lock:
+            for key in keys:
+                self._entries.pop(key, None)
+        if self._shared is not None:
+            try:
+                self._shared.discard(keys)
+            except sqlite3.Error as e:
+                logger.error("Ошибка общего хранилища обработанных сообщений: %s", e)
+
+    def stats(self):
+        hits = self.hits.value
+        total = hits + self.misses.value
+        size = len(self._entries)
+        # Ключ (bytes 16) + время истечения (float) + запись словаря
+        entry_bytes = sys.getsizeof(b'\0' * 16) + sys.getsizeof(0.0)
+        return {
+            'size': size,
+            'capacity': self._max_size,
+            'hits': hits,
+            'misses': self.misses.value,
+            'hit_rate': hits / total if total else 0.0,
+            'approx_bytes': sys.getsizeof(self._entries) + size * entry_bytes,
+        }
@@ -0,0 +1,241 @@
+import contextvars
+import logging
+import threading
+import time
+
+from metrics import Counter, Histogram, Labeled
+
+logger = logging.getLogger(__name__)
+
+# Статусы доставки исходящего сообщения (ack в событиях waApi: -1 ... 4)
+STATUS_FAILED = 'failed'
+STATUS_PENDING = 'pending'
+STATUS_SENT = 'sent'
+STATUS_DELIVERED = 'delivered'
+STATUS_READ = 'read'
+STATUS_PLAYED = 'played'
+ACK_STATUSES = {-1: STATUS_FAILED, 0: STATUS_PENDING, 1: STATUS_SENT, 2: STATUS_DELIVERED, 3: STATUS_READ,
+                4: STATUS_PLAYED}
+# Статусы, означающие, что сообщение дошло до получателя (прочитанное доставлено, даже если
+# подтверждение доставки не пришло или пришло позже)
+DELIVERED_STATUSES = frozenset((STATUS_DELIVERED, STATUS_READ, STATUS_PLAYED))
+# Итоги ожидания подтверждения (для метрики bot_delivery_results_total)
+DELIVERY_RESULTS = ('delivered', 'failed', 'undelivered', 'evicted')
+
+# Границы гистограмм доставки: от долей секунды до получателя в сети до минут для телефона без связи
+DELIVERY_BUCKETS = (0.25, 0.5, 1.0, 2.0, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0, 900.0)
+
+# Время получения webhook-запроса, на который отвечает сообщение (переносится в очередь отправки вместе
+# с контекстом); у сообщений рассылок его нет
+_inbound_received = contextvars.ContextVar('inbound_received', default=None)
+
+
+def mark_inbound():
+    """Отметка о получении webhook-запроса: ответы на него учитываются в задержке от входящего до доставки"""
+    _inbound_received.set(time.monotonic())
+
+
+class _Bucket:
+    __slots__ = ('epoch', 'pending', 'tracked', 'failed')
+
+    def __init__(self, epoch):
+        self.epoch = epoch
+        # ID сообщения -> (время отправки, время входящего запроса или None, экземпляр waApi)
+        self.pending = {}
+        # Отправлено и не доставлено с ошибкой по экземплярам (для доли недоставленных)
+        self.tracked = {}
+        self.failed = {}
+
+
+class DeliveryTracker:
+    """Ожидающие подтверждения доставки исходящие сообщения по ID, который вернул waApi.
+
+    Сообщения раскладываются по корзинам времени отправки (bucket_seconds) в кольце, покрывающем ttl:
+    подтверждение ищется в корзинах от новых к старым, а корзина старше ttl целиком снимается фоновым
+    потоком, и ее сообщения считаются недоставленными. Отправка и подтверждение - несколько обращений
+    к словарю под блокировкой, устаревшие корзины разбираются только в фоновом потоке. При max_pending
+    ожидающих самая старая корзина снимается досрочно (evicted).
+
+    Итоги ожидания копятся по экземплярам waApi, пока отправленных не наберется alert_min / alert_ratio:
+    если не доставлено (нет подтверждения или ошибка) не меньше alert_min и не меньше alert_ratio из них,
+    в журнал пишется ошибка (номер мог быть заблокирован или отключен).
+    ttl <= 0 отключает учет.
+    """
+
+    def __init__(self, ttl=900.0, bucket_seconds=30.0, max_pending=200000, alert_ratio=0.2, alert_min=10):
+        self.enabled = ttl > 0
+        self.ttl = ttl
+        self.bucket_seconds = max(1.0, bucket_seconds)
+        self.max_pending = max(1, max_pending)
+        self.alert_ratio = alert_ratio
+        self.alert_min = alert_min
+        # Корзины, покрывающие ttl, и еще одна - текущая, заполняемая
+        self._buckets = [_Bucket(-1) for _ in range(int(-(-ttl // self.bucket_seconds)) + 1 if ttl > 0 else 1)]
+        self._pending = 0
+        self._expired = []
+        # Экземпляр waApi -> [не доставлено, отправлено] с последней проверки
+        self._alert_window = {}
+        self._alert_sent = max(1, int(-(-alert_min // alert_ratio))) if alert_ratio > 0 else alert_min
+        self._lock = threading.Lock()
+        self._stop_event = threading.Event()
+        self._thread = None
+
+        self.acks = Labeled(('status',))
+        self.unmatched = Counter()
+        self.untracked = Counter()
+        self.results = Labeled(('instance', 'result'))
+        self.reply_latency = Histogram(DELIVERY_BUCKETS)
+        self.delivery_latency = Histogram(DELIVERY_BUCKETS)
+        self.alerts = Counter()
+        self.last_alert = None
+
+    def _epoch(self, now):
+        return int(now // self.bucket_seconds)
+
+    def track(self, message_id, instance_id):
+        """Сообщение отправлено через экземпляр instance_id, waApi вернул message_id"""
+        if not self.enabled or not message_id:
+            return
+        if self._thread is None:
+            self.start()
+        now = time.monotonic()
+        epoch = self._epoch(now)
+        entry = (now, _inbound_received.get(), instance_id)
+        with self._lock:
+            bucket = self._buckets[epoch % len(self._buckets)]
+            if bucket.epoch != epoch:
+                # Фоновый поток еще не снял корзину, занимавшую это место в кольце
+                bucket = self._retire(epoch % len(self._buckets), epoch)
+            if self._pending >= self.max_pending and not self._evict_oldest(epoch):
+                # Все ожидающие отправлены в текущей корзине
+                self.untracked.inc()
+                return
+            if message_id not in bucket.pending:
+                self._pending += 1
+            bucket.pending[message_id] = entry
+            bucket.tracked[instance_id] = bucket.tracked.get(instance_id, 0) + 1
+
+    def _retire(self, index, epoch):
+        """Замена корзины в кольце новой; старая передается фоновому потоку"""
+        old = self._buckets[index]
+        if old.pending or old.tracked:
+            self._pending -= len(old.pending)
+            self._expired.append((old, 'undelivered'))
+        bucket = self._buckets[index] = _Bucket(epoch)
+        return bucket
+
+    def _evict_oldest(self, epoch):
+        """Досрочное снятие самой старой непустой корзины, кроме текущей"""
+        for age in range(len(self._buckets) - 1, 0, -1):
+            index = (epoch - age) % len(self._buckets)
+            old = self._buckets[index]
+            if old.pending:
+                self._pending -= len(old.pending)
+                self._expired.append((old, 'evicted'))
+                self._buckets[index] = _Bucket(old.epoch)
+                return True
+        return False
+
+    def acknowledge(self, message_id, status):
+        """Подтверждение статуса сообщения из события waApi"""
+        self.acks.labels(status).inc()
+        if not self.enabled or not message_id or (status not in DELIVERED_STATUSES and status != STATUS_FAILED):
+            return
+        now = time.monotonic()
+        epoch = self._epoch(now)
+        entry = None
+        with self._lock:
+            buckets = self._buckets
+            for age in range(len(buckets)):
+                bucket = buckets[(epoch - age) % len(buckets)]
+                entry = bucket.pending.pop(message_id, None)
+                if entry is not None:
+                    self._pending -= 1
+                    if status == STATUS_FAILED:
+                        bucket.failed[entry[2]] = bucket.failed.get(entry[2], 0) + 1
+                    break
+        if entry is None:
+            # Подтверждение уже учтено (прочтение после доставки), сообщение отправлено другим процессом
+            # или до перезапуска, или ожидание истекло
+            self.unmatched.inc()
+            return
+        sent_at, received_at, instance_id = entry
+        if status == STATUS_FAILED:
+            self.results.labels(instance_id, 'failed').inc()
+            return
+        self.results.labels(instance_id, 'delivered').inc()
+        self.delivery_latency.observe(now - sent_at)
+        if received_at is not None:
+            self.reply_latency.observe(now - received_at)
+
+    def _expire(self):
+        epoch = self._epoch(time.monotonic())
+        with self._lock:
+            for index, bucket in enumerate(self._buckets):
+                if bucket.epoch <= epoch - len(self._buckets) + 1 and (bucket.pending or bucket.tracked):
+                    self._retire(index, bucket.epoch)
+            expired, self._expired = self._expired, []
+        for bucket, result in expired:
+            undelivered = {}
+            for _, _, instance_id in bucket.pending.values():
+                undelivered[instance_id] = undelivered.get(instance_id, 0) + 1
+            for instance_id, count in undelivered.items():
+                self.results.labels(instance_id, result).inc(count)
+            if result == 'evicted':
+                logger.warning("Ожидающих подтверждения больше %d: %d самых старых сообщений сняты с учета",
+                               self.max_pending, len(bucket.pending))
+                continue
+            for instance_id, sent in bucket.tracked.items():
+                failed = undelivered.get(instance_id, 0) + bucket.failed.get(instance_id, 0)
+                self._check_alert(instance_id, failed, sent)
+
+    def _check_alert(self, instance_id, undelivered, sent):
+        window = self._alert_window.setdefault(instance_id, [0, 0])
+        window[0] += undelivered
+        window[1] += sent
+        if window[1] < self._alert_sent:
+            return
+        undelivered, sent = window
+        del self._alert_window[instance_id]
+        if undelivered >= self.alert_min and undelivered >= sent * self.alert_ratio:
+            self.alerts.inc()
+            self.last_alert = {'time': time.time(), 'instance': instance_id, 'undelivered': undelivered, 'sent': sent}
+            logger.error("Не доставлено %d из %d сообщений, отправленных через экземпляр waApi %s: "
+                         "проверьте состояние номера", undelivered, sent, instance_id)
+
+    def _run(self):
+        while not self._stop_event.wait(self.bucket_seconds):
+            try:
+                self._expire()
+            except Exception as e:
+                logger.error("Ошибка при разборе устаревших подтверждений доставки: %s", e, exc_info=True)
+
+    def start(self):
+        """Запуск фонового потока, снимающего устаревшие корзины (выполняется лениво при первой отправке)"""
+        with self._lock:
+            if self._thread is not None or not self.enabled:
+                return
+            self._thread = threading.Thread(target=self._run, name='delivery-tracker', daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop_event.set()
+
+    def pending(self):
+        return self._pending
+
+    def stats(self):
+        return {
+            'enabled': self.enabled,
+            'pending': self._pending,
+            'max_pending': self.max_pending,
+            'ttl': self.ttl,
+            'acks': {values[0]: counter.value for values, counter in self.acks.items()},
+            'unmatched_acks': self.unmatched.value,
+            'untracked': self.untracked.value,
+            'results': {f'{values[0]}:{values[1]}': counter.value for values, counter in self.results.items()},
+            'reply_latency': self.reply_latency.snapshot(),
+            'delivery_latency': self.delivery_latency.snapshot(),
+            'alerts': self.alerts.value,
+            'last_alert': self.last_alert,
+        }
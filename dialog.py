@@ -0,0 +1,131 @@
+import logging
+
+from matching import AnswerIndex
+
+logger = logging.getLogger(__name__)
+
+# Действия, которые вариант ответа может переопределить у состояния
+STEP_KEYS = ('field', 'value', 'prompt', 'prompt_language', 'next', 'language', 'user_type', 'reset_data', 'submit')
+
+
+class Step:
+    """Скомпилированное действие: что сохранить, что ответить и куда перейти"""
+
+    __slots__ = ('field', 'value', 'replies', 'next_state', 'language', 'user_type', 'reset_data', 'submit')
+
+    def __init__(self, spec, messages, default_language):
+        self.field = spec.get('field')
+        self.value = spec.get('value')
+        self.next_state = spec.get('next')
+        self.language = spec.get('language')
+        self.user_type = spec.get('user_type')
+        self.reset_data = bool(spec.get('reset_data'))
+        self.submit = bool(spec.get('submit'))
+        self.replies = self._compile_replies(spec.get('prompt'), spec.get('prompt_language'), messages, default_language)
+
+    @staticmethod
+    def _compile_replies(prompt, prompt_language, messages, default_language):
+        """Готовые тексты ответа для каждого языка.
+
+        Если сообщения нет на выбранном языке, используется язык по умолчанию.
+        """
+        if not prompt:
+            return None
+        keys = [prompt] if isinstance(prompt, str) else list(prompt)
+        fallback = messages[default_language]
+        replies = {}
+        for language, texts in messages.items():
+            source = messages[prompt_language] if prompt_language else texts
+            replies[language] = '\n\n'.join(source.get(key, fallback[key]) for key in keys)
+        return replies
+
+
+class CompiledState:
+    """Состояние диалога с индексом ключевых слов (matching.AnswerIndex или None без вариантов ответа)"""
+
+    __slots__ = ('keywords', 'default', 'media_field')
+
+    def __init__(self, keywords, default, media_field=None):
+        self.keywords = keywords
+        self.default = default
+        # Поле, для которого в этом состоянии принимается файл (фото документа)
+        self.media_field = media_field
+
+
+def _merge(state_spec, choice_spec):
+    merged = {key: state_spec[key] for key in STEP_KEYS if key in state_spec}
+    merged.update((key, choice_spec[key]) for key in STEP_KEYS if key in choice_spec)
+    return merged
+
+
+def compile_flow(flow, messages, default_language, matching='fuzzy', counters=None):
+    """Компиляция описания диалога из config.DIALOG_FLOW в таблицы переходов.
+
+    matching - способ сопоставления ответов с ключевыми словами (matching.MODES), counters - счетчики
+    результатов сопоставления (matching.match_counters).
+    """
+    states = {}
+    for state, spec in flow.items():
+        keywords = {}
+        for choice in spec.get('choices', ()):
+            step = Step(_merge(spec, choice), messages, default_language)
+            for keyword in frozenset(keyword.lower() for keyword in choice['keywords']):
+                if keyword in keywords:
+                    raise ValueError(f"Ключевое слово '{keyword}' повторяется в состоянии {state}")
+                keywords[keyword] = step
+        if 'default' in spec:
+            default = Step(_merge(spec, spec['default']), messages, default_language)
+        elif not spec.get('choices'):
+            # Состояние без вариантов: любой ответ сохраняется и ведет к следующему состоянию
+            default = Step(_merge(spec, {}), messages, default_language)
+        else:
+            default = None
+        index = AnswerIndex(keywords, matching, counters) if keywords else None
+        states[state] = CompiledState(index, default, spec.get('field') if spec.get('media') else None)
+    return states
+
+
+class DialogEngine:
+    """Обработка сообщения по скомпилированной таблице состояний"""
+
+    def __init__(self, flow, messages, default_language, matching='fuzzy', counters=None):
+        self.default_language = default_language
+        self.states = compile_flow(flow, messages, default_language, matching, counters)
+
+    def handle(self, session, text):
+        """Применение сообщения к сессии.
+
+        Возвращает шаг, который был выполнен, или None, если сообщение игнорируется.
+        """
+        compiled = self.states.get(session.state)
+        if compiled is None:
+            logger.warning("Нет описания для состояния диалога %s", session.state)
+            return None
+        step = compiled.keywords.get(text, compiled.default) if compiled.keywords else compiled.default
+        if step is None:
+            return None
+
+        if step.reset_data:
+            session.data = None
+        if step.language is not None:
+            session.language = step.language
+        if step.user_type is not None:
+            session.user_type = step.user_type
+        if step.field:
+            if session.data is None:
+                session.data = {}
+            session.data[step.field] = text if step.value is None else step.value
+        if step.next_state is not None:
+            session.state = step.next_state
+        return step
+
+    def media_field(self, state):
+        """Поле для файла из сообщения в состоянии state или None, если файл не ожидается"""
+        compiled = self.states.get(state)
+        return compiled.media_field if compiled is not None else None
+
+    def reply(self, step, language):
+        """Текст ответа на выбранном языке"""
+        if step is None or step.replies is None:
+            return ''
+        return step.replies.get(language) or step.replies[self.default_language]
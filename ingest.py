@@ -0,0 +1,268 @@
+import json
+import logging
+
+from delivery import ACK_STATUSES
+from media import MediaRef
+
+try:
+    import orjson
+except ImportError:  # orjson не обязателен, без него используется стандартный json
+    orjson = None
+
+logger = logging.getLogger(__name__)
+
+# События waApi с подтверждением статуса отправленного сообщения
+ACK_EVENTS = ('message_ack', 'message.ack')
+
+
+class IncomingMessage:
+    """Входящее сообщение, извлеченное из webhook-запроса"""
+
+    __slots__ = ('text', 'phone', 'message_id', 'timestamp', 'media', 'instance')
+
+    def __init__(self, text, phone, message_id=None, timestamp=None, media=None, instance=None):
+        self.text = text
+        self.phone = phone
+        self.message_id = message_id
+        self.timestamp = timestamp
+        self.media = media
+        # Экземпляр waApi (номер WhatsApp), получивший сообщение; None - экземпляр по умолчанию
+        self.instance = instance
+
+    def __repr__(self):
+        return f"IncomingMessage(phone={self.phone!r}, message_id={self.message_id!r})"
+
+
+class DeliveryAck:
+    """Подтверждение статуса отправленного ботом сообщения, извлеченное из webhook-запроса"""
+
+    __slots__ = ('message_id', 'status', 'instance')
+
+    def __init__(self, message_id, status, instance=None):
+        self.message_id = message_id
+        self.status = status
+        self.instance = instance
+
+    def __repr__(self):
+        return f"DeliveryAck(message_id={self.message_id!r}, status={self.status!r})"
+
+
+class PayloadError(ValueError):
+    """Тело webhook-запроса слишком большое, слишком глубокое или не является JSON"""
+
+
+def parse_json(raw, max_bytes):
+    """Разбор тела запроса с ограничением размера"""
+    if len(raw) > max_bytes:
+        raise PayloadError(f"Размер тела запроса {len(raw)} превышает {max_bytes} байт")
+    try:
+        if orjson is not None:
+            return orjson.loads(raw)
+        return json.loads(raw)
+    except RecursionError:
+        raise PayloadError("Слишком глубокая вложенность JSON")
+    except ValueError as e:
+        raise PayloadError(f"Некорректный JSON: {e}")
+
+
+def _phone_from_chat_id(value):
+    """Номер из идентификатора чата вида XXXXXXXXXXX@c.us"""
+    return value.split('@')[0] if '@' in value else value
+
+
+def _message_id(value):
+    """Идентификатор сообщения: строка или объект вида {"_serialized": "..."}"""
+    if isinstance(value, dict):
+        value = value.get('_serialized') or value.get('id')
+    return str(value) if value else None
+
+
+def _instance_id(value):
+    """Идентификатор экземпляра waApi: число или строка"""
+    return str(value) if isinstance(value, (str, int)) and value != '' else None
+
+
+def _media_ref(url=None, data=None, mime_type=None, filename=None):
+    """Ссылка на файл, если в сообщении есть URL или данные base64"""
+    url = url if isinstance(url, str) and url.startswith(('http://', 'https://')) else None
+    data = data if isinstance(data, str) and data else None
+    if url is None and data is None:
+        return None
+    return MediaRef(url, data, mime_type if isinstance(mime_type, str) else None,
+                    filename if isinstance(filename, str) else None)
+
+
+def _extract_waapi_event(data):
+    """Формат waApi: {"event": "message", "instanceId": ..., "data": {"message": {...}, "media": {...}}}"""
+    message = data['data'].get('message') or {}
+    sender = message.get('from') or ''
+    media = None
+    if message.get('hasMedia') or message.get('mediaUrl'):
+        # Файл передается ссылкой (mediaUrl) или данными base64 в data.media
+        attached = data['data'].get('media')
+        attached = attached if isinstance(attached, dict) else {}
+        media = _media_ref(message.get('mediaUrl') or attached.get('url'), attached.get('data'),
+                           attached.get('mimetype') or message.get('mimetype'), attached.get('filename'))
+    # У сообщения с файлом в body - подпись к файлу
+    body = message.get('body') or message.get('caption') or ''
+    return IncomingMessage(body.strip(), _phone_from_chat_id(sender),
+                           _message_id(message.get('id')), message.get('timestamp'), media,
+                           _instance_id(data.get('instanceId', data['data'].get('instanceId'))))
+
+
+def _ack_status(value):
+    """Статус доставки из числового ack waApi (-1 ... 4) или названия статуса"""
+    if isinstance(value, bool):
+        return None
+    if isinstance(value, int):
+        return ACK_STATUSES.get(value)
+    if isinstance(value, str):
+        value = value.lower()
+        return value if value in ACK_STATUSES.values() else None
+    return None
+
+
+def _extract_waapi_ack(data):
+    """Формат waApi: {"event": "message_ack", "instanceId": ..., "data": {"message": {...}, "ack": 2}}"""
+    message = data['data'].get('message')
+    message = message if isinstance(message, dict) else {}
+    ack = data['data'].get('ack', message.get('ack'))
+    message_id = _message_id(message.get('id') or data['data'].get('id'))
+    status = _ack_status(ack)
+    if message_id is None or status is None:
+        return []
+    return [DeliveryAck(message_id, status, _instance_id(data.get('instanceId', data['data'].get('instanceId'))))]
+
+
+def _extract_legacy(message):
+    """Одно сообщение старого формата {"messages": [{...}, ...]}"""
+    if 'text' in message:
+        body = message['text'].get('body', '')
+    elif 'caption' in message:
+        body = message.get('caption', '')
+    else:
+        body = message.get('body', '')
+    media = None
+    attached = message.get('image') or message.get('document')
+    if isinstance(attached, dict):
+        media = _media_ref(attached.get('link') or attached.get('url'), None,
+                           attached.get('mime_type'), attached.get('filename'))
+        body = body or attached.get('caption') or ''
+    return IncomingMessage(body.strip(), _phone_from_chat_id(message.get('from', '')),
+                           _message_id(message.get('id')), message.get('timestamp'), media)
+
+
+def _extract_legacy_batch(messages):
+    """Сообщения пачки старого формата: сообщение неожиданной структуры пропускается, остальные обрабатываются"""
+    extracted = []
+    for message in messages:
+        if not isinstance(message, dict):
+            continue
+        try:
+            extracted.append(_extract_legacy(message))
+        except (AttributeError, TypeError, ValueError) as e:
+            logger.warning("Сообщение старого формата пропущено: %s", e)
+    return extracted
+
+
+def _extract_generic(data, max_depth, max_nodes):
+    """Поиск первых полей body и from обходом в глубину с ограничением глубины и числа узлов"""
+    incoming_msg = ''
+    sender_phone = ''
+    stack = [(data, 0)]
+    visited = 0
+    while stack and not (incoming_msg and sender_phone):
+        obj, depth = stack.pop()
+        visited += 1
+        if visited > max_nodes:
+            logger.warning("Обход webhook-запроса остановлен после %d узлов", max_nodes)
+            break
+        if isinstance(obj, dict):
+            children = []
+            for key, value in obj.items():
+                if key == 'body' and isinstance(value, str):
+                    if not incoming_msg:
+                        incoming_msg = value.strip()
+                elif key == 'from' and isinstance(value, str) and '@' in value:
+                    if not sender_phone:
+                        sender_phone = value.split('@')[0]
+                elif isinstance(value, (dict, list)):
+                    children.append(value)
+        elif isinstance(obj, list):
+            children = [item for item in obj if isinstance(item, (dict, list))]
+        else:
+            continue
+        if depth + 1 > max_depth:
+            continue
+        # Дочерние узлы кладутся в обратном порядке, чтобы обход шел в порядке документа
+        for child in reversed(children):
+            stack.append((child, depth + 1))
+    return incoming_msg, sender_phone
+
+
+def extract_messages(data, max_depth, max_nodes):
+    """Все входящие сообщения из JSON webhook-запроса в порядке поступления.
+
+    Старый формат может доставлять сообщения пачкой: при высокой нагрузке провайдер отправляет
+    несколько сообщений одним запросом, и каждое из них должно попасть в диалог.
+    В запросах только с подтверждениями доставки (см. extract_acks) сообщений нет.
+    """
+    if isinstance(data, dict):
+        if data.get('event') == 'message' and isinstance(data.get('data'), dict):
+            return [_extract_waapi_event(data)]
+        if data.get('event') in ACK_EVENTS:
+            return []
+        if isinstance(data.get('messages'), list) and data['messages']:
+            return _extract_legacy_batch(data['messages'])
+        if isinstance(data.get('statuses'), list) and data['statuses']:
+            return []
+    incoming_msg, sender_phone = _extract_generic(data, max_depth, max_nodes)
+    logger.info("Извлечены данные из альтернативного формата: отправитель=%s", sender_phone)
+    return [IncomingMessage(incoming_msg, sender_phone)]
+
+
+def extract_acks(data):
+    """Подтверждения доставки из JSON webhook-запроса: событие waApi message_ack или пачка
+    {"statuses": [{"id": ..., "status": "delivered"}, ...]} старого формата"""
+    if not isinstance(data, dict):
+        return []
+    if data.get('event') in ACK_EVENTS:
+        return _extract_waapi_ack(data) if isinstance(data.get('data'), dict) else []
+    statuses = data.get('statuses')
+    if not isinstance(statuses, list):
+        return []
+    acks = []
+    for status in statuses:
+        if not isinstance(status, dict):
+            continue
+        message_id = _message_id(status.get('id'))
+        ack = _ack_status(status.get('status', status.get('ack')))
+        if message_id is not None and ack is not None:
+            acks.append(DeliveryAck(message_id, ack))
+    return acks
+
+
+def extract_message(data, max_depth, max_nodes):
+    """Первое входящее сообщение из JSON webhook-запроса"""
+    messages = extract_messages(data, max_depth, max_nodes)
+    return messages[0] if messages else IncomingMessage('', '')
+
+
+def group_by_sender(messages):
+    """Сообщения по отправителям (экземпляр waApi, номер): группы в порядке первого сообщения отправителя,
+    сообщения внутри группы - в порядке поступления"""
+    groups = {}
+    for message in messages:
+        groups.setdefault((message.instance, message.phone), []).append(message)
+    return groups
+
+
+def extract_form(data):
+    """Входящее сообщение из данных формы (для тестирования)"""
+    incoming_msg = data.get('body', data.get('Body', '')).strip()
+    sender_phone = data.get('from', data.get('From', '')).replace('whatsapp:', '')
+    media = _media_ref(data.get('MediaUrl0') or data.get('media_url'), None,
+                       data.get('MediaContentType0') or data.get('media_type'))
+    return IncomingMessage(incoming_msg, _phone_from_chat_id(sender_phone),
+                           data.get('id') or None, data.get('timestamp') or None, media,
+                           _instance_id(data.get('instance')))
@@ -0,0 +1,106 @@
+import asyncio
+import threading
+import time
+from contextlib import asynccontextmanager, contextmanager
+
+from metrics import Histogram
+
+# Границы корзин для количества ожидающих перед потоком
+CONTENTION_BUCKETS = (0, 1, 2, 4, 8, 16, 32, 64)
+
+
+class _Shard:
+    """Справедливая (FIFO) блокировка: потоки получают ее в порядке обращения"""
+
+    __slots__ = ('condition', 'next_ticket', 'serving', 'abandoned')
+
+    def __init__(self):
+        self.condition = threading.Condition(threading.Lock())
+        self.next_ticket = 0
+        self.serving = 0
+        # Номера потоков, прерванных во время ожидания: их очередь пропускается
+        self.abandoned = set()
+
+    def advance(self):
+        """Передача блокировки следующему ожидающему (вызывается под condition)"""
+        self.serving += 1
+        while self.serving in self.abandoned:
+            self.abandoned.discard(self.serving)
+            self.serving += 1
+        self.condition.notify_all()
+
+
+class KeyedLocks:
+    """Таблица блокировок по ключу (номеру отправителя).
+
+    Сообщения одного отправителя обрабатываются строго по очереди в порядке поступления,
+    сообщения разных отправителей - параллельно. Ключи распределяются по фиксированному
+    числу сегментов, поэтому память не растет с количеством отправителей.
+    """
+
+    def __init__(self, shards=256):
+        self._shards = [_Shard() for _ in range(shards)]
+        self.wait_time = Histogram()
+        self.contention = Histogram(CONTENTION_BUCKETS)
+
+    @contextmanager
+    def hold(self, key):
+        shard = self._shards[hash(key) % len(self._shards)]
+        started = time.monotonic()
+        with shard.condition:
+            ticket = shard.next_ticket
+            shard.next_ticket += 1
+            self.contention.observe(ticket - shard.serving)
+            try:
+                while shard.serving != ticket:
+                    shard.condition.wait()
+            except BaseException:
+                # Без пропуска номера прерванного потока сегмент остался бы заблокированным навсегда
+                if shard.serving == ticket:
+                    shard.advance()
+                else:
+                    shard.abandoned.add(ticket)
+                raise
+        self.wait_time.observe(time.monotonic() - started)
+        try:
+            yield
+        finally:
+            with shard.condition:
+                shard.advance()
+
+    def stats(self):
+        return {
+            'shards': len(self._shards),
+            'wait_time': self.wait_time.snapshot(),
+            'contention': self.contention.snapshot(),
+        }
+
+
+class AsyncKeyedLocks:
+    """Вариант KeyedLocks для asyncio: блокировки asyncio.Lock выдаются в порядке ожидания"""
+
+    def __init__(self, shards=256):
+        self._shards = None
+        self._shards_count = shards
+        self.wait_time = Histogram()
+        self.contention = Histogram(CONTENTION_BUCKETS)
+
+    @asynccontextmanager
+    async def hold(self, key):
+        if self._shards is None:
+            # Блокировки создаются в работающем цикле событий
+            self._shards = [asyncio.Lock() for _ in range(self._shards_count)]
+        lock = self._shards[hash(key) % self._shards_count]
+        waiters = getattr(lock, '_waiters', None)
+        self.contention.observe((len(waiters) if waiters else 0) + (1 if lock.locked() else 0))
+        started = time.monotonic()
+        async with lock:
+            self.wait_time.observe(time.monotonic() - started)
+            yield
+
+    def stats(self):
+        return {
+            'shards': self._shards_count,
+            'wait_time': self.wait_time.snapshot(),
+            'contention': self.contention.snapshot(),
+        }
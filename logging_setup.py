@@ -0,0 +1,177 @@
+import atexit
+import contextvars
+import json
+import logging
+import logging.handlers
+import queue
+import random
+import re
+import sys
+import time
+
+# Идентификатор запроса, к которому относится запись журнала
+request_id_var = contextvars.ContextVar('request_id', default='-')
+
+# Номера телефонов: 11-15 цифр, в том числе с "+" и в составе chatId вида 77011234567@c.us
+PHONE_RE = re.compile(r'(?<![\w.])\+?\d{7,11}(\d{4})(?![\w.])')
+# Параметры запроса в URL и в пути (ключ и токен Trello, номера в текстах ошибок requests, urllib3 и httpx)
+URL_QUERY_RE = re.compile(r'((?:\bhttps?://|(?<![\w/])/)[^\s?#\'"]*)\?[^\s#\'"]+')
+
+REDACTED = '***'
+
+_payload_sample_rate = 1.0
+
+
+def set_request_id(request_id):
+    request_id_var.set(request_id)
+
+
+def get_request_id():
+    return request_id_var.get()
+
+
+def mask_phones(text):
+    """Маскирование номеров телефонов, остаются последние 4 цифры"""
+    return PHONE_RE.sub(lambda match: REDACTED + match.group(1), text)
+
+
+def strip_query(text):
+    """Удаление параметров запроса из URL в тексте"""
+    return URL_QUERY_RE.sub(lambda match: match.group(1) + '?' + REDACTED, text)
+
+
+def _field_pattern(fields):
+    """Значения полей в уже собранном тексте: 'field': 'value', "field": "value" и field=value"""
+    names = '|'.join(re.escape(field) for field in sorted(fields) if field)
+    if not names:
+        return None
+    return re.compile(r'''(["']?\b(?:%s)\b["']?\s*[:=]\s*)(?:"[^"]*"|'[^']*'|[^\s,&;)}\]]+)''' % names)
+
+
+def _redact_value(value, fields):
+    if isinstance(value, dict):
+        return {key: REDACTED if key in fields else _redact_value(item, fields) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_redact_value(item, fields) for item in value]
+    return value
+
+
+class ContextFilter(logging.Filter):
+    """Добавление идентификатора запроса в запись (выполняется в потоке, создавшем запись)"""
+
+    def filter(self, record):
+        record.request_id = request_id_var.get()
+        return True
+
+
+class RedactingFilter(logging.Filter):
+    """Удаление персональных данных: значения указанных полей, параметры запроса в URL и номера телефонов.
+
+    Маскируются и сообщение, и трассировка исключения: тексты ошибок requests содержат полный URL запроса.
+    """
+
+    def __init__(self, fields):
+        super().__init__()
+        self.fields = frozenset(fields)
+        self._field_re = _field_pattern(self.fields)
+
+    def redact_text(self, text):
+        text = strip_query(text)
+        if self._field_re is not None:
+            text = self._field_re.sub(lambda match: match.group(1) + REDACTED, text)
+        return mask_phones(text)
+
+    def filter(self, record):
+        if record.args:
+            if isinstance(record.args, dict):
+                record.args = _redact_value(record.args, self.fields)
+            else:
+                record.args = tuple(_redact_value(arg, self.fields) for arg in record.args)
+        record.msg = self.redact_text(record.getMessage())
+        record.args = None
+        if record.exc_info and not record.exc_text:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+        if record.exc_text:
+            record.exc_text = self.redact_text(record.exc_text)
+        if record.stack_info:
+            record.stack_info = self.redact_text(record.stack_info)
+        return True
+
+
+class JsonFormatter(logging.Formatter):
+    """Запись журнала в виде одной строки JSON"""
+
+    def format(self, record):
+        entry = {
+            'ts': time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime(record.created)) + f'.{int(record.msecs):03d}Z',
+            'level': record.levelname,
+            'logger': record.name,
+            'request_id': getattr(record, 'request_id', '-'),
+            'message': record.getMessage(),
+        }
+        # Трассировка собрана заранее (и замаскирована RedactingFilter), если она есть
+        if record.exc_text:
+            entry['exc_info'] = record.exc_text
+        elif record.exc_info:
+            entry['exc_info'] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False)
+
+
+class _DeferredQueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler без форматирования в вызывающем потоке: сообщение собирается в потоке журнала"""
+
+    dropped = 0
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            # Переполненная очередь журнала не должна задерживать обработку запросов
+            self.dropped += 1
+
+    def prepare(self, record):
+        if record.exc_info and not record.exc_text:
+            # Трассировку нужно получить сейчас, пока исключение доступно
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+        return record
+
+
+def setup_logging(level='INFO', fmt='text', redact=True, redact_fields=(), payload_sample_rate=1.0,
+                  queue_size=10000, stream=None):
+    """Настройка журнала: запись через очередь в отдельном потоке, JSON или текст, маскирование данных"""
+    global _payload_sample_rate
+    _payload_sample_rate = payload_sample_rate
+
+    handler = logging.StreamHandler(stream or sys.stderr)
+    if fmt == 'json':
+        handler.setFormatter(JsonFormatter())
+    else:
+        handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s %(name)s [%(request_id)s] %(message)s'))
+    if redact:
+        handler.addFilter(RedactingFilter(redact_fields))
+
+    log_queue = queue.Queue(maxsize=queue_size)
+    queue_handler = _DeferredQueueHandler(log_queue)
+    queue_handler.addFilter(ContextFilter())
+
+    root = logging.getLogger()
+    for existing in list(root.handlers):
+        root.removeHandler(existing)
+    root.addHandler(queue_handler)
+    root.setLevel(level)
+
+    listener = logging.handlers.QueueListener(log_queue, handler, respect_handler_level=True)
+    listener.start()
+    atexit.register(stop_listener, listener)
+    return listener
+
+
+def stop_listener(listener):
+    """Остановка потока журнала с записью оставшихся в очереди записей"""
+    if listener._thread is not None:
+        listener.stop()
+
+
+def should_log_payload():
+    """Нужно ли записывать в журнал полное тело запроса (выборочно, с долей LOG_PAYLOAD_SAMPLE_RATE)"""
+    return _payload_sample_rate >= 1.0 or random.random() < _payload_sample_rate
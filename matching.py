@@ -0,0 +1,199 @@
+import re
+import unicodedata
+
+from metrics import Counter
+
+# Способы сопоставления ответа с ключевыми словами: exact - точное совпадение без учета регистра (как раньше),
+# normalized - после нормализации, fuzzy - дополнительно с опечатками и по началу слова
+MODES = ('exact', 'normalized', 'fuzzy')
+# Результаты поиска ответа (для метрики bot_answer_matches_total)
+MATCH_KINDS = ('exact', 'normalized', 'fuzzy', 'prefix', 'miss')
+
+# Казахские буквы и ё приводятся к близким русским: "қазақша" и "казакша" - один ответ
+_LETTER_FOLD = str.maketrans({'ә': 'а', 'ғ': 'г', 'қ': 'к', 'ң': 'н', 'ө': 'о', 'ұ': 'у', 'ү': 'у', 'һ': 'х',
+                              'і': 'и', 'ё': 'е', '🔟': '10'})
+# Латинские буквы, неотличимые от кириллических, в словах, где смешаны обе азбуки ("pуcский")
+_HOMOGLYPHS = str.maketrans({'a': 'а', 'c': 'с', 'e': 'е', 'i': 'и', 'k': 'к', 'o': 'о', 'p': 'р', 'x': 'х',
+                             'y': 'у'})
+# Все, кроме букв и цифр: знаки препинания, эмодзи, символ клавиши в "1️⃣" (U+FE0F, U+20E3)
+_NON_WORD = re.compile(r'[\W_]+')
+_LATIN = re.compile(r'[a-z]')
+_CYRILLIC = re.compile(r'[а-я]')
+
+# Слово короче - без опечаток (у "да" и "на" одно различие); до 8 букв - одна опечатка, длиннее - две
+FUZZY_MIN_LENGTH = 4
+FUZZY_LONG_LENGTH = 8
+# Ключевые слова не короче этого совпадают по началу ответа ("kazakh" - "kaz", "русский язык" - "рус")
+PREFIX_MIN_LENGTH = 3
+# Слова, которые не меняют смысла ответа после первого слова ("русский язык", "қазақ тілі", "да, сотрудничаем"),
+# после normalize_answer: ответ из нескольких слов сопоставляется по первому слову, только если остальные - отсюда
+FILLER_WORDS = frozenset(('язык', 'языке', 'тили', 'тилинде', 'language', 'сотрудничаем', 'пожалуйста', 'please',
+                          'спасибо', 'рахмет'))
+
+
+def normalize_answer(text):
+    """Ответ для сопоставления: NFKC, без регистра, казахские буквы - как русские, цифры вместо эмодзи-клавиш,
+    без знаков препинания и эмодзи, пробелы схлопнуты"""
+    text = unicodedata.normalize('NFKC', text).casefold().translate(_LETTER_FOLD)
+    words = _NON_WORD.sub(' ', text).split()
+    for i, word in enumerate(words):
+        if _LATIN.search(word) and _CYRILLIC.search(word):
+            words[i] = word.translate(_HOMOGLYPHS)
+    return ' '.join(words)
+
+
+def max_distance(keyword):
+    """Допустимое количество опечаток для ключевого слова"""
+    if len(keyword) < FUZZY_MIN_LENGTH:
+        return 0
+    return 1 if len(keyword) < FUZZY_LONG_LENGTH else 2
+
+
+def _deletes(word, distance):
+    """Варианты слова без не более чем distance букв (включая само слово)"""
+    variants = {word}
+    edge = {word}
+    for _ in range(distance):
+        edge = {variant[:i] + variant[i + 1:] for variant in edge for i in range(len(variant))}
+        variants |= edge
+    return variants
+
+
+def edit_distance(a, b, limit):
+    """Расстояние Дамерау-Левенштейна (с перестановкой соседних букв) или limit + 1, если оно больше limit"""
+    if abs(len(a) - len(b)) > limit:
+        return limit + 1
+    previous2 = None
+    previous = list(range(len(b) + 1))
+    for i in range(1, len(a) + 1):
+        current = [i] + [0] * len(b)
+        for j in range(1, len(b) + 1):
+            cost = a[i - 1] != b[j - 1]
+            current[j] = min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + cost)
+            if i > 1 and j > 1 and a[i - 1] == b[j - 2] and a[i - 2] == b[j - 1]:
+                current[j] = min(current[j], previous2[j - 2] + 1)
+        if min(current) > limit:
+            return limit + 1
+        previous2, previous = previous, current
+    return previous[-1]
+
+
+class AnswerIndex:
+    """Заранее построенный индекс ключевых слов состояния для сопоставления ответа пользователя.
+
+    Ответ ищется по точному совпадению, затем после normalize_answer, затем с опечатками
+    (варианты с удаленными буквами заранее вычислены для ключевых слов, поэтому поиск - несколько
+    обращений к словарю для ответа ограниченной длины) и по началу ответа. Ответ из нескольких слов
+    сопоставляется целиком, затем по первому слову, если остальные слова - из FILLER_WORDS ("русский язык",
+    "да, сотрудничаем"; в "9 марта буду" первое слово - не выбор варианта).
+    Если ответ одинаково близок к вариантам с разными значениями, совпадения нет.
+    """
+
+    __slots__ = ('_raw', '_normalized', '_deletes', '_prefixes', '_prefix_lengths', '_max_length', '_mode',
+                 '_counters')
+
+    def __init__(self, choices, mode='fuzzy', counters=None):
+        if mode not in MODES:
+            raise ValueError(f"Неизвестный способ сопоставления ответов: {mode}")
+        self._mode = mode
+        self._counters = counters
+        self._raw = {}
+        self._normalized = {}
+        for keyword, value in choices.items():
+            self._raw[keyword.lower()] = value
+            key = normalize_answer(keyword)
+            if key in self._normalized and self._normalized[key] is not value:
+                raise ValueError(f"Ключевые слова с разными вариантами совпадают после нормализации: '{key}'")
+            self._normalized[key] = value
+        self._deletes = {}
+        self._prefixes = {}
+        for key in self._normalized:
+            for variant in _deletes(key, max_distance(key)):
+                self._deletes.setdefault(variant, []).append(key)
+            if len(key) >= PREFIX_MIN_LENGTH and ' ' not in key and not key.isdigit():
+                self._prefixes[key] = self._normalized[key]
+        self._prefix_lengths = sorted({len(key) for key in self._prefixes}, reverse=True)
+        # Ответ длиннее самого длинного ключевого слова с учетом опечаток не может с ним совпасть
+        self._max_length = max((len(key) + max_distance(key) for key in self._normalized), default=0)
+
+    def __len__(self):
+        return len(self._raw)
+
+    def _count(self, kind):
+        if self._counters is not None:
+            self._counters[kind].inc()
+
+    def get(self, text, default=None):
+        """Значение варианта, с которым совпадает ответ text, или default"""
+        value = self._raw.get(text.lower())
+        if value is not None:
+            self._count('exact')
+            return value
+        if self._mode == 'exact':
+            self._count('miss')
+            return default
+        answer = normalize_answer(text)
+        words = answer.split(' ')
+        first_word = words[0]
+        by_first_word = all(word in FILLER_WORDS for word in words[1:])
+        candidates = (answer, first_word) if len(words) > 1 and by_first_word else (answer,)
+        for candidate in candidates:
+            value = self._normalized.get(candidate)
+            if value is not None:
+                self._count('normalized')
+                return value
+        if self._mode == 'fuzzy':
+            for candidate in candidates:
+                value = self._fuzzy(candidate)
+                if value is not None:
+                    self._count('fuzzy')
+                    return value
+            value = self._prefix(first_word) if by_first_word else None
+            if value is not None:
+                self._count('prefix')
+                return value
+        self._count('miss')
+        return default
+
+    def _fuzzy(self, answer):
+        if len(answer) < FUZZY_MIN_LENGTH - 1 or len(answer) > self._max_length:
+            return None
+        # Две опечатки допускаются только в длинных словах: короткому ответу достаточно вариантов без одной буквы
+        distance = 1 if len(answer) < FUZZY_LONG_LENGTH - 2 else 2
+        # Ключевые слова, у которых есть общий с ответом вариант без нескольких букв, проверяются по одному разу
+        keys = set()
+        deletes = self._deletes
+        for variant in _deletes(answer, distance):
+            keys.update(deletes.get(variant, ()))
+        best = None
+        best_distance = FUZZY_LONG_LENGTH
+        for key in keys:
+            limit = max_distance(key)
+            distance = edit_distance(answer, key, limit)
+            if distance > limit:
+                continue
+            value = self._normalized[key]
+            if distance < best_distance:
+                best, best_distance = value, distance
+            elif distance == best_distance and value is not best:
+                # Одинаково близко к разным вариантам - ответ неоднозначен
+                best = _AMBIGUOUS
+        return None if best is _AMBIGUOUS else best
+
+    def _prefix(self, word):
+        found = None
+        for length in self._prefix_lengths:
+            value = self._prefixes.get(word[:length]) if len(word) > length else None
+            if value is not None:
+                if found is not None and found is not value:
+                    return None
+                found = value
+        return found
+
+
+_AMBIGUOUS = object()
+
+
+def match_counters():
+    """Счетчики результатов поиска ответов по видам MATCH_KINDS"""
+    return {kind: Counter() for kind in MATCH_KINDS}
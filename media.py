@@ -0,0 +1,284 @@
+import base64
+import hashlib
+import logging
+import mimetypes
+import os
+import tempfile
+import threading
+import time
+import urllib.parse
+import uuid
+
+from metrics import Counter, Histogram
+
+logger = logging.getLogger(__name__)
+
+
+class MediaError(ValueError):
+    """Файл не удалось получить: слишком большой, пустой или ошибка загрузки"""
+
+
+class MediaRef:
+    """Ссылка на файл во входящем сообщении: URL для загрузки или данные base64 из webhook-запроса"""
+
+    __slots__ = ('url', 'data', 'mime_type', 'filename')
+
+    def __init__(self, url=None, data=None, mime_type=None, filename=None):
+        self.url = url
+        self.data = data
+        self.mime_type = mime_type
+        self.filename = filename
+
+    def __repr__(self):
+        return f"MediaRef(url={self.url!r}, mime_type={self.mime_type!r})"
+
+
+class MediaFile:
+    """Файл в хранилище: имя файла - SHA-256 содержимого, поэтому одинаковые файлы хранятся один раз"""
+
+    __slots__ = ('sha256', 'size', 'mime_type', 'filename')
+
+    def __init__(self, sha256, size, mime_type=None, filename=None):
+        self.sha256 = sha256
+        self.size = size
+        self.mime_type = mime_type
+        self.filename = filename
+
+    def to_dict(self):
+        return {'sha256': self.sha256, 'size': self.size, 'mime_type': self.mime_type, 'filename': self.filename}
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(data['sha256'], data['size'], data.get('mime_type'), data.get('filename'))
+
+    def __repr__(self):
+        return f"MediaFile(sha256={self.sha256[:12]!r}, size={self.size})"
+
+
+class MediaSpool:
+    """Хранилище файлов из сообщений.
+
+    Файл пишется частями во временный файл с одновременным подсчетом хеша и затем переименовывается
+    в <каталог>/<2 символа хеша>/<хеш>, поэтому расход памяти не зависит от размера файла.
+
+    Ссылку на файл присылает отправитель сообщения, поэтому загрузка идет только по http(s) с хостов
+    allowed_hosts (".example.com" - хост и его поддомены), без перенаправлений и не дольше download_timeout секунд.
+    """
+
+    def __init__(self, directory, chunk_size=64 * 1024, max_bytes=16 * 1024 * 1024, download_timeout=None,
+                 allowed_hosts=()):
+        self.directory = directory
+        self.chunk_size = chunk_size
+        self.max_bytes = max_bytes
+        self.download_timeout = download_timeout
+        self.allowed_hosts = frozenset(host.strip().lower() for host in allowed_hosts if host.strip())
+        os.makedirs(directory, exist_ok=True)
+
+        self.stored = Counter()
+        self.deduplicated = Counter()
+        self.rejected = Counter()
+        self.bytes_written = Counter()
+        self.file_size = Histogram(buckets=(64 * 1024, 256 * 1024, 1024 * 1024, 4 * 1024 * 1024,
+                                            16 * 1024 * 1024, 64 * 1024 * 1024))
+        self._lock = threading.Lock()
+
+    def path(self, sha256):
+        return os.path.join(self.directory, sha256[:2], sha256)
+
+    def exists(self, sha256):
+        return os.path.exists(self.path(sha256))
+
+    def store(self, chunks, mime_type=None, filename=None):
+        """Запись файла из последовательности частей, возвращает MediaFile"""
+        digest = hashlib.sha256()
+        size = 0
+        fd, tmp_path = tempfile.mkstemp(prefix='.incoming-', dir=self.directory)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                for chunk in chunks:
+                    if not chunk:
+                        continue
+                    size += len(chunk)
+                    if size > self.max_bytes:
+                        self.rejected.inc()
+                        raise MediaError(f"Размер файла превышает {self.max_bytes} байт")
+                    digest.update(chunk)
+                    f.write(chunk)
+            if not size:
+                self.rejected.inc()
+                raise MediaError("Пустой файл")
+
+            sha256 = digest.hexdigest()
+            target = self.path(sha256)
+            with self._lock:
+                if os.path.exists(target):
+                    self.deduplicated.inc()
+                    logger.info("Файл %s уже есть в хранилище", sha256[:12])
+                else:
+                    os.makedirs(os.path.dirname(target), exist_ok=True)
+                    os.replace(tmp_path, target)
+                    tmp_path = None
+                    self.stored.inc()
+                    self.bytes_written.inc(size)
+                    self.file_size.observe(size)
+        finally:
+            if tmp_path is not None:
+                try:
+                    os.unlink(tmp_path)
+                except FileNotFoundError:
+                    pass
+        return MediaFile(sha256, size, mime_type, filename or _default_filename(sha256, mime_type))
+
+    def check_url(self, url):
+        """Проверка ссылки на файл: схема http(s) и хост из allowed_hosts, иначе MediaError"""
+        parsed = urllib.parse.urlsplit(url)
+        host = (parsed.hostname or '').lower()
+        if parsed.scheme not in ('http', 'https') or not host:
+            raise MediaError(f"Недопустимая ссылка на файл: {parsed.scheme}://{host}")
+        if not any(host == allowed or (allowed.startswith('.') and (host.endswith(allowed) or host == allowed[1:]))
+                   for allowed in self.allowed_hosts):
+            raise MediaError(f"Загрузка файлов с {host} не разрешена")
+
+    def download(self, http, ref, headers=None):
+        """Загрузка файла по ссылке частями через HTTP-клиент (upstream.UpstreamClient)"""
+        self.check_url(ref.url)
+        deadline = time.monotonic() + self.download_timeout if self.download_timeout else None
+        # Перенаправление могло бы увести загрузку на неразрешенный хост
+        response = http.get(ref.url, headers=headers, stream=True, allow_redirects=False)
+        try:
+            if response.status_code != 200:
+                raise MediaError(f"Ошибка загрузки файла: {response.status_code}")
+            length = response.headers.get('Content-Length')
+            if length and length.isdigit() and int(length) > self.max_bytes:
+                self.rejected.inc()
+                raise MediaError(f"Размер файла {length} превышает {self.max_bytes} байт")
+            mime_type = ref.mime_type or response.headers.get('Content-Type', '').split(';')[0].strip() or None
+            chunks = response.iter_content(self.chunk_size)
+            if deadline is not None:
+                chunks = self._until(chunks, deadline)
+            return self.store(chunks, mime_type, ref.filename)
+        finally:
+            response.close()
+
+    def _until(self, chunks, deadline):
+        """Части файла до истечения общего времени загрузки: таймаут чтения ограничивает только паузу между частями"""
+        for chunk in chunks:
+            if time.monotonic() > deadline:
+                self.rejected.inc()
+                raise MediaError(f"Загрузка файла не завершена за {self.download_timeout:g} с")
+            yield chunk
+
+    def store_base64(self, ref):
+        """Запись файла, переданного в webhook-запросе в base64"""
+        return self.store(_decode_base64(ref.data, self.chunk_size), ref.mime_type, ref.filename)
+
+    def fetch(self, http, ref, headers=None):
+        """Получение файла из сообщения: по ссылке или из данных base64"""
+        if ref.url:
+            return self.download(http, ref, headers)
+        if ref.data:
+            return self.store_base64(ref)
+        raise MediaError("В сообщении нет ссылки на файл")
+
+    def stats(self):
+        return {
+            'stored': self.stored.value,
+            'deduplicated': self.deduplicated.value,
+            'rejected': self.rejected.value,
+            'bytes_written': self.bytes_written.value,
+            'file_size': self.file_size.snapshot(),
+        }
+
+
+def _default_filename(sha256, mime_type):
+    extension = mimetypes.guess_extension(mime_type or '') or ''
+    if extension == '.jpe':
+        extension = '.jpg'
+    return f"{sha256[:12]}{extension}"
+
+
+def _decode_base64(data, chunk_size):
+    """Декодирование base64 частями (длина части кратна 4 символам).
+
+    Данные могут быть разбиты на строки (MIME, перевод строки через каждые 76 символов): пробельные символы
+    удаляются из каждой части, а остаток, не кратный 4 символам, переносится в следующую часть.
+    """
+    if ',' in data[:100] and data.startswith('data:'):
+        # Формат data:<тип>;base64,<данные>
+        data = data.split(',', 1)[1]
+    step = max(4, chunk_size // 3 * 4)
+    carry = ''
+    for start in range(0, len(data), step):
+        chunk = carry + ''.join(data[start:start + step].split())
+        aligned = len(chunk) - len(chunk) % 4
+        carry = chunk[aligned:]
+        if aligned:
+            yield base64.b64decode(chunk[:aligned])
+    if carry:
+        yield base64.b64decode(carry)
+
+
+class MultipartFile:
+    """Тело multipart/form-data с файлом из хранилища, читаемое частями.
+
+    Длина известна заранее, поэтому requests передает тело с Content-Length без чтения файла в память.
+    Поддерживает seek(0) для повтора запроса.
+    """
+
+    def __init__(self, path, fields, file_field, filename, mime_type, chunk_size=64 * 1024):
+        self.boundary = uuid.uuid4().hex
+        self.content_type = f'multipart/form-data; boundary={self.boundary}'
+        self._path = path
+        self._chunk_size = chunk_size
+        # Кавычки и переводы строк в имени файла из сообщения сломали бы заголовок части
+        filename = filename.replace('"', "'").replace('\r', ' ').replace('\n', ' ')
+        parts = []
+        for name, value in fields.items():
+            parts.append(f'--{self.boundary}\r\nContent-Disposition: form-data; name="{name}"\r\n\r\n{value}\r\n')
+        parts.append(f'--{self.boundary}\r\nContent-Disposition: form-data; name="{file_field}"; '
+                     f'filename="{filename}"\r\nContent-Type: {mime_type or "application/octet-stream"}\r\n\r\n')
+        self._head = ''.join(parts).encode('utf-8')
+        self._tail = f'\r\n--{self.boundary}--\r\n'.encode('ascii')
+        self._length = len(self._head) + os.path.getsize(path) + len(self._tail)
+        self._file = None
+        self.seek(0)
+
+    def __len__(self):
+        return self._length
+
+    def seek(self, offset, whence=0):
+        if offset != 0 or whence != 0:
+            raise ValueError("Поддерживается только перемотка в начало")
+        self.close()
+        self._file = open(self._path, 'rb')
+        self._parts = iter((self._head, self._file, self._tail))
+        self._current = next(self._parts)
+        self._position = 0
+        return 0
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            size = self._chunk_size
+        while self._current is not None:
+            if isinstance(self._current, bytes):
+                chunk = self._current[self._position:self._position + size]
+                self._position += len(chunk)
+            else:
+                chunk = self._current.read(size)
+            if chunk:
+                return chunk
+            self._current = next(self._parts, None)
+            self._position = 0
+        return b''
+
+    def __iter__(self):
+        while True:
+            chunk = self.read(self._chunk_size)
+            if not chunk:
+                return
+            yield chunk
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
@@ -0,0 +1,203 @@
+import bisect
+import collections
+import math
+import threading
+
+# Наблюдения сначала добавляются в очередь (deque.append потокобезопасен и не требует блокировки),
+# а сворачиваются в итоговые значения при чтении или по достижении этого размера очереди
+FOLD_THRESHOLD = 1024
+
+
+class Counter:
+    """Потокобезопасный монотонный счетчик без блокировки при увеличении"""
+
+    __slots__ = ('_pending', '_value', '_lock')
+
+    def __init__(self):
+        self._pending = collections.deque()
+        self._value = 0
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1):
+        pending = self._pending
+        pending.append(amount)
+        # Сворачивает очередь только один поток, остальные не ждут
+        if len(pending) >= FOLD_THRESHOLD and self._lock.acquire(False):
+            try:
+                self._fold()
+            finally:
+                self._lock.release()
+
+    def _fold(self):
+        pending = self._pending
+        total = 0
+        try:
+            while True:
+                total += pending.popleft()
+        except IndexError:
+            pass
+        self._value += total
+
+    @property
+    def value(self):
+        with self._lock:
+            self._fold()
+            return self._value
+
+
+class Histogram:
+    """Гистограмма с фиксированными границами корзин (значения в секундах) без блокировки при наблюдении"""
+
+    DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+    __slots__ = ('buckets', '_pending', '_counts', '_sum', '_count', '_lock')
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        self._pending = collections.deque()
+        # Последняя корзина - для значений больше максимальной границы (+Inf)
+        self._counts = [0] * (len(self.buckets) + 1)
+        self._sum = 0.0
+        self._count = 0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        pending = self._pending
+        pending.append(value)
+        if len(pending) >= FOLD_THRESHOLD and self._lock.acquire(False):
+            try:
+                self._fold()
+            finally:
+                self._lock.release()
+
+    def _fold(self):
+        pending = self._pending
+        buckets = self.buckets
+        counts = self._counts
+        total = 0.0
+        count = 0
+        try:
+            while True:
+                value = pending.popleft()
+                counts[bisect.bisect_left(buckets, value)] += 1
+                total += value
+                count += 1
+        except IndexError:
+            pass
+        self._sum += total
+        self._count += count
+
+    def snapshot(self):
+        """Кумулятивные значения корзин, количество и сумма наблюдений"""
+        with self._lock:
+            self._fold()
+            counts = list(self._counts)
+            total_sum = self._sum
+            total_count = self._count
+        cumulative = {}
+        running = 0
+        for bound, count in zip(self.buckets, counts):
+            running += count
+            cumulative[str(bound)] = running
+        cumulative['+Inf'] = total_count
+        return {'buckets': cumulative, 'count': total_count, 'sum': total_sum}
+
+
+class Labeled:
+    """Набор счетчиков или гистограмм с метками: labels('значение', ...) возвращает метрику для набора меток"""
+
+    def __init__(self, labelnames, factory=Counter):
+        self.labelnames = tuple(labelnames)
+        self._factory = factory
+        self._children = {}
+        self._lock = threading.Lock()
+
+    def labels(self, *values):
+        child = self._children.get(values)
+        if child is None:
+            if len(values) != len(self.labelnames):
+                raise ValueError(f"Ожидаются метки {self.labelnames}, получено {values}")
+            with self._lock:
+                child = self._children.get(values)
+                if child is None:
+                    child = self._children[values] = self._factory()
+        return child
+
+    def items(self):
+        return list(self._children.items())
+
+
+def _format_value(value):
+    if isinstance(value, float):
+        if math.isinf(value):
+            return '+Inf' if value > 0 else '-Inf'
+        return repr(value)
+    return str(value)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in labels.items()) + '}'
+
+
+class Registry:
+    """Реестр метрик для вывода в текстовом формате Prometheus.
+
+    Источник метрики - Counter, Histogram, Labeled или функция, возвращающая число или список пар
+    (метки, значение); функции вызываются только при запросе метрик.
+    """
+
+    CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+    def __init__(self):
+        self._families = {}
+        self._lock = threading.Lock()
+
+    def register(self, name, kind, help_text, source, labels=None):
+        """Добавление источника метрики name (kind: counter, gauge или histogram) с постоянными метками"""
+        with self._lock:
+            family = self._families.setdefault(name, (kind, help_text, []))
+            if family[0] != kind:
+                raise ValueError(f"Метрика {name} уже зарегистрирована с типом {family[0]}")
+            family[2].append((source, dict(labels or {})))
+        return source
+
+    def _samples(self, source, labels):
+        if isinstance(source, Labeled):
+            for values, child in source.items():
+                yield from self._samples(child, dict(labels, **dict(zip(source.labelnames, values))))
+        elif isinstance(source, Histogram):
+            snapshot = source.snapshot()
+            for bound, count in snapshot['buckets'].items():
+                yield '_bucket', dict(labels, le=bound), count
+            yield '_sum', labels, snapshot['sum']
+            yield '_count', labels, snapshot['count']
+        elif isinstance(source, Counter):
+            yield '', labels, source.value
+        else:
+            result = source()
+            if isinstance(result, (int, float)):
+                yield '', labels, result
+            else:
+                for sample_labels, value in result:
+                    yield '', dict(labels, **sample_labels), value
+
+    def render(self):
+        """Все метрики в текстовом формате Prometheus"""
+        with self._lock:
+            families = [(name, kind, help_text, list(sources))
+                        for name, (kind, help_text, sources) in self._families.items()]
+        lines = []
+        for name, kind, help_text, sources in families:
+            lines.append(f'# HELP {name} {help_text}')
+            lines.append(f'# TYPE {name} {kind}')
+            for source, labels in sources:
+                for suffix, sample_labels, value in self._samples(source, labels):
+                    lines.append(f'{name}{suffix}{_format_labels(sample_labels)} {_format_value(value)}')
+        lines.append('')
+        return '\n'.join(lines)
@@ -0,0 +1,235 @@
+import asyncio
+import contextvars
+import logging
+import queue
+import threading
+import time
+
+from metrics import Counter, Histogram
+
+logger = logging.getLogger(__name__)
+
+# Маркер остановки рабочего потока
+_STOP = object()
+
+
+class OutboundDispatcher:
+    """Асинхронная отправка исходящих сообщений через ограниченную очередь и пул потоков.
+
+    У каждого потока своя очередь, а сообщения распределяются по первому аргументу
+    (номеру получателя), поэтому сообщения одному получателю отправляются по порядку.
+    """
+
+    def __init__(self, send_func, queue_size=1000, workers=4, shutdown_timeout=10.0):
+        self._send_func = send_func
+        self._workers_count = max(1, workers)
+        self._queues = [queue.Queue(maxsize=max(1, queue_size // self._workers_count))
+                        for _ in range(self._workers_count)]
+        self._shutdown_timeout = shutdown_timeout
+        self._threads = []
+        self._lock = threading.Lock()
+        self._started = False
+        self._closed = False
+
+        self.sent = Counter()
+        self.failed = Counter()
+        self.overflow = Counter()
+        self.dropped = Counter()
+        self.latency = Histogram()
+
+    def start(self):
+        """Запуск рабочих потоков (выполняется лениво при первой отправке)"""
+        with self._lock:
+            if self._started or self._closed:
+                return
+            for i, worker_queue in enumerate(self._queues):
+                thread = threading.Thread(target=self._worker, args=(worker_queue,), name=f'outbound-{i}',
+                                          daemon=True)
+                thread.start()
+                self._threads.append(thread)
+            self._started = True
+            logger.info("Запущен пул исходящих сообщений: %d потоков", self._workers_count)
+
+    def submit(self, *args):
+        """Постановка сообщения в очередь, возвращает False при переполнении или остановке"""
+        if self._closed:
+            self.dropped.inc()
+            logger.error("Очередь исходящих сообщений остановлена, сообщение отброшено")
+            return False
+        if not self._started:
+            self.start()
+        worker_queue = self._queues[hash(args[0]) % self._workers_count]
+        try:
+            # Контекст (в том числе идентификатор запроса для журнала) переносится в поток отправки
+            worker_queue.put_nowait((contextvars.copy_context(), args))
+        except queue.Full:
+            self.overflow.inc()
+            logger.error("Очередь исходящих сообщений переполнена, сообщение отброшено")
+            return False
+        return True
+
+    def _worker(self, worker_queue):
+        while True:
+            item = worker_queue.get()
+            try:
+                if item is _STOP:
+                    return
+                context, args = item
+                started = time.monotonic()
+                try:
+                    result = context.run(self._send_func, *args)
+                except Exception as e:
+                    logger.error("Ошибка в обработчике исходящих сообщений: %s", e, exc_info=True)
+                    result = None
+                self.latency.observe(time.monotonic() - started)
+                if result is None:
+                    self.failed.inc()
+                else:
+                    self.sent.inc()
+            finally:
+                worker_queue.task_done()
+
+    def shutdown(self, timeout=None):
+        """Остановка приема сообщений и дренирование очереди"""
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+            started = self._started
+        if not started:
+            return
+        timeout = self._shutdown_timeout if timeout is None else timeout
+        deadline = time.monotonic() + timeout
+        logger.info("Дренирование очереди исходящих сообщений: %d в очереди", self.depth())
+        for worker_queue in self._queues:
+            # Маркеры встают после уже поставленных сообщений, поэтому очередь дочитывается до конца
+            worker_queue.put(_STOP)
+        for thread in self._threads:
+            thread.join(max(0.0, deadline - time.monotonic()))
+        # Все, что осталось в очередях после истечения времени, считается потерянным
+        remaining = sum(1 for worker_queue in self._queues for item in list(worker_queue.queue) if item is not _STOP)
+        if remaining:
+            self.dropped.inc(remaining)
+            logger.error("Не удалось отправить %d сообщений до остановки", remaining)
+
+    def depth(self):
+        """Количество сообщений в очередях"""
+        return sum(worker_queue.qsize() for worker_queue in self._queues)
+
+    def stats(self):
+        """Текущие показатели очереди"""
+        return {
+            'queue_depth': self.depth(),
+            'queue_capacity': sum(worker_queue.maxsize for worker_queue in self._queues),
+            'workers': self._workers_count,
+            'sent': self.sent.value,
+            'failed': self.failed.value,
+            'overflow': self.overflow.value,
+            'dropped': self.dropped.value,
+            'latency': self.latency.snapshot(),
+        }
+
+
+class AsyncOutboundDispatcher:
+    """Асинхронный вариант OutboundDispatcher для asgi.py: очереди asyncio и сопрограммы-отправители.
+
+    Сопрограммы дешевы, поэтому их может быть сотни, и столько же запросов к waApi выполняется одновременно.
+    """
+
+    def __init__(self, send_func, queue_size=1000, workers=256, shutdown_timeout=10.0):
+        self._send_func = send_func
+        self._workers_count = max(1, workers)
+        self._queue_size = max(1, queue_size // self._workers_count)
+        self._shutdown_timeout = shutdown_timeout
+        self._queues = []
+        self._tasks = []
+        self._closed = False
+
+        self.sent = Counter()
+        self.failed = Counter()
+        self.overflow = Counter()
+        self.dropped = Counter()
+        self.latency = Histogram()
+
+    def start(self):
+        """Запуск сопрограмм-отправителей в текущем цикле событий"""
+        if self._tasks or self._closed:
+            return
+        self._queues = [asyncio.Queue(maxsize=self._queue_size) for _ in range(self._workers_count)]
+        self._tasks = [asyncio.ensure_future(self._worker(worker_queue)) for worker_queue in self._queues]
+        logger.info("Запущены асинхронные отправители исходящих сообщений: %d", self._workers_count)
+
+    def submit(self, *args):
+        """Постановка сообщения в очередь, возвращает False при переполнении или остановке"""
+        if self._closed:
+            self.dropped.inc()
+            logger.error("Очередь исходящих сообщений остановлена, сообщение отброшено")
+            return False
+        if not self._tasks:
+            self.start()
+        worker_queue = self._queues[hash(args[0]) % self._workers_count]
+        if worker_queue.full():
+            self.overflow.inc()
+            logger.error("Очередь исходящих сообщений переполнена, сообщение отброшено")
+            return False
+        # Контекст (идентификатор запроса для журнала) переносится в сопрограмму отправки
+        worker_queue.put_nowait((contextvars.copy_context(), args))
+        return True
+
+    async def _worker(self, worker_queue):
+        while True:
+            item = await worker_queue.get()
+            try:
+                if item is _STOP:
+                    return
+                context, args = item
+                started = time.monotonic()
+                try:
+                    # Задача создается внутри контекста сообщения и получает его копию
+                    result = await context.run(asyncio.ensure_future, self._send_func(*args))
+                except Exception as e:
+                    logger.error("Ошибка в обработчике исходящих сообщений: %s", e, exc_info=True)
+                    result = None
+                self.latency.observe(time.monotonic() - started)
+                if result is None:
+                    self.failed.inc()
+                else:
+                    self.sent.inc()
+            finally:
+                worker_queue.task_done()
+
+    async def shutdown(self, timeout=None):
+        """Остановка приема сообщений и дренирование очередей"""
+        if self._closed:
+            return
+        self._closed = True
+        if not self._tasks:
+            return
+        timeout = self._shutdown_timeout if timeout is None else timeout
+        for worker_queue in self._queues:
+            # Маркеры встают после уже поставленных сообщений, поэтому очереди дочитываются до конца
+            await worker_queue.put(_STOP)
+        done, pending = await asyncio.wait(self._tasks, timeout=timeout)
+        for task in pending:
+            task.cancel()
+        remaining = self.depth()
+        if remaining:
+            self.dropped.inc(remaining)
+            logger.error("Не удалось отправить %d сообщений до остановки", remaining)
+
+    def depth(self):
+        """Количество сообщений в очередях"""
+        return sum(worker_queue.qsize() for worker_queue in self._queues)
+
+    def stats(self):
+        """Текущие показатели очереди"""
+        return {
+            'queue_depth': self.depth(),
+            'queue_capacity': self._queue_size * self._workers_count,
+            'workers': self._workers_count,
+            'sent': self.sent.value,
+            'failed': self.failed.value,
+            'overflow': self.overflow.value,
+            'dropped': self.dropped.value,
+            'latency': self.latency.snapshot(),
+        }
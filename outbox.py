@@ -0,0 +1,288 @@
+import fcntl
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from metrics import Counter
+
+logger = logging.getLogger(__name__)
+
+
+class RejectedError(Exception):
+    """Получатель окончательно отклонил заявку (например, Trello ответил 400 на неверный список): повтор
+    без изменения заявки не поможет"""
+
+
+class Outbox:
+    """Журнал заявок для Trello с фоновой повторной отправкой.
+
+    Каждая заявка записывается строкой JSON в журнал до отправки в Trello.
+    Успешно отправленные заявки отмечаются в файле подтверждений (<path>.acks),
+    а смещение, до которого все заявки подтверждены, хранится в <path>.checkpoint.
+    Повторную отправку выполняет только один процесс - тот, кто удерживает <path>.lock.
+
+    Заявка, которую получатель отклонил (deliver_func вызвал RejectedError или другое исключение)
+    max_attempts раз, переносится в <path>.dead и отмечается подтвержденной, чтобы контрольная точка
+    прошла дальше и журнал мог очиститься. Неудачи без исключения (сервис недоступен) не считаются.
+    """
+
+    def __init__(self, path, deliver_func, fsync_batch=16, fsync_interval=1.0, replay_interval=15.0,
+                 replay_concurrency=4, replay_delay=60.0, replay_batch=500, max_attempts=5):
+        self.path = path
+        self._acks_path = path + '.acks'
+        self._dead_path = path + '.dead'
+        self._checkpoint_path = path + '.checkpoint'
+        self._leader_path = path + '.lock'
+        self._deliver_func = deliver_func
+        self._fsync_batch = max(1, fsync_batch)
+        self._fsync_interval = fsync_interval
+        self._replay_interval = replay_interval
+        self._replay_concurrency = max(1, replay_concurrency)
+        # Заявки моложе этого возраста еще могут отправляться напрямую из webhook
+        self._replay_delay = replay_delay
+        self._replay_batch = replay_batch
+        self._max_attempts = max(1, max_attempts)
+
+        self._lock = threading.Lock()
+        self._journal = open(path, 'ab')
+        self._acks = open(self._acks_path, 'ab')
+        self._unsynced = 0
+        self._leader_file = None
+        self._stop_event = threading.Event()
+        self._threads = []
+
+        # Состояние повторной отправки (используется только процессом-лидером)
+        self._acked = set()
+        self._acks_offset = 0
+        self._checkpoint = self._read_checkpoint()
+        # Отклоненные попытки отправки по идентификатору заявки
+        self._attempts = {}
+
+        self.appended = Counter()
+        self.delivered = Counter()
+        self.replay_failed = Counter()
+        self.dead_lettered = Counter()
+
+    # --- Запись ---
+
+    def _append_line(self, file, line):
+        with self._lock:
+            fcntl.flock(self._journal, fcntl.LOCK_EX)
+            try:
+                file.write(line)
+                file.flush()
+            finally:
+                fcntl.flock(self._journal, fcntl.LOCK_UN)
+            self._unsynced += 1
+            if self._unsynced >= self._fsync_batch:
+                self._sync_locked()
+
+    def _sync_locked(self):
+        if self._unsynced:
+            os.fsync(self._journal.fileno())
+            os.fsync(self._acks.fileno())
+            self._unsynced = 0
+
+    def sync(self):
+        """Принудительная запись журнала на диск"""
+        with self._lock:
+            self._sync_locked()
+
+    def append(self, record):
+        """Запись заявки в журнал, возвращает ее идентификатор"""
+        record = dict(record)
+        record.setdefault('id', uuid.uuid4().hex)
+        record.setdefault('created_at', time.time())
+        line = json.dumps(record, ensure_ascii=False).encode('utf-8') + b'\n'
+        self._append_line(self._journal, line)
+        self.appended.inc()
+        return record['id']
+
+    def ack(self, record_id):
+        """Отметка об успешной отправке заявки"""
+        self._append_line(self._acks, record_id.encode('ascii') + b'\n')
+
+    # --- Повторная отправка ---
+
+    def _read_checkpoint(self):
+        try:
+            with open(self._checkpoint_path, 'r') as f:
+                return int(f.read().strip() or 0)
+        except (OSError, ValueError):
+            return 0
+
+    def _write_checkpoint(self, offset):
+        tmp_path = self._checkpoint_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            f.write(str(offset))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self._checkpoint_path)
+        self._checkpoint = offset
+
+    def _is_leader(self):
+        if self._leader_file is not None:
+            return True
+        leader_file = open(self._leader_path, 'a')
+        try:
+            fcntl.flock(leader_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            leader_file.close()
+            return False
+        self._leader_file = leader_file
+        logger.info("Процесс отвечает за повторную отправку заявок в Trello")
+        return True
+
+    def _load_acks(self):
+        """Дочитывание новых подтверждений, в том числе записанных другими процессами"""
+        with open(self._acks_path, 'rb') as f:
+            f.seek(0, os.SEEK_END)
+            if f.tell() < self._acks_offset:
+                # Файл был сжат
+                self._acks_offset = 0
+            f.seek(self._acks_offset)
+            for line in f:
+                if not line.endswith(b'\n'):
+                    break
+                self._acks_offset += len(line)
+                self._acked.add(line.strip().decode('ascii', 'ignore'))
+
+    def _scan(self):
+        """Проход по журналу от контрольной точки.
+
+        Возвращает новое смещение контрольной точки и список неотправленных заявок.
+        """
+        checkpoint = self._checkpoint
+        contiguous = True
+        pending = []
+        now = time.time()
+        with open(self.path, 'rb') as f:
+            f.seek(checkpoint)
+            offset = checkpoint
+            for line in f:
+                if not line.endswith(b'\n'):
+                    # Незавершенная запись в конце журнала
+                    break
+                offset += len(line)
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    logger.error("Поврежденная запись в журнале заявок на смещении %d", offset - len(line))
+                    record = None
+                if record is None or record.get('id') in self._acked:
+                    if contiguous:
+                        checkpoint = offset
+                    continue
+                contiguous = False
+                if now - record.get('created_at', 0) >= self._replay_delay and len(pending) < self._replay_batch:
+                    pending.append(record)
+        return checkpoint, pending
+
+    def _compact(self):
+        """Очистка журнала, если все заявки подтверждены"""
+        with self._lock:
+            fcntl.flock(self._journal, fcntl.LOCK_EX)
+            try:
+                if os.path.getsize(self.path) != self._checkpoint:
+                    return
+                self._journal.truncate(0)
+                self._acks.truncate(0)
+                self._acked.clear()
+                self._attempts.clear()
+                self._acks_offset = 0
+                self._write_checkpoint(0)
+            finally:
+                fcntl.flock(self._journal, fcntl.LOCK_UN)
+
+    def _deliver(self, record):
+        try:
+            if self._deliver_func(record):
+                self.ack(record['id'])
+                self._acked.add(record['id'])
+                self._attempts.pop(record['id'], None)
+                self.delivered.inc()
+                return True
+        except Exception as e:
+            logger.error("Ошибка при повторной отправке заявки %s: %s", record.get('id'), e)
+            attempts = self._attempts.get(record['id'], 0) + 1
+            self._attempts[record['id']] = attempts
+            if attempts >= self._max_attempts:
+                self._dead_letter(record, e, attempts)
+        self.replay_failed.inc()
+        return False
+
+    def _dead_letter(self, record, error, attempts):
+        """Перенос отклоненной заявки в <path>.dead: повторная отправка прекращается"""
+        entry = dict(record, dead_at=time.time(), attempts=attempts, error=str(error)[:500])
+        line = json.dumps(entry, ensure_ascii=False).encode('utf-8') + b'\n'
+        with self._lock:
+            with open(self._dead_path, 'ab') as f:
+                f.write(line)
+                f.flush()
+                os.fsync(f.fileno())
+        self.ack(record['id'])
+        self._acked.add(record['id'])
+        self._attempts.pop(record['id'], None)
+        self.dead_lettered.inc()
+        logger.error("Заявка %s отклонена %d раз и перенесена в %s: %s",
+                     record['id'], attempts, self._dead_path, error)
+
+    def replay_once(self):
+        """Один цикл повторной отправки, возвращает количество отправленных заявок"""
+        if not self._is_leader():
+            return 0
+        self._load_acks()
+        checkpoint, pending = self._scan()
+        delivered = 0
+        if pending:
+            logger.info("Повторная отправка в Trello: %d заявок", len(pending))
+            with ThreadPoolExecutor(max_workers=self._replay_concurrency) as executor:
+                delivered = sum(executor.map(self._deliver, pending))
+            self._load_acks()
+            checkpoint, _ = self._scan()
+        if checkpoint != self._checkpoint:
+            self._write_checkpoint(checkpoint)
+        if self._checkpoint and self._checkpoint == os.path.getsize(self.path):
+            self._compact()
+        return delivered
+
+    def _replay_loop(self):
+        while not self._stop_event.wait(self._replay_interval):
+            try:
+                # Пока заявки отправляются полными пачками, продолжаем без паузы
+                while self.replay_once() >= self._replay_batch and not self._stop_event.is_set():
+                    pass
+            except Exception as e:
+                logger.error("Ошибка в цикле повторной отправки заявок: %s", e, exc_info=True)
+
+    def _sync_loop(self):
+        while not self._stop_event.wait(self._fsync_interval):
+            self.sync()
+
+    def start(self):
+        """Запуск фоновой записи на диск и повторной отправки"""
+        for target, name in ((self._sync_loop, 'outbox-sync'), (self._replay_loop, 'outbox-replay')):
+            thread = threading.Thread(target=target, name=name, daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self):
+        """Остановка фоновых потоков с записью журнала на диск"""
+        self._stop_event.set()
+        for thread in self._threads:
+            thread.join(timeout=self._replay_interval)
+        self.sync()
+
+    def stats(self):
+        return {
+            'appended': self.appended.value,
+            'delivered': self.delivered.value,
+            'replay_failed': self.replay_failed.value,
+            'dead_lettered': self.dead_lettered.value,
+            'checkpoint': self._checkpoint,
+            'journal_bytes': os.path.getsize(self.path),
+        }
@@ -0,0 +1,220 @@
+import asyncio
+import heapq
+import itertools
+import logging
+import threading
+import time
+
+from metrics import Counter, Histogram, Labeled
+
+logger = logging.getLogger(__name__)
+
+# Приоритеты отправки: меньшее значение обслуживается раньше
+PRIORITY_INTERACTIVE = 0   # ответы в диалоге
+PRIORITY_RETRY = 1         # повторы после ошибки
+PRIORITY_BULK = 2          # массовые рассылки
+PRIORITY_NAMES = {PRIORITY_INTERACTIVE: 'interactive', PRIORITY_RETRY: 'retry', PRIORITY_BULK: 'bulk'}
+
+# Границы гистограммы ожидания: при темпе в несколько сообщений в секунду ожидание измеряется секундами
+WAIT_BUCKETS = (0.001, 0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+class _BucketBase:
+    """Общая часть синхронного и асинхронного ведра токенов.
+
+    Токены пополняются со скоростью rate в секунду до burst. Ожидающие обслуживаются в порядке
+    приоритета, а при равном приоритете - в порядке поступления.
+    """
+
+    def __init__(self, rate, burst):
+        self.rate = float(rate)
+        self.burst = max(1.0, float(burst))
+        self._tokens = self.burst
+        self._updated = time.monotonic()
+        self._waiters = []
+        self._sequence = itertools.count()
+
+        self.acquired = Labeled(('priority',))
+        self.wait_time = Labeled(('priority',), lambda: Histogram(WAIT_BUCKETS))
+        self.throttled = Counter()
+
+    def _refill(self, now):
+        if now > self._updated:
+            self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+
+    def _take(self, waiter):
+        """Выдача токена ожидающему в начале очереди, иначе время до появления токена"""
+        self._refill(time.monotonic())
+        if self._waiters[0] is not waiter:
+            return None
+        if self._tokens >= 1:
+            self._tokens -= 1
+            heapq.heappop(self._waiters)
+            if self._waiters:
+                # Следующий в очереди начинает ждать свой токен
+                self._waiters[0][2].set()
+            return 0.0
+        return (1 - self._tokens) / self.rate
+
+    def _try_fast(self):
+        """Токен без ожидания, если очередь пуста"""
+        if self._waiters:
+            return False
+        self._refill(time.monotonic())
+        if self._tokens >= 1:
+            self._tokens -= 1
+            return True
+        return False
+
+    def _enqueue(self, priority, event):
+        waiter = [priority, next(self._sequence), event]
+        heapq.heappush(self._waiters, waiter)
+        return waiter
+
+    def _remove(self, waiter):
+        """Удаление ожидающего, прерванного исключением или отменой"""
+        if waiter in self._waiters:
+            was_head = self._waiters[0] is waiter
+            self._waiters.remove(waiter)
+            heapq.heapify(self._waiters)
+            if was_head and self._waiters:
+                self._waiters[0][2].set()
+
+    def _record(self, priority, started):
+        name = PRIORITY_NAMES.get(priority, str(priority))
+        self.acquired.labels(name).inc()
+        self.wait_time.labels(name).observe(time.monotonic() - started)
+
+    def throttle(self, seconds):
+        """Пауза в выдаче токенов (например, по Retry-After при ответе 429)"""
+        self._refill(time.monotonic())
+        self._tokens = min(self._tokens, -seconds * self.rate)
+        self.throttled.inc()
+        logger.warning("Отправка приостановлена на %.1f с по ответу сервиса", seconds)
+
+    def level(self):
+        """Текущее количество токенов"""
+        self._refill(time.monotonic())
+        return self._tokens
+
+    def waiting(self):
+        """Количество ожидающих по приоритетам"""
+        counts = {}
+        for priority, _, _ in list(self._waiters):
+            name = PRIORITY_NAMES.get(priority, str(priority))
+            counts[name] = counts.get(name, 0) + 1
+        return counts
+
+    def stats(self):
+        self._refill(time.monotonic())
+        return {
+            'rate': self.rate,
+            'burst': self.burst,
+            'tokens': round(self._tokens, 3),
+            'waiting': self.waiting(),
+            'throttled': self.throttled.value,
+            'acquired': {values[0]: counter.value for values, counter in self.acquired.items()},
+            'wait_time': {values[0]: histogram.snapshot() for values, histogram in self.wait_time.items()},
+        }
+
+
+class TokenBucket(_BucketBase):
+    """Ведро токенов для потоков: acquire ждет своей очереди и токена, а не отказывает"""
+
+    def __init__(self, rate, burst):
+        super().__init__(rate, burst)
+        self._lock = threading.Lock()
+
+    def acquire(self, priority=PRIORITY_INTERACTIVE):
+        """Ожидание токена, возвращает время ожидания в секундах"""
+        started = time.monotonic()
+        with self._lock:
+            if self._try_fast():
+                self._record(priority, started)
+                return 0.0
+            waiter = self._enqueue(priority, threading.Event())
+        try:
+            while True:
+                with self._lock:
+                    waiter[2].clear()
+                    delay = self._take(waiter)
+                if delay == 0.0:
+                    break
+                # Первый в очереди спит до появления токена, остальные - до сигнала, что они стали первыми
+                if delay is None:
+                    waiter[2].wait()
+                else:
+                    time.sleep(delay)
+        except BaseException:
+            with self._lock:
+                self._remove(waiter)
+            raise
+        self._record(priority, started)
+        return time.monotonic() - started
+
+    def throttle(self, seconds):
+        with self._lock:
+            super().throttle(seconds)
+
+    def level(self):
+        with self._lock:
+            return super().level()
+
+    def stats(self):
+        with self._lock:
+            return super().stats()
+
+
+class AsyncTokenBucket(_BucketBase):
+    """Ведро токенов для сопрограмм (asgi.py)"""
+
+    async def acquire(self, priority=PRIORITY_INTERACTIVE):
+        """Ожидание токена, возвращает время ожидания в секундах"""
+        started = time.monotonic()
+        if self._try_fast():
+            self._record(priority, started)
+            return 0.0
+        waiter = self._enqueue(priority, asyncio.Event())
+        try:
+            while True:
+                waiter[2].clear()
+                delay = self._take(waiter)
+                if delay == 0.0:
+                    break
+                if delay is None:
+                    await waiter[2].wait()
+                else:
+                    await asyncio.sleep(delay)
+        except BaseException:
+            self._remove(waiter)
+            raise
+        self._record(priority, started)
+        return time.monotonic() - started
+
+
+class InstanceRateLimiter:
+    """Ведра токенов по идентификатору экземпляра WhatsApp (WAAPI_INSTANCE_ID)"""
+
+    def __init__(self, rate, burst, bucket_class=TokenBucket):
+        self.rate = rate
+        self.burst = burst
+        self._bucket_class = bucket_class
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def bucket(self, instance_id):
+        """Ведро экземпляра или None, если ограничение выключено (rate <= 0)"""
+        if self.rate <= 0:
+            return None
+        bucket = self._buckets.get(instance_id)
+        if bucket is None:
+            with self._lock:
+                bucket = self._buckets.setdefault(instance_id, self._bucket_class(self.rate, self.burst))
+        return bucket
+
+    def items(self):
+        return list(self._buckets.items())
+
+    def stats(self):
+        return {str(instance_id): bucket.stats() for instance_id, bucket in self.items()}
@@ -0,0 +1,344 @@
+import fcntl
+import gc
+import logging
+import marshal
+import os
+import signal
+import struct
+import threading
+import time
+import zlib
+
+from metrics import Counter
+from session_store import Session
+
+logger = logging.getLogger(__name__)
+
+# Сигнатура базового снимка (меняется вместе с форматом записей)
+SNAPSHOT_MAGIC = b'WBS1'
+# Заголовок снимка: сигнатура, поколение, CRC32 и длина данных
+_BASE_HEADER = struct.Struct('<4sIIQ')
+# Заголовок записи журнала: поколение, CRC32 и длина данных
+_FRAME_HEADER = struct.Struct('<III')
+
+# Журнал меньше этого размера не сжимается в новый снимок, даже если он больше снимка
+COMPACT_MIN_BYTES = 1024 * 1024
+
+
+class SnapshotError(ValueError):
+    """Файл снимка сессий поврежден или записан в другом формате"""
+
+
+class SessionSnapshot:
+    """Снимок сессий MemorySessionStore на диске для восстановления диалогов после перезапуска.
+
+    Файл path - базовый снимок всех сессий, <path>.journal - журнал изменений после него: раз в interval
+    секунд фоновый поток дописывает в журнал сессии, измененные или удаленные с прошлой записи. Когда журнал
+    становится больше compact_ratio размеров снимка, пишется новый снимок (через временный файл) и журнал
+    очищается. Записи журнала помечены поколением снимка, поэтому журнал, не очищенный из-за сбоя после
+    замены снимка, не применяется к новому снимку. Сессии и записи журнала хранятся в формате marshal,
+    неполная запись в конце журнала (сбой во время записи) отбрасывается по CRC32.
+
+    Время последнего сохранения сессии переводится в абсолютное: сессии, простаивавшие вместе с процессом,
+    удаляются по SESSION_IDLE_TTL как обычно. Пишет только процесс, удерживающий <path>.lock.
+    """
+
+    def __init__(self, path, store, interval=1.0, compact_ratio=1.0):
+        self.path = path
+        self.store = store
+        self.interval = interval
+        self.compact_ratio = compact_ratio
+        self._journal_path = path + '.journal'
+        self._lock_path = path + '.lock'
+        self._lock_file = None
+        self._journal = None
+        self._generation = 0
+        self._base_bytes = 0
+        self._journal_bytes = 0
+        self._write_lock = threading.Lock()
+        self._stop_event = threading.Event()
+        self._thread = None
+        self._disabled = False
+        # Журнал после сбоя записи не удалось вернуть к последней целой записи: следующая запись - новый снимок
+        self._compact_pending = False
+
+        self.restored = 0
+        self.restore_ms = None
+        self.journaled = Counter()
+        self.compactions = Counter()
+        self.errors = Counter()
+
+    # --- Формат ---
+
+    @staticmethod
+    def _records(items):
+        """Записи сессий: (ключ, состояние, тип, язык, данные, время сохранения); удаленная - (ключ,)"""
+        offset = int(time.time() - time.monotonic())
+        records = []
+        for key, session in items:
+            if session is None:
+                records.append((key,))
+            else:
+                records.append((key, session.state, session.user_type, session.language, session.data,
+                                session.touched_at + offset))
+        return records
+
+    @staticmethod
+    def _apply(sessions, records, offset):
+        for record in records:
+            sessions.pop(record[0], None)
+            if len(record) > 1:
+                key, state, user_type, language, data, touched_at = record
+                sessions[key] = Session(state, user_type, language, data, touched_at - offset)
+
+    def _read_base(self):
+        """Поколение и записи базового снимка (0 и пустой список, если снимка нет)"""
+        try:
+            with open(self.path, 'rb') as f:
+                raw = f.read()
+        except FileNotFoundError:
+            return 0, []
+        if len(raw) < _BASE_HEADER.size:
+            raise SnapshotError("снимок короче заголовка")
+        magic, generation, crc, length = _BASE_HEADER.unpack_from(raw)
+        payload = memoryview(raw)[_BASE_HEADER.size:]
+        if magic != SNAPSHOT_MAGIC or len(payload) != length or zlib.crc32(payload) != crc:
+            raise SnapshotError("неизвестный формат или поврежденные данные")
+        self._base_bytes = len(raw)
+        return generation, marshal.loads(payload)
+
+    def _read_journal(self, generation):
+        """Записи журнала текущего поколения и смещение конца последней целой записи"""
+        try:
+            with open(self._journal_path, 'rb') as f:
+                raw = f.read()
+        except FileNotFoundError:
+            return [], 0
+        batches = []
+        offset = 0
+        while offset + _FRAME_HEADER.size <= len(raw):
+            frame_generation, crc, length = _FRAME_HEADER.unpack_from(raw, offset)
+            payload = memoryview(raw)[offset + _FRAME_HEADER.size:offset + _FRAME_HEADER.size + length]
+            if len(payload) != length or zlib.crc32(payload) != crc:
+                break
+            if frame_generation == generation:
+                batches.append(marshal.loads(payload))
+            offset += _FRAME_HEADER.size + length
+        if offset != len(raw):
+            logger.warning("Журнал снимка сессий обрезан до последней целой записи: %d из %d байт", offset, len(raw))
+        return batches, offset
+
+    # --- Восстановление ---
+
+    def restore(self):
+        """Загрузка сессий из снимка и журнала в хранилище (при запуске, до обработки запросов)"""
+        started = time.perf_counter()
+        # Сотни тысяч объектов создаются подряд и все остаются живыми: сборка мусора во время загрузки
+        # только замедляет ее в несколько раз
+        gc_enabled = gc.isenabled()
+        gc.disable()
+        try:
+            return self._restore(started)
+        finally:
+            if gc_enabled:
+                gc.enable()
+
+    def _restore(self, started):
+        try:
+            generation, records = self._read_base()
+            batches, journal_end = self._read_journal(generation)
+            offset = int(time.time() - time.monotonic())
+            # Базовый снимок не содержит удалений и повторов ключей
+            sessions = {record[0]: Session(record[1], record[2], record[3], record[4], record[5] - offset)
+                        for record in records}
+            for batch in batches:
+                self._apply(sessions, batch, offset)
+        except (SnapshotError, ValueError, EOFError, TypeError, IndexError) as e:
+            # Снимок другого формата (например, после смены версии Python) или поврежден: диалоги начинаются
+            # заново, файлы сохраняются для разбора (если их не пишет другой процесс)
+            logger.error("Снимок сессий %s не загружен: %s", self.path, e)
+            self.errors.inc()
+            if self._acquire():
+                for path in (self.path, self._journal_path):
+                    if os.path.exists(path):
+                        os.replace(path, path + '.corrupt')
+            generation, records, batches, journal_end, sessions = 0, [], [], 0, {}
+            self._base_bytes = 0
+        self.store.restore(sessions)
+        # Неполная запись в конце журнала отбрасывается, только если журнал не пишет другой процесс:
+        # его незаконченная запись - не сбой
+        if (os.path.exists(self._journal_path) and os.path.getsize(self._journal_path) > journal_end
+                and self._acquire()):
+            with open(self._journal_path, 'r+b') as f:
+                f.truncate(journal_end)
+        self._generation = generation
+        self._journal_bytes = journal_end
+        self.restored = len(sessions)
+        self.restore_ms = round((time.perf_counter() - started) * 1000, 1)
+        if sessions or records:
+            logger.info("Восстановлено сессий из снимка: %d за %s мс (записей журнала: %d)",
+                        len(sessions), self.restore_ms, sum(len(batch) for batch in batches))
+        return len(sessions)
+
+    # --- Запись ---
+
+    def _acquire(self):
+        """Блокировка файлов снимка: несколько процессов не должны писать в один журнал"""
+        if self._lock_file is not None:
+            return True
+        if self._disabled:
+            return False
+        lock_file = open(self._lock_path, 'a')
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            lock_file.close()
+            logger.error("Снимок сессий %s записывает другой процесс: в этом процессе снимок отключен "
+                         "(для нескольких процессов используйте SESSION_BACKEND=sqlite)", self.path)
+            self._disabled = True
+            self.store.track_changes(False)
+            return False
+        self._lock_file = lock_file
+        return True
+
+    def flush(self):
+        """Запись изменений в журнал и, если журнал вырос, нового снимка. Возвращает число записанных сессий"""
+        with self._write_lock:
+            if self._disabled:
+                return 0
+            changes = self.store.drain_changes()
+            if not (changes or self._compact_pending) or not self._acquire():
+                return 0
+            try:
+                if self._journal is None:
+                    # Без буфера: после сбоя в буфере не остается части записи, которая попала бы в журнал позже
+                    self._journal = open(self._journal_path, 'ab', buffering=0)
+                if self._compact_pending:
+                    # Новый снимок содержит все сессии хранилища, в том числе изменения changes
+                    self._compact()
+                    return len(changes)
+                payload = marshal.dumps(self._records(changes))
+                frame = memoryview(_FRAME_HEADER.pack(self._generation, zlib.crc32(payload), len(payload)) + payload)
+                while frame:
+                    frame = frame[self._journal.write(frame):]
+                os.fsync(self._journal.fileno())
+            except BaseException:
+                # Изменения вернутся в следующую запись, а неполная запись не должна остаться перед ней:
+                # при загрузке журнал читается только до первой поврежденной записи
+                self.store.requeue_changes(key for key, _ in changes)
+                self._rollback_journal()
+                raise
+            self._journal_bytes += _FRAME_HEADER.size + len(payload)
+            self.journaled.inc(len(changes))
+            if self._journal_bytes > max(COMPACT_MIN_BYTES, self._base_bytes * self.compact_ratio):
+                self._compact()
+            return len(changes)
+
+    def _rollback_journal(self):
+        """Возврат журнала к концу последней целой записи после сбоя записи"""
+        if self._compact_pending or self._journal is None:
+            return
+        try:
+            self._journal.truncate(self._journal_bytes)
+            self._journal.seek(self._journal_bytes)
+        except OSError as e:
+            logger.error("Журнал снимка сессий не возвращен к последней целой записи: %s", e)
+            try:
+                self._journal.close()
+            except OSError:
+                pass
+            self._journal = None
+            self._compact_pending = True
+
+    def _compact(self):
+        """Новый базовый снимок всех сессий и очистка журнала"""
+        started = time.perf_counter()
+        generation = self._generation + 1
+        # Если снимок прервется после замены файла, записи журнала старого поколения будут пропущены при загрузке:
+        # до успешного завершения следующая запись - снова новый снимок, а не журнал
+        self._compact_pending = True
+        payload = marshal.dumps(self._records(self.store.snapshot()))
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(_BASE_HEADER.pack(SNAPSHOT_MAGIC, generation, zlib.crc32(payload), len(payload)))
+            f.write(payload)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+        # Сбой до очистки журнала безопасен: записи старого поколения при загрузке пропускаются
+        self._journal.truncate(0)
+        self._generation = generation
+        self._base_bytes = _BASE_HEADER.size + len(payload)
+        self._journal_bytes = 0
+        self._compact_pending = False
+        self.compactions.inc()
+        logger.info("Записан снимок сессий: %d байт за %.0f мс", self._base_bytes,
+                    (time.perf_counter() - started) * 1000)
+
+    def _run(self):
+        while not self._stop_event.wait(self.interval):
+            try:
+                self.flush()
+            except Exception as e:
+                self.errors.inc()
+                logger.error("Ошибка при записи снимка сессий: %s", e, exc_info=True)
+
+    def start(self):
+        """Учет изменений в хранилище и запуск фоновой записи"""
+        if self._thread is not None or self._disabled:
+            return
+        self.store.track_changes()
+        self._thread = threading.Thread(target=self._run, name='session-snapshot', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """Остановка фоновой записи с записью последних изменений"""
+        self._stop_event.set()
+        if self._thread is not None:
+            self._thread.join(timeout=self.interval + 5)
+        try:
+            written = self.flush()
+        except Exception as e:
+            self.errors.inc()
+            logger.error("Ошибка при записи снимка сессий при остановке: %s", e, exc_info=True)
+            return
+        if written:
+            logger.info("При остановке в журнал снимка записано сессий: %d", written)
+
+    def flush_on_signal(self, signals=(signal.SIGTERM,), timeout=5.0):
+        """Запись изменений по сигналу остановки до обработчика, установленного раньше.
+
+        Запись идет в отдельном потоке: сигнал мог прийти, пока основной поток держит блокировку хранилища.
+        Если обработчика не было, процесс завершается через SystemExit, и stop() выполняется в atexit.
+        """
+        for signum in signals:
+            try:
+                previous = signal.getsignal(signum)
+
+                def handler(signum, frame, previous=previous):
+                    writer = threading.Thread(target=self.flush, name='session-snapshot-final', daemon=True)
+                    writer.start()
+                    writer.join(timeout)
+                    if callable(previous):
+                        previous(signum, frame)
+                    elif previous != signal.SIG_IGN:
+                        raise SystemExit(128 + signum)
+
+                signal.signal(signum, handler)
+            except ValueError:
+                # Обработчики сигналов устанавливаются только в основном потоке
+                logger.debug("Обработчик сигнала %s для снимка сессий не установлен", signum)
+
+    def stats(self):
+        return {
+            'path': self.path,
+            'enabled': not self._disabled,
+            'generation': self._generation,
+            'base_bytes': self._base_bytes,
+            'journal_bytes': self._journal_bytes,
+            'restored': self.restored,
+            'restore_ms': self.restore_ms,
+            'journaled': self.journaled.value,
+            'compactions': self.compactions.value,
+            'errors': self.errors.value,
+        }
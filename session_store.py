@@ -0,0 +1,365 @@
+import collections
+import contextlib
+import itertools
+import json
+import logging
+import sqlite3
+import sys
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# Количество сессий, по которым оценивается средний размер сессии в памяти
+SIZE_SAMPLE = 100
+
+
+class Session:
+    """Сессия диалога одного пользователя"""
+
+    __slots__ = ('state', 'user_type', 'language', 'data', 'touched_at')
+
+    def __init__(self, state, user_type, language, data=None, touched_at=0):
+        self.state = state
+        self.user_type = user_type
+        self.language = language
+        # Словарь собранных полей создается только при сохранении первого поля
+        self.data = data
+        self.touched_at = touched_at
+
+    def __repr__(self):
+        return (f"Session(state={self.state!r}, user_type={self.user_type!r}, "
+                f"language={self.language!r}, data={self.data!r})")
+
+
+def approximate_size(phone_number, session):
+    """Приблизительный размер сессии в памяти вместе с ключом, в байтах"""
+    size = sys.getsizeof(phone_number) + sys.getsizeof(session)
+    if session.data:
+        size += sys.getsizeof(session.data)
+        size += sum(sys.getsizeof(value) for value in session.data.values())
+    return size
+
+
+class MemorySessionStore:
+    """Хранение сессий в памяти процесса (один процесс, данные теряются при перезапуске).
+
+    Сессии хранятся в обычном словаре в порядке последнего сохранения (сессия переставляется
+    в конец при каждом сохранении). Завершенные сессии удаляются через
+    completed_ttl секунд простоя, остальные - через idle_ttl, а при превышении max_sessions
+    удаляются самые давние.
+    """
+
+    def __init__(self, max_sessions=100000, idle_ttl=604800.0, completed_ttl=86400.0,
+                 completed_states=(), sweep_interval=60.0):
+        self._sessions = {}
+        self._lock = threading.Lock()
+        self._max_sessions = max_sessions
+        # При переполнении удаляется сразу пачка самых давних сессий
+        self._evict_batch = max(1, max_sessions // 100)
+        self._clock = 0
+        self._idle_ttl = idle_ttl
+        self._completed_ttl = completed_ttl
+        self._completed_states = frozenset(completed_states)
+        self._sweep_interval = sweep_interval
+        self._next_sweep = time.monotonic() + sweep_interval
+        self.evicted = 0
+        # Ключи сессий, измененных или удаленных после последнего снимка (None - изменения не учитываются)
+        self._changed = None
+
+    def load(self, phone_number):
+        """Сессия пользователя или None"""
+        return self._sessions.get(phone_number)
+
+    def _now(self):
+        """Время с точностью до секунды. Один объект int используется всеми сессиями этой секунды"""
+        now = int(time.monotonic())
+        if now != self._clock:
+            self._clock = now
+        return self._clock
+
+    def save(self, phone_number, session):
+        now = self._now()
+        session.touched_at = now
+        with self._lock:
+            # Удаление и повторная вставка переносят сессию в конец порядка обхода
+            self._sessions.pop(phone_number, None)
+            self._sessions[phone_number] = session
+            if self._changed is not None:
+                self._changed.add(phone_number)
+            if len(self._sessions) > self._max_sessions:
+                oldest = list(itertools.islice(self._sessions, self._evict_batch))
+                for key in oldest:
+                    del self._sessions[key]
+                self.evicted += len(oldest)
+                if self._changed is not None:
+                    self._changed.update(oldest)
+            if now >= self._next_sweep:
+                self._sweep_locked(now)
+
+    def _sweep_locked(self, now):
+        """Удаление устаревших сессий. Просмотр идет от самых давних и прекращается на свежих"""
+        self._next_sweep = now + self._sweep_interval
+        expired = []
+        for phone_number, session in self._sessions.items():
+            idle = now - session.touched_at
+            if idle < self._completed_ttl and idle < self._idle_ttl:
+                break
+            if idle >= self._idle_ttl or session.state in self._completed_states:
+                expired.append(phone_number)
+        for phone_number in expired:
+            del self._sessions[phone_number]
+        self.evicted += len(expired)
+        if self._changed is not None:
+            self._changed.update(expired)
+        if expired:
+            logger.info("Удалено устаревших сессий: %d", len(expired))
+
+    def sweep(self):
+        """Принудительное удаление устаревших сессий"""
+        with self._lock:
+            self._sweep_locked(self._now())
+
+    def delete(self, phone_number):
+        with self._lock:
+            self._sessions.pop(phone_number, None)
+            if self._changed is not None:
+                self._changed.add(phone_number)
+
+    @contextlib.contextmanager
+    def transaction(self, phone_number):
+        """Чтение и запись сессии в одной транзакции. В памяти процесса обработку отправителя уже
+        упорядочивает блокировка отправителя, поэтому дополнительная транзакция не нужна"""
+        yield
+
+    def track_changes(self, enabled=True):
+        """Включение (или отключение) учета измененных сессий для снимков (session_snapshot.py)"""
+        with self._lock:
+            self._changed = set() if enabled else None
+
+    def drain_changes(self):
+        """Изменения после прошлого вызова: список (ключ, сессия или None, если сессия удалена)"""
+        with self._lock:
+            if not self._changed:
+                return []
+            changed, self._changed = self._changed, set()
+            return [(key, self._sessions.get(key)) for key in changed]
+
+    def requeue_changes(self, keys):
+        """Возврат ключей, изменения которых не удалось записать, в учет изменений"""
+        with self._lock:
+            if self._changed is not None:
+                self._changed.update(keys)
+
+    def snapshot(self):
+        """Все сессии в порядке последнего сохранения для базового снимка; изменения учитываются заново"""
+        with self._lock:
+            if self._changed is not None:
+                self._changed = set()
+            return list(self._sessions.items())
+
+    def restore(self, sessions):
+        """Загрузка сессий из снимка (словарь в порядке последнего сохранения) при запуске"""
+        with self._lock:
+            if not self._sessions:
+                self._sessions = dict(sessions)
+            else:
+                for key, session in sessions.items():
+                    self._sessions.pop(key, None)
+                    self._sessions[key] = session
+            excess = len(self._sessions) - self._max_sessions
+            if excess > 0:
+                for key in list(itertools.islice(self._sessions, excess)):
+                    del self._sessions[key]
+                self.evicted += excess
+
+    def count(self):
+        return len(self._sessions)
+
+    def count_by_state(self):
+        """Количество сессий в каждом состоянии диалога"""
+        with self._lock:
+            sessions = list(self._sessions.values())
+        return dict(collections.Counter(session.state for session in sessions))
+
+    def iter_by_state(self, states, batch_size=1000):
+        """Номера и сессии в состояниях states. Под блокировкой копируется только список номеров"""
+        states = frozenset(states)
+        with self._lock:
+            phones = list(self._sessions)
+        for phone_number in phones:
+            session = self._sessions.get(phone_number)
+            if session is not None and session.state in states:
+                yield phone_number, session
+
+    def stats(self):
+        count = len(self._sessions)
+        with self._lock:
+            sample = list(itertools.islice(reversed(self._sessions.items()), SIZE_SAMPLE))
+        average = sum(approximate_size(phone, session) for phone, session in sample) / len(sample) if sample else 0
+        return {
+            'live_sessions': count,
+            'approx_bytes': int(average * count),
+            'evicted': self.evicted,
+        }
+
+
+class SQLiteSessionStore:
+    """Хранение сессий в SQLite (режим WAL), общее для нескольких процессов gunicorn"""
+
+    def __init__(self, path, busy_timeout_ms=5000, idle_ttl=604800.0, completed_ttl=86400.0,
+                 completed_states=(), sweep_interval=60.0):
+        self.path = path
+        self._busy_timeout_ms = busy_timeout_ms
+        self._idle_ttl = idle_ttl
+        self._completed_ttl = completed_ttl
+        self._completed_states = tuple(completed_states)
+        self._sweep_interval = sweep_interval
+        self._next_sweep = time.monotonic() + sweep_interval
+        self.evicted = 0
+        self._local = threading.local()
+        conn = self._connection()
+        conn.execute(
+            'CREATE TABLE IF NOT EXISTS sessions ('
+            ' phone TEXT PRIMARY KEY,'
+            ' state INTEGER NOT NULL,'
+            ' user_type INTEGER NOT NULL,'
+            ' language TEXT NOT NULL,'
+            ' data TEXT NOT NULL,'
+            ' updated_at REAL NOT NULL)'
+        )
+        conn.execute('CREATE INDEX IF NOT EXISTS sessions_updated_at ON sessions (updated_at)')
+        conn.execute('CREATE INDEX IF NOT EXISTS sessions_state ON sessions (state, phone)')
+        conn.commit()
+
+    def _connection(self):
+        # Соединение SQLite нельзя разделять между потоками, поэтому у каждого потока свое
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=self._busy_timeout_ms / 1000.0)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            conn.execute(f'PRAGMA busy_timeout={int(self._busy_timeout_ms)}')
+            self._local.conn = conn
+        return conn
+
+    def load(self, phone_number):
+        """Сессия пользователя или None"""
+        row = self._connection().execute(
+            'SELECT state, user_type, language, data FROM sessions WHERE phone = ?', (phone_number,)
+        ).fetchone()
+        if row is None:
+            return None
+        return Session(row[0], row[1], row[2], json.loads(row[3]) or None)
+
+    @contextlib.contextmanager
+    def transaction(self, phone_number):
+        """Чтение, изменение и запись сессии одной транзакцией BEGIN IMMEDIATE.
+
+        Блокировка отправителя действует только внутри процесса: без транзакции два процесса gunicorn
+        могут прочитать одну и ту же сессию, и запись одного из них затрет изменения другого.
+        BEGIN IMMEDIATE сразу берет блокировку записи, поэтому второй процесс ждет (busy_timeout)
+        и читает сессию уже после фиксации первого.
+        """
+        conn = self._connection()
+        if conn.in_transaction:
+            yield
+            return
+        conn.execute('BEGIN IMMEDIATE')
+        self._local.transaction = phone_number
+        try:
+            yield
+        except BaseException:
+            conn.rollback()
+            raise
+        else:
+            conn.commit()
+        finally:
+            self._local.transaction = None
+
+    def save(self, phone_number, session):
+        conn = self._connection()
+        in_transaction = getattr(self._local, 'transaction', None) is not None
+        if not in_transaction and time.monotonic() >= self._next_sweep:
+            self.sweep()
+        conn.execute(
+            'INSERT INTO sessions (phone, state, user_type, language, data, updated_at)'
+            ' VALUES (?, ?, ?, ?, ?, ?)'
+            ' ON CONFLICT(phone) DO UPDATE SET state = excluded.state, user_type = excluded.user_type,'
+            ' language = excluded.language, data = excluded.data, updated_at = excluded.updated_at',
+            (phone_number, session.state, session.user_type, session.language,
+             json.dumps(session.data or {}, ensure_ascii=False), time.time())
+        )
+        if not in_transaction:
+            conn.commit()
+
+    def sweep(self):
+        """Удаление завершенных и давно неактивных сессий"""
+        self._next_sweep = time.monotonic() + self._sweep_interval
+        now = time.time()
+        conn = self._connection()
+        cursor = conn.execute('DELETE FROM sessions WHERE updated_at < ?', (now - self._idle_ttl,))
+        removed = cursor.rowcount
+        if self._completed_states:
+            placeholders = ', '.join('?' * len(self._completed_states))
+            cursor = conn.execute(
+                f'DELETE FROM sessions WHERE updated_at < ? AND state IN ({placeholders})',
+                (now - self._completed_ttl,) + self._completed_states
+            )
+            removed += cursor.rowcount
+        conn.commit()
+        self.evicted += removed
+        if removed:
+            logger.info("Удалено устаревших сессий: %d", removed)
+
+    def delete(self, phone_number):
+        conn = self._connection()
+        conn.execute('DELETE FROM sessions WHERE phone = ?', (phone_number,))
+        conn.commit()
+
+    def count(self):
+        return self._connection().execute('SELECT COUNT(*) FROM sessions').fetchone()[0]
+
+    def count_by_state(self):
+        """Количество сессий в каждом состоянии диалога"""
+        return dict(self._connection().execute('SELECT state, COUNT(*) FROM sessions GROUP BY state').fetchall())
+
+    def iter_by_state(self, states, batch_size=1000):
+        """Номера и сессии в состояниях states, частями по batch_size строк (по возрастанию номера)"""
+        states = tuple(states)
+        if not states:
+            return
+        placeholders = ', '.join('?' * len(states))
+        last_phone = ''
+        while True:
+            rows = self._connection().execute(
+                f'SELECT phone, state, user_type, language, data FROM sessions'
+                f' WHERE state IN ({placeholders}) AND phone > ? ORDER BY phone LIMIT ?',
+                states + (last_phone, batch_size)
+            ).fetchall()
+            for phone, state, user_type, language, data in rows:
+                yield phone, Session(state, user_type, language, json.loads(data) or None)
+            if len(rows) < batch_size:
+                return
+            last_phone = rows[-1][0]
+
+    def stats(self):
+        conn = self._connection()
+        page_count = conn.execute('PRAGMA page_count').fetchone()[0]
+        page_size = conn.execute('PRAGMA page_size').fetchone()[0]
+        return {
+            'live_sessions': self.count(),
+            'approx_bytes': page_count * page_size,
+            'evicted': self.evicted,
+        }
+
+
+def create_session_store(backend, path=None, **options):
+    """Создание хранилища сессий по названию: memory или sqlite"""
+    if backend == 'memory':
+        return MemorySessionStore(**options)
+    if backend == 'sqlite':
+        logger.info("Сессии хранятся в SQLite: %s", path)
+        options.pop('max_sessions', None)
+        return SQLiteSessionStore(path, **options)
+    raise ValueError(f"Неизвестное хранилище сессий: {backend}")
@@ -0,0 +1,376 @@
+import collections
+import contextvars
+import cProfile
+import functools
+import inspect
+import logging
+import os
+import pstats
+import sys
+import threading
+import time
+
+from metrics import Counter
+
+logger = logging.getLogger(__name__)
+
+# Трассировка запроса, к которому относится текущий код (переносится в очередь отправки и задачи вместе с контекстом)
+_current_trace = contextvars.ContextVar('trace', default=None)
+
+
+class Trace:
+    """Этапы обработки одного запроса: название, начало относительно начала запроса и длительность.
+
+    Запрос завершается, когда отвечен и выполнены все отложенные этапы (отправка ответа из очереди,
+    карточка Trello в фоновой задаче): каждый отложенный этап отмечается hold() при постановке
+    и release() по окончании.
+    """
+
+    __slots__ = ('request_id', 'path', 'started', 'started_at', 'spans', 'response_time', '_pending', '_lock',
+                 '_tracer')
+
+    def __init__(self, tracer, request_id, path):
+        self.request_id = request_id
+        self.path = path
+        self.started = time.perf_counter()
+        self.started_at = time.time()
+        self.spans = []
+        self.response_time = None
+        # Сам запрос - первый незавершенный этап
+        self._pending = 1
+        self._lock = threading.Lock()
+        self._tracer = tracer
+
+    def add(self, stage, started, duration):
+        # list.append потокобезопасен: этапы добавляются из потоков и задач отправки без блокировки
+        self.spans.append((stage, started - self.started, duration))
+
+    def hold(self):
+        with self._lock:
+            self._pending += 1
+
+    def release(self):
+        with self._lock:
+            self._pending -= 1
+            finished = self._pending == 0
+        if finished:
+            self._tracer.finish(self)
+
+    def breakdown(self):
+        """Суммарное время по этапам (сек) в порядке первого появления"""
+        stages = {}
+        for stage, _, duration in self.spans:
+            stages[stage] = stages.get(stage, 0.0) + duration
+        return stages
+
+
+class _Span:
+    __slots__ = ('trace', 'stage', 'release', 'started')
+
+    def __init__(self, trace, stage, release):
+        self.trace = trace
+        self.stage = stage
+        self.release = release
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.trace.add(self.stage, self.started, time.perf_counter() - self.started)
+        if self.release:
+            self.trace.release()
+
+
+class _NullSpan:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+
+_NULL_SPAN = _NullSpan()
+
+
+def span(stage, release=False):
+    """Измерение этапа stage текущего запроса (вне трассируемого запроса ничего не делает).
+
+    release=True - этап отложенный: по окончании снимается отметка hold(), сделанная при его постановке.
+    """
+    trace = _current_trace.get()
+    if trace is None:
+        return _NULL_SPAN
+    return _Span(trace, stage, release)
+
+
+def hold():
+    """Отметка об отложенном этапе текущего запроса перед постановкой в очередь или задачу, возвращает трассировку"""
+    trace = _current_trace.get()
+    if trace is not None:
+        trace.hold()
+    return trace
+
+
+def release(trace):
+    """Снятие отметки hold(), если отложенный этап не был поставлен (очередь переполнена)"""
+    if trace is not None:
+        trace.release()
+
+
+def traced(stage, func):
+    """Функция func как отложенный этап stage: вызов в контексте запроса снимает отметку hold() при постановке"""
+    if inspect.iscoroutinefunction(func):
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            with span(stage, release=True):
+                return await func(*args, **kwargs)
+    else:
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with span(stage, release=True):
+                return func(*args, **kwargs)
+    return wrapper
+
+
+class Tracer:
+    """Трассировка запросов с записью медленных: если запрос вместе с отложенными этапами занял больше
+    slow_threshold секунд, в журнал пишется разбивка по этапам, а запись сохраняется в последних slow_log_size.
+
+    slow_threshold <= 0 отключает трассировку: span() ничего не измеряет.
+    """
+
+    def __init__(self, slow_threshold=1.0, slow_log_size=100):
+        self.slow_threshold = slow_threshold
+        self.enabled = slow_threshold > 0
+        self.traced = Counter()
+        self.slow = Counter()
+        self._slow_log = collections.deque(maxlen=max(1, slow_log_size))
+
+    def begin(self, request_id, path):
+        """Начало трассировки запроса в текущем контексте (None, если трассировка отключена)"""
+        if not self.enabled:
+            return None
+        trace = Trace(self, request_id, path)
+        _current_trace.set(trace)
+        return trace
+
+    def end(self, trace):
+        """Ответ на запрос отправлен: запрос завершается, если отложенных этапов нет"""
+        if trace is None:
+            return
+        _current_trace.set(None)
+        trace.response_time = time.perf_counter() - trace.started
+        trace.release()
+
+    def finish(self, trace):
+        total = time.perf_counter() - trace.started
+        self.traced.inc()
+        if total < self.slow_threshold:
+            return
+        self.slow.inc()
+        # Запись собирается при чтении (/debug/slow), здесь сохраняется только трассировка
+        self._slow_log.append((trace, total))
+        if logger.isEnabledFor(logging.WARNING):
+            stages = ', '.join(f'{stage} {duration * 1000:.0f} мс' for stage, duration in trace.breakdown().items())
+            logger.warning("Медленный запрос %s: %.0f мс (ответ через %.0f мс), этапы: %s", trace.path, total * 1000,
+                           (trace.response_time or total) * 1000, stages)
+
+    @staticmethod
+    def _record(trace, total):
+        stages = trace.breakdown()
+        return {
+            'request_id': trace.request_id,
+            'path': trace.path,
+            'started_at': trace.started_at,
+            'total_ms': round(total * 1000, 3),
+            'response_ms': round((trace.response_time or total) * 1000, 3),
+            # Время вне измеренных этапов: ожидание блокировок и очереди отправки, ответ сервера
+            'unaccounted_ms': round(max(0.0, total - sum(stages.values())) * 1000, 3),
+            'stages': {stage: round(duration * 1000, 3) for stage, duration in stages.items()},
+            'spans': [[stage, round(offset * 1000, 3), round(duration * 1000, 3)]
+                      for stage, offset, duration in sorted(trace.spans, key=lambda item: item[1])],
+        }
+
+    def slow_requests(self, limit=None):
+        """Последние медленные запросы, новые первыми"""
+        records = list(self._slow_log)[::-1]
+        return [self._record(trace, total) for trace, total in (records[:limit] if limit else records)]
+
+    def stats(self):
+        return {
+            'enabled': self.enabled,
+            'slow_threshold_ms': self.slow_threshold * 1000,
+            'traced': self.traced.value,
+            'slow': self.slow.value,
+        }
+
+
+# Функции, в которых простаивают потоки (ожидание блокировки, очереди, сокета): такие выборки не учитываются
+_IDLE_FRAMES = {('threading.py', 'wait'), ('selectors.py', 'select'), ('queue.py', 'get'),
+                ('threading.py', '_wait_for_tstate_lock')}
+
+
+def _frame_name(code):
+    return f"{os.path.basename(code.co_filename)}:{code.co_name}"
+
+
+class _ProfileSession:
+    __slots__ = ('mode', 'requested', 'remaining', 'in_flight', 'profiled', 'interval', 'started_at',
+                 'finished_at', 'stats', 'busy', 'stacks', 'samples', 'stop_event', 'sampler')
+
+    def __init__(self, mode, requests, interval):
+        self.mode = mode
+        self.requested = requests
+        self.remaining = requests
+        self.in_flight = 0
+        self.profiled = 0
+        self.interval = interval
+        self.started_at = time.time()
+        self.finished_at = None
+        self.stats = None
+        self.busy = False
+        self.stacks = collections.Counter()
+        self.samples = 0
+        self.stop_event = threading.Event()
+        self.sampler = None
+
+
+class Profiler:
+    """Профиль следующих N запросов по команде администратора.
+
+    cprofile - cProfile в потоке запроса (запросы профилируются по одному: запрос, пришедший во время
+    профилирования другого, пропускается), sample - выборки стеков всех потоков раз в interval секунд,
+    пока обрабатываются профилируемые запросы (включая отправку из очереди и фоновые задачи).
+    Пока профиль не запрошен, запрос проверяет только атрибут active.
+    """
+
+    MODES = ('cprofile', 'sample')
+
+    def __init__(self):
+        self.active = False
+        self._session = None
+        self._lock = threading.Lock()
+
+    def start(self, mode, requests, interval=0.005):
+        """Начало сбора профиля следующих requests запросов (предыдущий профиль сбрасывается)"""
+        if mode not in self.MODES:
+            raise ValueError(f"Неизвестный режим профилирования: {mode}")
+        if requests < 1:
+            raise ValueError("Количество запросов должно быть положительным")
+        if interval <= 0:
+            raise ValueError("Интервал выборки должен быть положительным")
+        with self._lock:
+            if self._session is not None:
+                self._session.stop_event.set()
+            self._session = _ProfileSession(mode, requests, interval)
+            self.active = True
+        logger.info("Профилирование следующих %d запросов (%s)", requests, mode)
+
+    def begin(self):
+        """Начало профилирования запроса, возвращает отметку для end() или None, если запрос не профилируется"""
+        with self._lock:
+            session = self._session
+            if session is None or session.remaining <= 0 or (session.mode == 'cprofile' and session.busy):
+                return None
+            session.remaining -= 1
+            session.in_flight += 1
+            if session.mode == 'cprofile':
+                session.busy = True
+            elif session.sampler is None:
+                session.sampler = threading.Thread(target=self._sample, args=(session,), name='profiler',
+                                                   daemon=True)
+                session.sampler.start()
+        if session.mode == 'sample':
+            return session, None
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError:
+            # Профилировщик уже включен в этом потоке другим инструментом
+            profile = None
+        return session, profile
+
+    def end(self, token):
+        if token is None:
+            return
+        session, profile = token
+        if profile is not None:
+            profile.disable()
+        with self._lock:
+            if profile is not None:
+                if session.stats is None:
+                    session.stats = pstats.Stats(profile)
+                else:
+                    session.stats.add(profile)
+            session.busy = False
+            session.in_flight -= 1
+            session.profiled += 1
+            if session.remaining <= 0 and session.in_flight == 0:
+                session.finished_at = time.time()
+                session.stop_event.set()
+                if session is self._session:
+                    self.active = False
+                logger.info("Профилирование завершено: %d запросов", session.profiled)
+
+    def _sample(self, session):
+        own = threading.get_ident()
+        while not session.stop_event.wait(session.interval):
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own:
+                    continue
+                code = frame.f_code
+                if (os.path.basename(code.co_filename), code.co_name) in _IDLE_FRAMES:
+                    continue
+                stack = []
+                while frame is not None:
+                    stack.append(_frame_name(frame.f_code))
+                    frame = frame.f_back
+                session.stacks[';'.join(reversed(stack))] += 1
+                session.samples += 1
+
+    def report(self, limit=50):
+        """Состояние сбора и профиль, накопленный к этому моменту"""
+        with self._lock:
+            session = self._session
+            if session is None:
+                return {'active': False}
+            report = {
+                'active': self.active,
+                'mode': session.mode,
+                'requested': session.requested,
+                'profiled': session.profiled,
+                'in_flight': session.in_flight,
+                'started_at': session.started_at,
+                'finished_at': session.finished_at,
+            }
+            if session.mode == 'cprofile':
+                report['functions'] = self._cprofile_functions(session.stats, limit)
+            else:
+                stacks = session.stacks.copy()
+                report['interval_ms'] = session.interval * 1000
+                report['samples'] = session.samples
+        if session.mode == 'sample':
+            # Собственное время функции - выборки, в которых она на вершине стека
+            leaves = collections.Counter()
+            for stack, count in stacks.items():
+                leaves[stack.rsplit(';', 1)[-1]] += count
+            report['functions'] = [{'function': name, 'samples': count} for name, count in leaves.most_common(limit)]
+            # Свернутые стеки (формат flamegraph.pl: "a;b;c количество")
+            report['stacks'] = [{'stack': stack, 'samples': count} for stack, count in stacks.most_common(limit)]
+        return report
+
+    @staticmethod
+    def _cprofile_functions(stats, limit):
+        if stats is None:
+            return []
+        rows = sorted(stats.stats.items(), key=lambda item: item[1][3], reverse=True)[:limit]
+        return [{
+            'function': pstats.func_std_string(func),
+            'calls': calls,
+            'primitive_calls': primitive_calls,
+            'total_ms': round(total * 1000, 3),
+            'cumulative_ms': round(cumulative * 1000, 3),
+        } for func, (primitive_calls, calls, total, cumulative, _) in rows]
@@ -0,0 +1,169 @@
+import logging
+import re
+import sqlite3
+import threading
+import time
+
+from metrics import Counter
+
+logger = logging.getLogger(__name__)
+
+# Номер телефона в описании карточки, сформированной prepare_trello_card
+PHONE_RE = re.compile(r'^Телефон:\s*\+?(\d+)\s*$', re.MULTILINE)
+
+
+def card_phone(description):
+    """Номер телефона из описания карточки Trello или None"""
+    match = PHONE_RE.search(description or '')
+    return match.group(1) if match else None
+
+
+class TrelloCardIndex:
+    """Соответствие номера телефона карточке Trello в каждом списке для обновления карточек вместо дублей.
+
+    Соответствия хранятся в SQLite (общей для процессов и сохраняющейся между перезапусками),
+    а последние использованные - в ограниченном кеше в памяти. При запуске и затем каждые
+    refresh_interval секунд индекс сверяется с карточками списков одним запросом на список
+    (fetch_func(list_id) возвращает карточки с полями id и desc): удаленные и архивные карточки
+    исчезают из индекса, созданные вручную - добавляются.
+    """
+
+    def __init__(self, path, fetch_func, cache_size=10000, refresh_interval=3600.0, busy_timeout_ms=5000):
+        self.path = path
+        self._fetch_func = fetch_func
+        self._cache = {}
+        self._cache_size = max(1, cache_size)
+        self._refresh_interval = refresh_interval
+        self._busy_timeout_ms = busy_timeout_ms
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._stop_event = threading.Event()
+        self._thread = None
+        self._list_ids = ()
+        self.last_refresh = None
+        self.hits = Counter()
+        self.misses = Counter()
+        self.refreshes = Counter()
+        conn = self._connection()
+        conn.execute(
+            'CREATE TABLE IF NOT EXISTS trello_cards ('
+            ' list_id TEXT NOT NULL,'
+            ' phone TEXT NOT NULL,'
+            ' card_id TEXT NOT NULL,'
+            ' updated_at REAL NOT NULL,'
+            ' PRIMARY KEY (list_id, phone))'
+        )
+        conn.commit()
+
+    def _connection(self):
+        # Соединение SQLite нельзя разделять между потоками, поэтому у каждого потока свое
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=self._busy_timeout_ms / 1000.0)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            conn.execute(f'PRAGMA busy_timeout={int(self._busy_timeout_ms)}')
+            self._local.conn = conn
+        return conn
+
+    def _remember(self, key, card_id):
+        with self._lock:
+            # Удаление и повторная вставка переносят запись в конец порядка вытеснения
+            self._cache.pop(key, None)
+            self._cache[key] = card_id
+            if len(self._cache) > self._cache_size:
+                del self._cache[next(iter(self._cache))]
+
+    def get(self, list_id, phone):
+        """ID карточки номера phone в списке list_id или None"""
+        key = (list_id, phone)
+        card_id = self._cache.get(key)
+        if card_id is None:
+            row = self._connection().execute(
+                'SELECT card_id FROM trello_cards WHERE list_id = ? AND phone = ?', key).fetchone()
+            if row is None:
+                self.misses.inc()
+                return None
+            card_id = row[0]
+        self._remember(key, card_id)
+        self.hits.inc()
+        return card_id
+
+    def put(self, list_id, phone, card_id):
+        conn = self._connection()
+        conn.execute('INSERT OR REPLACE INTO trello_cards (list_id, phone, card_id, updated_at) VALUES (?, ?, ?, ?)',
+                     (list_id, phone, card_id, time.time()))
+        conn.commit()
+        self._remember((list_id, phone), card_id)
+
+    def discard(self, list_id, phone):
+        """Удаление соответствия (карточка удалена или перенесена в другой список)"""
+        conn = self._connection()
+        conn.execute('DELETE FROM trello_cards WHERE list_id = ? AND phone = ?', (list_id, phone))
+        conn.commit()
+        with self._lock:
+            self._cache.pop((list_id, phone), None)
+
+    def refresh(self, list_id):
+        """Сверка индекса списка с его карточками, возвращает количество карточек с номером телефона"""
+        started = time.time()
+        cards = {}
+        for card in self._fetch_func(list_id):
+            phone = card_phone(card.get('desc'))
+            # Карточки создаются наверху списка, поэтому первая карточка номера - самая новая
+            if phone and phone not in cards:
+                cards[phone] = card['id']
+        # Соответствия, записанные во время загрузки карточек, новее загруженных и сохраняются
+        conn = self._connection()
+        conn.execute('DELETE FROM trello_cards WHERE list_id = ? AND updated_at < ?', (list_id, started))
+        conn.executemany('INSERT OR IGNORE INTO trello_cards (list_id, phone, card_id, updated_at) VALUES (?, ?, ?, ?)',
+                         [(list_id, phone, card_id, started) for phone, card_id in cards.items()])
+        conn.commit()
+        with self._lock:
+            self._cache = {key: card_id for key, card_id in self._cache.items() if key[0] != list_id}
+        self.refreshes.inc()
+        self.last_refresh = started
+        logger.info("Индекс карточек Trello списка %s: %d номеров", list_id, len(cards))
+        return len(cards)
+
+    def _refresh_all(self):
+        for list_id in self._list_ids:
+            try:
+                self.refresh(list_id)
+            except Exception as e:
+                # Индекс остается прежним до следующей сверки
+                logger.error("Не удалось загрузить карточки списка Trello %s: %s", list_id, e)
+
+    def _run(self):
+        while True:
+            self._refresh_all()
+            if self._stop_event.wait(self._refresh_interval):
+                return
+
+    def start(self, list_ids):
+        """Сверка с карточками списков list_ids в фоновом потоке: сразу и затем каждые refresh_interval секунд"""
+        self._list_ids = tuple(dict.fromkeys(list_id for list_id in list_ids if list_id))
+        if self._thread is not None or not self._list_ids:
+            return
+        self._thread = threading.Thread(target=self._run, name='trello-index', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop_event.set()
+
+    def count(self):
+        return self._connection().execute('SELECT COUNT(*) FROM trello_cards').fetchone()[0]
+
+    def stats(self):
+        hits = self.hits.value
+        total = hits + self.misses.value
+        return {
+            'cards': self.count(),
+            'cached': len(self._cache),
+            'cache_capacity': self._cache_size,
+            'hits': hits,
+            'misses': self.misses.value,
+            'hit_rate': hits / total if total else 0.0,
+            'refreshes': self.refreshes.value,
+            'last_refresh': self.last_refresh,
+        }
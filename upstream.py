@@ -0,0 +1,385 @@
+import asyncio
+import logging
+import random
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import ConnectTimeoutError, NewConnectionError
+
+try:
+    import httpx
+except ImportError:  # httpx нужен только для асинхронного режима (asgi.py)
+    httpx = None
+
+from config import (HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT, HTTP_MAX_RETRIES, HTTP_BACKOFF_BASE,
+                    HTTP_BACKOFF_MAX, HTTP_POOL_SIZE, CIRCUIT_FAILURE_THRESHOLD, CIRCUIT_RESET_TIMEOUT)
+from metrics import Counter, Histogram, Labeled
+from rate_limit import PRIORITY_INTERACTIVE, PRIORITY_RETRY
+
+logger = logging.getLogger(__name__)
+
+# Коды ответа, при которых запрос повторяется
+RETRY_STATUSES = frozenset([429, 500, 502, 503, 504])
+# Методы, которые можно повторить после разрыва соединения: повтор не создает вторую сущность.
+# POST (отправка сообщения, создание карточки) повторяется, только если соединение не было установлено
+IDEMPOTENT_METHODS = frozenset(['GET', 'HEAD', 'OPTIONS', 'PUT', 'DELETE'])
+
+
+class CircuitOpenError(Exception):
+    """Внешний сервис помечен как недоступный, запрос не выполняется"""
+
+
+class CircuitBreaker:
+    """Автомат защиты: после серии ошибок запросы отклоняются до истечения таймаута"""
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+    # Результат allow() для пробной попытки в полуоткрытом состоянии
+    PROBE = 'probe'
+
+    def __init__(self, failure_threshold=5, reset_timeout=30.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._state = self.CLOSED
+        self._failures = 0
+        self._opened_at = 0.0
+        self._probe_in_flight = False
+        self._lock = threading.Lock()
+        self.rejected = Counter()
+        self.opened = Counter()
+
+    @property
+    def state(self):
+        with self._lock:
+            if self._state == self.OPEN and time.monotonic() - self._opened_at >= self.reset_timeout:
+                return self.HALF_OPEN
+            return self._state
+
+    def allow(self):
+        """Можно ли выполнить запрос. В полуоткрытом состоянии пропускается одна пробная попытка (PROBE)"""
+        with self._lock:
+            if self._state == self.CLOSED:
+                return True
+            if self._state == self.OPEN:
+                if time.monotonic() - self._opened_at < self.reset_timeout:
+                    self.rejected.inc()
+                    return False
+                self._state = self.HALF_OPEN
+                self._probe_in_flight = False
+            if self._probe_in_flight:
+                self.rejected.inc()
+                return False
+            self._probe_in_flight = True
+            return self.PROBE
+
+    def release_probe(self):
+        """Пробная попытка завершилась без ответа и без учтенной ошибки (отмена, исключение вне HTTP-клиента):
+        следующий запрос может стать новой пробной попыткой"""
+        with self._lock:
+            if self._state == self.HALF_OPEN:
+                self._probe_in_flight = False
+
+    def record_success(self):
+        with self._lock:
+            self._state = self.CLOSED
+            self._failures = 0
+            self._probe_in_flight = False
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            self._probe_in_flight = False
+            if self._state == self.HALF_OPEN or self._failures >= self.failure_threshold:
+                if self._state != self.OPEN:
+                    self.opened.inc()
+                self._state = self.OPEN
+                self._opened_at = time.monotonic()
+
+
+class _UpstreamBase:
+    """Общая часть синхронного и асинхронного клиентов: повторы, автомат защиты и счетчики"""
+
+    def __init__(self, name, connect_timeout=HTTP_CONNECT_TIMEOUT, read_timeout=HTTP_READ_TIMEOUT,
+                 max_retries=HTTP_MAX_RETRIES, backoff_base=HTTP_BACKOFF_BASE, backoff_max=HTTP_BACKOFF_MAX,
+                 failure_threshold=CIRCUIT_FAILURE_THRESHOLD, reset_timeout=CIRCUIT_RESET_TIMEOUT):
+        self.name = name
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.breaker = CircuitBreaker(failure_threshold, reset_timeout)
+
+        self.requests = Counter()
+        self.retries = Counter()
+        self.errors = Counter()
+        # Длительность и коды ответов каждой попытки (error - ответ не получен)
+        self.latency = Labeled(('method',), Histogram)
+        self.responses = Labeled(('method', 'status'))
+
+    def _observe(self, method, started, response):
+        self.latency.labels(method).observe(time.perf_counter() - started)
+        self.responses.labels(method, str(response.status_code) if response is not None else 'error').inc()
+
+    def _check_breaker(self):
+        """CircuitOpenError, если сервис помечен как недоступный; True - запрос является пробной попыткой"""
+        allowed = self.breaker.allow()
+        if not allowed:
+            raise CircuitOpenError(f"{self.name}: сервис временно недоступен")
+        return allowed == CircuitBreaker.PROBE
+
+    def _should_retry_connection_error(self, attempt, error, method, connect_failed):
+        """Ошибка соединения: True - повторить запрос, False - исчерпаны попытки или запрос мог быть
+        уже выполнен (соединение разорвано после отправки тела неидемпотентного запроса)"""
+        if attempt >= self.max_retries:
+            self.errors.inc()
+            self.breaker.record_failure()
+            return False
+        if not connect_failed and method.upper() not in IDEMPOTENT_METHODS:
+            logger.warning("%s: соединение разорвано после отправки %s (%s), запрос не повторяется",
+                           self.name, method.upper(), error)
+            self.errors.inc()
+            self.breaker.record_failure()
+            return False
+        logger.warning("%s: ошибка соединения (%s), повтор #%d", self.name, error, attempt + 1)
+        return True
+
+    def _record_error(self):
+        self.errors.inc()
+        self.breaker.record_failure()
+
+    def _should_retry_response(self, attempt, response):
+        """Ответ получен: True - повторить запрос, False - вернуть ответ вызывающему коду"""
+        if response.status_code not in RETRY_STATUSES or attempt >= self.max_retries:
+            if response.status_code in RETRY_STATUSES:
+                self._record_error()
+            else:
+                self.breaker.record_success()
+            return False
+        logger.warning("%s: HTTP %s, повтор #%d", self.name, response.status_code, attempt + 1)
+        return True
+
+    @staticmethod
+    def _attempt_priority(attempt, priority):
+        """Приоритет попытки в ведре токенов: повторы уступают новым ответам в диалоге"""
+        return priority if attempt == 0 else max(priority, PRIORITY_RETRY)
+
+    @staticmethod
+    def _throttles(rate_limiter, response):
+        """Ответ 429 приостанавливает все отправки через ведро, а не только повтор этого запроса"""
+        return rate_limiter is not None and response is not None and response.status_code == 429
+
+    def _backoff(self, attempt, response=None):
+        """Пауза перед повтором: экспоненциальная задержка с полным джиттером или Retry-After"""
+        if response is not None:
+            retry_after = response.headers.get('Retry-After')
+            if retry_after and retry_after.isdigit():
+                return min(float(retry_after), self.backoff_max)
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * (2 ** attempt)))
+
+    def _base_stats(self):
+        return {
+            'breaker_state': self.breaker.state,
+            'breaker_opened': self.breaker.opened.value,
+            'breaker_rejected': self.breaker.rejected.value,
+            'requests': self.requests.value,
+            'retries': self.retries.value,
+            'errors': self.errors.value,
+        }
+
+
+def _connect_failed(error):
+    """Ошибка requests произошла до отправки запроса: соединение не установлено"""
+    if isinstance(error, requests.ConnectTimeout):
+        return True
+    reason = error.args[0] if error.args else None
+    # requests оборачивает ошибку urllib3 в MaxRetryError с причиной в reason
+    reason = getattr(reason, 'reason', reason)
+    return isinstance(reason, (NewConnectionError, ConnectTimeoutError))
+
+
+class UpstreamClient(_UpstreamBase):
+    """HTTP-клиент внешнего сервиса: пул keep-alive соединений, таймауты, повторы и автомат защиты"""
+
+    def __init__(self, name, pool_size=HTTP_POOL_SIZE, **options):
+        super().__init__(name, **options)
+        self.timeout = (self.connect_timeout, self.read_timeout)
+
+        # Повторы выполняются здесь, а не в urllib3, чтобы учитывать их в автомате защиты
+        self._adapter = HTTPAdapter(pool_connections=4, pool_maxsize=pool_size, max_retries=0)
+        self.session = requests.Session()
+        self.session.mount('https://', self._adapter)
+        self.session.mount('http://', self._adapter)
+
+    def request(self, method, url, rate_limiter=None, priority=PRIORITY_INTERACTIVE, **kwargs):
+        """Выполнение запроса. CircuitOpenError - если сервис помечен как недоступный.
+
+        rate_limiter - ведро токенов (rate_limit.py): каждая попытка ждет токен с приоритетом priority.
+        """
+        probe = self._check_breaker()
+        kwargs.setdefault('timeout', self.timeout)
+
+        try:
+            attempt = 0
+            while True:
+                if rate_limiter is not None:
+                    rate_limiter.acquire(self._attempt_priority(attempt, priority))
+                self.requests.inc()
+                response = None
+                if attempt and hasattr(kwargs.get('data'), 'seek'):
+                    # Тело-поток (например, вложение) перематывается перед повтором
+                    kwargs['data'].seek(0)
+                started = time.perf_counter()
+                try:
+                    response = self.session.request(method, url, **kwargs)
+                except requests.ConnectionError as e:
+                    # Соединение не установлено - повторяем; разорвано - повторяем только идемпотентные запросы
+                    if not self._should_retry_connection_error(attempt, e, method, _connect_failed(e)):
+                        raise
+                except requests.RequestException:
+                    # Таймаут чтения и прочие ошибки не повторяются: запрос мог быть уже выполнен
+                    self._record_error()
+                    raise
+                else:
+                    if not self._should_retry_response(attempt, response):
+                        return response
+                    # Соединение возвращается в пул и при запросе с stream=True
+                    response.close()
+                finally:
+                    self._observe(method, started, response)
+                self.retries.inc()
+                delay = self._backoff(attempt, response)
+                if self._throttles(rate_limiter, response):
+                    rate_limiter.throttle(delay)
+                else:
+                    time.sleep(delay)
+                attempt += 1
+        except BaseException:
+            # Пробная попытка, прерванная отменой или исключением вне HTTP-клиента, не должна
+            # оставить автомат защиты полуоткрытым навсегда
+            if probe:
+                self.breaker.release_probe()
+            raise
+
+    def get(self, url, **kwargs):
+        return self.request('GET', url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request('POST', url, **kwargs)
+
+    def pool_stats(self):
+        """Количество запросов и новых соединений по всем пулам (хостам) клиента"""
+        total_requests = 0
+        total_connections = 0
+        pools = self._adapter.poolmanager.pools
+        for key in list(pools.keys()):
+            pool = pools.get(key)
+            if pool is None:
+                continue
+            total_requests += pool.num_requests
+            total_connections += pool.num_connections
+        return {
+            'hosts': len(pools),
+            'connections_opened': total_connections,
+            # Запрос, не потребовавший нового соединения, обслужен из пула
+            'pool_hits': max(0, total_requests - total_connections),
+        }
+
+    def stats(self):
+        stats = self._base_stats()
+        stats.update(self.pool_stats())
+        return stats
+
+
+class AsyncUpstreamClient(_UpstreamBase):
+    """Асинхронный HTTP-клиент внешнего сервиса на httpx с теми же повторами и автоматом защиты.
+
+    Клиент создается в работающем цикле событий (start) и закрывается при остановке (close).
+    """
+
+    def __init__(self, name, max_connections=1000, **options):
+        if httpx is None:
+            raise RuntimeError("Для асинхронного режима установите httpx: pip install httpx")
+        super().__init__(name, **options)
+        self.max_connections = max_connections
+        self.client = None
+
+    def start(self):
+        if self.client is None:
+            self.client = httpx.AsyncClient(
+                timeout=httpx.Timeout(self.read_timeout, connect=self.connect_timeout),
+                limits=httpx.Limits(max_connections=self.max_connections,
+                                    max_keepalive_connections=self.max_connections)
+            )
+
+    async def close(self):
+        if self.client is not None:
+            await self.client.aclose()
+            self.client = None
+
+    async def request(self, method, url, rate_limiter=None, priority=PRIORITY_INTERACTIVE, **kwargs):
+        """Выполнение запроса. CircuitOpenError - если сервис помечен как недоступный.
+
+        rate_limiter - асинхронное ведро токенов (rate_limit.AsyncTokenBucket).
+        """
+        probe = self._check_breaker()
+        self.start()
+
+        try:
+            attempt = 0
+            while True:
+                if rate_limiter is not None:
+                    await rate_limiter.acquire(self._attempt_priority(attempt, priority))
+                self.requests.inc()
+                response = None
+                started = time.perf_counter()
+                try:
+                    response = await self.client.request(method, url, **kwargs)
+                except (httpx.ConnectError, httpx.RemoteProtocolError) as e:
+                    # ConnectError - соединение не установлено, RemoteProtocolError - разорвано после отправки
+                    if not self._should_retry_connection_error(attempt, e, method, isinstance(e, httpx.ConnectError)):
+                        raise
+                except httpx.HTTPError:
+                    self._record_error()
+                    raise
+                else:
+                    if not self._should_retry_response(attempt, response):
+                        return response
+                finally:
+                    self._observe(method, started, response)
+                self.retries.inc()
+                delay = self._backoff(attempt, response)
+                if self._throttles(rate_limiter, response):
+                    rate_limiter.throttle(delay)
+                else:
+                    await asyncio.sleep(delay)
+                attempt += 1
+        except BaseException:
+            # Пробная попытка, прерванная отменой или исключением вне HTTP-клиента, не должна
+            # оставить автомат защиты полуоткрытым навсегда
+            if probe:
+                self.breaker.release_probe()
+            raise
+
+    async def get(self, url, **kwargs):
+        return await self.request('GET', url, **kwargs)
+
+    async def post(self, url, **kwargs):
+        return await self.request('POST', url, **kwargs)
+
+    def stats(self):
+        stats = self._base_stats()
+        pool = getattr(getattr(self.client, '_transport', None), '_pool', None)
+        stats['connections_open'] = len(pool.connections) if pool is not None else 0
+        return stats
+
+
+# Общие клиенты для внешних сервисов
+waapi_http = UpstreamClient('waapi')
+trello_http = UpstreamClient('trello')
+# Файлы из сообщений загружаются отдельным клиентом: медленный или недоступный хост файлов
+# не размыкает автомат защиты waApi и не занимает его пул соединений
+media_http = UpstreamClient('media')